@@ -0,0 +1,110 @@
+
+# Standard library imports
+import argparse
+import glob
+import json
+import os
+import time
+
+from configparser import ConfigParser
+
+# Third party library imports
+import numpy as np
+
+from tqdm import tqdm
+
+# Local library imports
+from code.input_interpreter import convert_to_PIL, convert_to_PIL_thumbnail
+from code.HOG_implementation.facial_detection import set_up, facial_detection_PIL
+
+
+def benchmark_detection_scale(image_paths, predictor_path, scales=(1, 2, 4, 8)):
+    """ Compares downscaled face detection against full resolution detection
+
+    :param image_paths: A list of strings to valid input image paths.
+    :param predictor_path: A string for a valid path to dlib predictor object.
+    :param scales: A tuple of integers for the detection scales to compare.
+    :return: A dictionary of scale to the mean detection time in seconds, the mean
+    landmark error in pixels and normalised by the inter-ocular distance, and the
+    number of images where detection failed.
+    """
+
+    predictor, detector = set_up(predictor_path)
+    results = {scale: {'seconds': [], 'error_px': [], 'error_iod': [], 'failures': 0}
+        for scale in scales}
+
+    pbar = tqdm(image_paths)
+    for file_path in pbar:
+        pbar.set_description('Benchmarking {}'.format(os.path.split(file_path)[1]))
+        PIL_img = convert_to_PIL(file_path)
+        PIL_img.load()
+
+        reference = None
+        for scale in scales:
+            # time the full detection including the reduced decode of the image
+            start = time.perf_counter()
+            try:
+                thumbnail = convert_to_PIL_thumbnail(file_path, scale) if scale > 1 else None
+                face_dict = facial_detection_PIL(PIL_img, predictor, detector, scale, thumbnail)
+            except (IOError, ValueError):
+                results[scale]['failures'] += 1
+                continue
+            results[scale]['seconds'].append(time.perf_counter() - start)
+
+            # faces smaller than the minimum size leave no detections behind
+            if not face_dict:
+                results[scale]['failures'] += 1
+                continue
+
+            # the first scale is the reference every other scale is compared to
+            points = np.array(face_dict[min(face_dict)]['facial_points'], dtype=float)
+            if reference is None:
+                reference = points
+            inter_ocular = np.linalg.norm(
+                reference[36:42].mean(axis=0) - reference[42:48].mean(axis=0)
+            )
+            error = np.linalg.norm(points - reference, axis=1).mean()
+            results[scale]['error_px'].append(error)
+            results[scale]['error_iod'].append(error / inter_ocular)
+
+    return {
+        scale: {
+            'seconds': float(np.mean(result['seconds'])) if result['seconds'] else None,
+            'error_px': float(np.mean(result['error_px'])) if result['error_px'] else None,
+            'error_iod': float(np.mean(result['error_iod'])) if result['error_iod'] else None,
+            'failures': result['failures']
+        }
+        for scale, result in results.items()
+    }
+
+
+if __name__ == '__main__':
+
+    # set up command line argument parser
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-i", "--images", required=False, default=None,
+        help="A string for the directory of images, defaults to original_dir")
+    ap.add_argument("-n", "--number", required=False, type=int, default=50,
+        help="An integer for the number of images to benchmark")
+    ap.add_argument("-s", "--scales", required=False, type=int, nargs='+',
+        default=[1, 2, 4, 8], help="The detection scales to compare, the first is the reference")
+    ap.add_argument("-o", "--output", required=False, default=None,
+        help="A string for a JSON file to save the results to")
+    args = vars(ap.parse_args())
+
+    # set up configuration and initialize variables
+    config = ConfigParser()
+    config.read('config.ini')
+
+    image_dir = args['images'] or config['Paths']['original_dir']
+    image_paths = sorted(glob.glob(os.path.join(image_dir, '*.*')))[:args['number']]
+
+    results = benchmark_detection_scale(
+        image_paths, config['Paths']['HOG_predictor_path'], args['scales']
+    )
+    for scale, result in results.items():
+        print("scale 1/{}: {}".format(scale, result))
+
+    if args['output']:
+        with open(args['output'], 'w') as fp:
+            json.dump(results, fp, indent=2)
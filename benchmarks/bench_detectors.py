@@ -0,0 +1,99 @@
+
+# Standard library imports
+import argparse
+import glob
+import json
+import os
+import time
+
+from configparser import ConfigParser
+
+# Third party library imports
+import numpy as np
+
+from tqdm import tqdm
+
+# Local library imports
+from code.input_interpreter import convert_to_PIL
+from code.detectors import DETECTORS, get_detector, detector_options
+
+
+def benchmark_detectors(image_paths, predictor_path, backends, backend_options=None,
+        batch_size=8):
+    """ Compares detector backends head to head on the same decoded images
+
+    :param image_paths: A list of strings to valid input image paths.
+    :param predictor_path: A string for a valid path to dlib predictor object.
+    :param backends: A list of backend names, the first is the reference every other
+    backend is compared to.
+    :param backend_options: An optional dictionary of backend names to their options.
+    :param batch_size: An integer with default 8 for the images passed per batch.
+    :return: A dictionary of backend to the mean seconds per image, the mean landmark
+    error normalised by the inter-ocular distance of the reference, and the number of
+    images without exactly one face.
+    """
+
+    backend_options = backend_options or {}
+    images = [convert_to_PIL(file_path).convert('RGB') for file_path in tqdm(image_paths)]
+
+    reference, results = None, {}
+    for name in backends:
+        detector = get_detector(name, predictor_path, **backend_options.get(name, {}))
+
+        start = time.perf_counter()
+        landmarks = []
+        for begin in range(0, len(images), batch_size):
+            landmarks.extend(detector.detect_batch(images[begin:begin + batch_size])[1])
+        seconds = time.perf_counter() - start
+
+        # only images with a single face in both backends can be compared
+        points = [points[0].astype(float) if len(points) == 1 else None for points in landmarks]
+        if reference is None:
+            reference = points
+        errors = []
+        for ref, pts in zip(reference, points):
+            if ref is None or pts is None:
+                continue
+            inter_ocular = np.linalg.norm(ref[36:42].mean(axis=0) - ref[42:48].mean(axis=0))
+            errors.append(np.linalg.norm(pts - ref, axis=1).mean() / inter_ocular)
+
+        results[name] = {
+            'seconds_per_image': seconds / max(len(images), 1),
+            'error_iod': float(np.mean(errors)) if errors else None,
+            'failures': sum(pts is None for pts in points),
+        }
+
+    return results
+
+
+if __name__ == '__main__':
+
+    # set up command line argument parser
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-i", "--images", required=False, default=None,
+        help="A string for the directory of images, defaults to original_dir")
+    ap.add_argument("-n", "--number", required=False, type=int, default=20,
+        help="An integer for the number of images to benchmark")
+    ap.add_argument("-b", "--backends", required=False, nargs='+', choices=sorted(DETECTORS),
+        default=sorted(DETECTORS), help="The backends to compare, the first is the reference")
+    ap.add_argument("-o", "--output", required=False, default=None,
+        help="A string for a JSON file to save the results to")
+    args = vars(ap.parse_args())
+
+    # set up configuration and initialize variables
+    config = ConfigParser()
+    config.read('config.ini')
+
+    image_dir = args['images'] or config['Paths']['original_dir']
+    image_paths = sorted(glob.glob(os.path.join(image_dir, '*.*')))[:args['number']]
+
+    results = benchmark_detectors(
+        image_paths, config['Paths']['HOG_predictor_path'], args['backends'],
+        {name: detector_options(config, name) for name in args['backends']}
+    )
+    for name, result in results.items():
+        print("{}: {}".format(name, result))
+
+    if args['output']:
+        with open(args['output'], 'w') as fp:
+            json.dump(results, fp, indent=2)
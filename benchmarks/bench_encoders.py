@@ -0,0 +1,105 @@
+
+# Standard library imports
+import argparse
+import glob
+import json
+import os
+import tempfile
+import time
+
+# Third party library imports
+from tqdm import tqdm
+
+# Local library imports
+from benchmarks.run_benchmarks import synthetic_image
+from code.image_alignment import ENCODER_PRESETS, crop_size, write_jpeg_list_to_video, \
+    write_jpeg_list_to_video_parallel
+
+
+def benchmark_encoders(jpeg_paths, presets, segment_counts=(1, 4), frame_rate=10):
+    """ Compares the total encode time and file size of encoder presets, each encoded
+    as a single video and split into segments encoded in parallel
+
+    :param jpeg_paths: A list of strings to valid .jpeg images in play order.
+    :param presets: A list of preset names of ENCODER_PRESETS.
+    :param segment_counts: A tuple of integers for the number of parallel segments.
+    :param frame_rate: An integer with default 10 for the framerate of the videos.
+    :return: A dictionary of preset to number of segments to the encode seconds,
+    frames per second and size of the video in megabytes.
+    """
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for preset in presets:
+            results[preset] = {}
+            for segments in segment_counts:
+                video_path = os.path.join(tmp_dir, "{}_{}.mp4".format(preset, segments))
+
+                start = time.perf_counter()
+                if segments > 1:
+                    write_jpeg_list_to_video_parallel(
+                        jpeg_paths, video_path, frame_rate, encoder=preset, segments=segments
+                    )
+                else:
+                    write_jpeg_list_to_video(jpeg_paths, video_path, frame_rate, encoder=preset)
+                seconds = time.perf_counter() - start
+
+                results[preset][segments] = {
+                    'seconds': seconds,
+                    'frames_per_second': len(jpeg_paths) / seconds,
+                    'size_mb': os.path.getsize(video_path) / 2 ** 20
+                        if os.path.exists(video_path) else None,
+                }
+                print("{} x{}: {}".format(preset, segments, results[preset][segments]))
+
+    return results
+
+
+def synthetic_jpegs(jpeg_dir, num_frames, size):
+    """ Writes synthetic frames which drift slowly like a timelapse, so the encoder
+    has motion to predict between them
+
+    :param jpeg_dir: A string for a valid directory to write the frames to.
+    :param num_frames: An integer for the number of frames.
+    :param size: A (width, height) tuple of the frame size.
+    :return: A list of strings to the written .jpeg images in play order.
+    """
+
+    jpeg_paths = []
+    for i in tqdm(range(num_frames)):
+        jpeg_path = os.path.join(jpeg_dir, "frame_{:05d}.jpeg".format(i))
+        synthetic_image(size, seed=i).rotate(i % 360).save(jpeg_path, quality=95)
+        jpeg_paths.append(jpeg_path)
+
+    return jpeg_paths
+
+
+if __name__ == '__main__':
+
+    # set up command line argument parser
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-i", "--images", required=False, default=None,
+        help="A string for a directory of processed .jpeg frames, synthetic without it")
+    ap.add_argument("-n", "--number", required=False, type=int, default=300,
+        help="An integer for the number of frames to encode")
+    ap.add_argument("-p", "--presets", required=False, nargs='+',
+        choices=sorted(ENCODER_PRESETS), default=sorted(ENCODER_PRESETS),
+        help="The encoder presets to compare")
+    ap.add_argument("-s", "--segments", required=False, type=int, nargs='+', default=[1, 4],
+        help="The numbers of segments encoded in parallel to compare")
+    ap.add_argument("-o", "--output", required=False, default=None,
+        help="A string for a JSON file to save the results to")
+    args = vars(ap.parse_args())
+
+    with tempfile.TemporaryDirectory() as jpeg_dir:
+        if args['images']:
+            jpeg_paths = sorted(glob.glob(os.path.join(args['images'], '*.jpeg')))
+            jpeg_paths = jpeg_paths[:args['number']]
+        else:
+            jpeg_paths = synthetic_jpegs(jpeg_dir, args['number'], crop_size(1080))
+
+        results = benchmark_encoders(jpeg_paths, args['presets'], tuple(args['segments']))
+
+    if args['output']:
+        with open(args['output'], 'w') as fp:
+            json.dump(results, fp, indent=2)
@@ -0,0 +1,249 @@
+
+# Standard library imports
+import argparse
+import json
+import os
+import subprocess
+import tempfile
+import time
+
+from configparser import ConfigParser
+from datetime import datetime
+
+# Third party library imports
+import numpy as np
+
+from PIL import Image
+
+# Local library imports
+from code.input_interpreter import convert_to_PIL
+from code.HOG_implementation.facial_detection import set_up, facial_detection_PIL
+from code.image_alignment import crop_image_from_PIL, crop_size, write_numpy_to_video
+from code.data_storage import store_single_hdf5
+
+
+RESOLUTIONS = {
+    '1080p': (1920, 1080),
+    '12MP': (4032, 3024),
+    '48MP': (8064, 6048),
+}
+
+
+def synthetic_image(size, seed=0):
+    """ Generates a smooth colour gradient with light noise, which compresses and
+    decodes much like a photo unlike pure noise
+
+    :param size: A (width, height) tuple of the image size.
+    :param seed: An integer with default 0 for the noise generator.
+    :return: A PIL object of the RGB image.
+    """
+
+    width, height = size
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0, 1, width, dtype=np.float32)[np.newaxis, :, np.newaxis]
+    y = np.linspace(0, 1, height, dtype=np.float32)[:, np.newaxis, np.newaxis]
+    rgb = 255 * (0.5 * x + 0.3 * y + 0.2 * np.array([0.8, 0.5, 0.3], dtype=np.float32))
+    rgb = rgb + rng.normal(0, 6, (height, width, 1)).astype(np.float32)
+
+    return Image.fromarray(np.clip(rgb, 0, 255).astype(np.uint8))
+
+
+def synthetic_face_dict(size):
+    """ Builds a recorded style set of 68 landmarks for a face in the middle of the
+    image, which is enough for every stage except detection itself
+
+    :param size: A (width, height) tuple of the image size.
+    :return: A dictionary of facial detections in the facial_detection_PIL format.
+    """
+
+    width, height = size
+    face = min(width, height) // 3
+    centre_x, centre_y = width // 2, height // 2
+
+    # spread the points over an ellipse and pin the eyes and nose to their places
+    angles = np.linspace(0, 2 * np.pi, 68, endpoint=False)
+    points = np.stack([
+        centre_x + 0.4 * face * np.cos(angles), centre_y + 0.5 * face * np.sin(angles)
+    ], axis=1)
+    points[36:42] = [centre_x - 0.2 * face, centre_y - 0.1 * face]
+    points[42:48] = [centre_x + 0.2 * face, centre_y - 0.1 * face]
+    points[27] = [centre_x, centre_y - 0.1 * face]
+    points[30] = [centre_x, centre_y + 0.1 * face]
+
+    return {
+        0: {
+            'facial_coords': [centre_x - face // 2, centre_y - face // 2,
+                centre_x + face // 2, centre_y + face // 2],
+            'facial_points': [tuple(point) for point in points.astype(int).tolist()]
+        }
+    }
+
+
+def time_call(func, repeats=3):
+    """ Times repeated calls of a function
+
+    :param func: A callable without arguments.
+    :param repeats: An integer with default 3 for the number of calls.
+    :return: A dictionary of the min, median and mean seconds of the calls.
+    """
+
+    seconds = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        seconds.append(time.perf_counter() - start)
+
+    return {
+        'min': float(np.min(seconds)),
+        'median': float(np.median(seconds)),
+        'mean': float(np.mean(seconds)),
+        'repeats': repeats,
+    }
+
+
+def run_benchmarks(resolutions, predictor_path=None, face_path=None, repeats=3,
+        num_frames=30):
+    """ Times every stage of the pipeline on synthetic inputs of each resolution
+
+    :param resolutions: A list of keys of RESOLUTIONS to benchmark.
+    :param predictor_path: An optional string for a valid path to dlib predictor
+    object, detection is skipped without it.
+    :param face_path: An optional string to a real selfie which is resized to every
+    resolution for timing detection, since a synthetic image holds no face.
+    :param repeats: An integer with default 3 for the number of timed calls.
+    :param num_frames: An integer with default 30 for the frames encoded to video.
+    :return: A dictionary of resolution to stage to timing dictionaries.
+    """
+
+    predictor, detector = set_up(predictor_path) if predictor_path else (None, None)
+    face_img = convert_to_PIL(face_path).convert('RGB') if face_path else None
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name in resolutions:
+            size = RESOLUTIONS[name]
+            print("Benchmarking {} {}x{}".format(name, *size))
+
+            jpeg_path = os.path.join(tmp_dir, name + ".jpeg")
+            synthetic_image(size).save(jpeg_path, quality=95)
+            face_dict = synthetic_face_dict(size)
+            box_size = min(size) // 2
+
+            def decode():
+                convert_to_PIL(jpeg_path).load()
+
+            PIL_img = convert_to_PIL(jpeg_path)
+            PIL_img.load()
+            cropped = crop_image_from_PIL(PIL_img, face_dict, box_size=box_size)
+            frame = np.asarray(cropped)
+
+            stages = {
+                'convert_to_PIL': decode,
+                'crop_image_from_PIL': lambda: crop_image_from_PIL(
+                    PIL_img, face_dict, box_size=box_size
+                ).load(),
+                'crop_image_from_PIL_1080': lambda: crop_image_from_PIL(
+                    PIL_img, face_dict, box_size=box_size, output_size=crop_size(1080)
+                ).load(),
+                'jpeg_save': lambda: cropped.save(
+                    os.path.join(tmp_dir, name + "_crop.jpeg"), quality=95
+                ),
+                'write_numpy_to_video': lambda: write_numpy_to_video(
+                    os.path.join(tmp_dir, name + ".mp4"), (frame for _ in range(num_frames)),
+                    frame_rate=10
+                ),
+                'store_single_hdf5': lambda: store_single_hdf5(
+                    name, frame, {'crop_size': crop_size(box_size)},
+                    os.path.join(tmp_dir, "frames.h5")
+                ),
+            }
+            if predictor is not None and face_img is not None:
+                face_resized = face_img.resize(size, Image.BILINEAR)
+                stages['facial_detection_PIL'] = lambda: facial_detection_PIL(
+                    face_resized, predictor, detector
+                )
+
+            results[name] = {
+                stage: time_call(func, repeats) for stage, func in stages.items()
+            }
+
+    return results
+
+
+def git_commit():
+    """ Looks up the commit the benchmarks are run against
+
+    :return: A string of the current commit hash or None outside a git repository.
+    """
+
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(results, baseline):
+    """ Prints the median time of every stage relative to a previous run
+
+    :param results: A dictionary of benchmark results returned by run_benchmarks.
+    :param baseline: A dictionary of benchmark results loaded from a saved run.
+    """
+
+    for name, stages in results.items():
+        for stage, timing in stages.items():
+            previous = baseline.get(name, {}).get(stage)
+            if previous is None:
+                continue
+            print("{:>6} {:<22} {:8.4f}s -> {:8.4f}s ({:+.1%})".format(
+                name, stage, previous['median'], timing['median'],
+                timing['median'] / previous['median'] - 1
+            ))
+
+
+if __name__ == '__main__':
+
+    # set up command line argument parser
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-r", "--resolutions", required=False, nargs='+',
+        choices=list(RESOLUTIONS), default=list(RESOLUTIONS),
+        help="The synthetic image resolutions to benchmark")
+    ap.add_argument("-f", "--face", required=False, default=None,
+        help="A string to a selfie used for timing detection, defaults to the first image of original_dir")
+    ap.add_argument("-n", "--repeats", required=False, type=int, default=3,
+        help="An integer for the number of timed calls of every stage")
+    ap.add_argument("-o", "--output", required=False, default="benchmarks/results",
+        help="A string for the directory the JSON results are saved to")
+    ap.add_argument("-c", "--compare", required=False, default=None,
+        help="A string to a previous JSON result to compare against")
+    args = vars(ap.parse_args())
+
+    # set up configuration and initialize variables
+    config = ConfigParser()
+    config.read('config.ini')
+
+    predictor_path = config.get('Paths', 'HOG_predictor_path', fallback=None)
+    face_path = args['face']
+    if face_path is None and config.has_option('Paths', 'original_dir'):
+        image_dir = config['Paths']['original_dir']
+        image_names = sorted(os.listdir(image_dir)) if os.path.isdir(image_dir) else []
+        face_path = os.path.join(image_dir, image_names[0]) if image_names else None
+
+    results = run_benchmarks(args['resolutions'], predictor_path, face_path, args['repeats'])
+
+    # save the results keyed by commit so regressions can be compared between commits
+    commit = git_commit()
+    os.makedirs(args['output'], exist_ok=True)
+    output_path = os.path.join(args['output'], "{}.json".format(commit or 'unknown'))
+    with open(output_path, 'w') as fp:
+        json.dump({
+            'commit': commit,
+            'timestamp': datetime.now().isoformat(),
+            'results': results,
+        }, fp, indent=2)
+    print("Saved results to {}".format(output_path))
+
+    if args['compare']:
+        with open(args['compare']) as fp:
+            compare_results(results, json.load(fp)['results'])
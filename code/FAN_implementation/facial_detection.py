@@ -1,34 +1,182 @@
-
 # Standard library imports
 import os
 
 # Third party library imports
+import numpy as np
 import face_alignment
+import torch
+
+from PIL import Image
 
 # Local library imports
 
 
-# TO BE CONTINUED (need system that can use CUDA gpu)
-def FAN_implementation(byte_input):
-  # fa = face_alignment.FaceAlignment(face_alignment.LandmarksType._3D, device='cpu', verbose=True)
-  fa = face_alignment.FaceAlignment(face_alignment.LandmarksType._3D, device='cuda', verbose=True)
-  preds = fa.get_landmark_from_image(byte_input)
-  print(preds)
-  return preds
+class FANRunner:
+    """ A persistent FAN landmark network on the CPU. The model is loaded once and
+    the face regions of many images, found by a cheaper detector, are cropped to the
+    network input size and run through the network together.
+    """
+
+    # FAN expects the face centred in a 256 pixel crop and returns 64 pixel heatmaps
+    INPUT_SIZE = 256
+    HEATMAP_SIZE = 64
+
+    def __init__(self, device='cpu', num_threads=None, batch_size=8):
+        """ Loads the FAN model
+
+        :param device: A string with default 'cpu' for the torch device.
+        :param num_threads: An optional integer for the number of intra-op threads.
+        :param batch_size: An integer with default 8 for the faces per forward pass.
+        """
+
+        if num_threads:
+            torch.set_num_threads(num_threads)
+
+        # the landmark type enum was renamed in face_alignment 1.4
+        landmarks_type = getattr(face_alignment.LandmarksType, 'TWO_D', None) \
+            or getattr(face_alignment.LandmarksType, '_2D')
+        model = face_alignment.FaceAlignment(landmarks_type, device=device, flip_input=False)
+
+        self.net = model.face_alignment_net.eval()
+        self.device = device
+        self.batch_size = batch_size
+
+    def predict_batch(self, images, boxes):
+        """ Predicts the landmarks of the face boxes of a batch of images
+
+        :param images: A list of PIL objects of RGB images.
+        :param boxes: A list of (F, 4) arrays of the left, top, right, bottom face
+        boxes of every image.
+        :return: A list of (F, 68, 2) float arrays of landmarks, one per image.
+        """
+
+        # crop every face of every image into one flat list of network inputs
+        crops, regions, owners = [], [], []
+        for i, (PIL_img, img_boxes) in enumerate(zip(images, boxes)):
+            for box in np.asarray(img_boxes, dtype=float).reshape(-1, 4):
+                region = _face_region(box)
+                crops.append(np.asarray(PIL_img.crop(tuple(np.rint(region).astype(int)))
+                    .resize((self.INPUT_SIZE, self.INPUT_SIZE), Image.BILINEAR)))
+                regions.append(region)
+                owners.append(i)
+
+        points = np.empty((len(crops), 68, 2))
+        for start in range(0, len(crops), self.batch_size):
+            batch = np.stack(crops[start:start + self.batch_size]).transpose(0, 3, 1, 2)
+            tensor = torch.from_numpy(batch).float().div_(255.0).to(self.device)
+            with torch.no_grad():
+                heatmaps = self.net(tensor)
+            # older releases return the heatmaps of every hourglass stack as a list
+            if isinstance(heatmaps, (list, tuple)):
+                heatmaps = heatmaps[-1]
+            points[start:start + len(batch)] = _heatmap_peaks(heatmaps.cpu().numpy())
+
+        # map the heatmap coordinates back onto the full resolution images
+        regions = np.array(regions).reshape(-1, 4)
+        scale = (regions[:, 2] - regions[:, 0]) / self.HEATMAP_SIZE
+        points = points * scale[:, np.newaxis, np.newaxis] + regions[:, np.newaxis, :2]
+
+        owners = np.array(owners, dtype=int)
+        return [points[owners == i] for i in range(len(images))]
+
+    def predict_face_dicts(self, images, boxes):
+        """ Predicts the landmarks of a batch of images in the format returned by
+        facial_detection_PIL
+
+        :param images: A list of PIL objects of RGB images.
+        :param boxes: A list of (F, 4) arrays of the face boxes of every image.
+        :return: A list of dictionaries of facial detection coordinates, one per image.
+        """
+
+        face_dicts = []
+        for img_boxes, img_points in zip(boxes, self.predict_batch(images, boxes)):
+            face_dict = {}
+            for i, (box, points) in enumerate(zip(np.reshape(img_boxes, (-1, 4)), img_points)):
+                face_dict[i] = {
+                    'facial_coords': [int(v) for v in box],
+                    'facial_points': [tuple(p) for p in np.rint(points).astype(int).tolist()]
+                }
+            face_dicts.append(face_dict)
+
+        return face_dicts
+
+
+def _face_region(box):
+    """ Calculates the square region FAN expects around a face box, following the
+    centre shift and scale face_alignment uses for its own detections
+
+    :param box: A (4,) numpy array of the left, top, right, bottom face box.
+    :return: A (4,) numpy array of the left, top, right, bottom crop region.
+    """
+
+    left, top, right, bottom = box
+    centre_x = (left + right) / 2
+    centre_y = (top + bottom) / 2 - 0.12 * (bottom - top)
+    half = 100 * ((right - left) + (bottom - top)) / 195
+
+    return np.array([centre_x - half, centre_y - half, centre_x + half, centre_y + half])
+
+
+def _heatmap_peaks(heatmaps):
+    """ Finds the peak of every landmark heatmap, moved a quarter pixel towards its
+    higher neighbour as FAN does
+
+    :param heatmaps: A (B, 68, H, W) numpy array of landmark heatmaps.
+    :return: A (B, 68, 2) numpy array of x, y peaks in heatmap pixels.
+    """
+
+    batch, parts, height, width = heatmaps.shape
+    flat = heatmaps.reshape(batch, parts, -1)
+    peak = flat.argmax(axis=-1)
+    x, y = peak % width, peak // width
+
+    # neighbouring values clipped to the heatmap
+    b, p = np.indices((batch, parts))
+    dx = heatmaps[b, p, y, np.minimum(x + 1, width - 1)] \
+        - heatmaps[b, p, y, np.maximum(x - 1, 0)]
+    dy = heatmaps[b, p, np.minimum(y + 1, height - 1), x] \
+        - heatmaps[b, p, np.maximum(y - 1, 0), x]
+
+    return np.stack([x + 0.25 * np.sign(dx), y + 0.25 * np.sign(dy)], axis=-1) + 0.5
+
+
+# the runner shared by calls of FAN_implementation so the model is only loaded once
+_RUNNER = None
+
+
+def FAN_implementation(PIL_img, boxes):
+    """ Predicts the landmarks of the face boxes of one image with a shared CPU runner
+
+    :param PIL_img: A PIL object of an RGB image.
+    :param boxes: A (F, 4) array of the face boxes found by a cheaper detector.
+    :return: A dictionary of facial detection coordinates.
+    """
+
+    global _RUNNER
+    if _RUNNER is None:
+        _RUNNER = FANRunner()
+
+    return _RUNNER.predict_face_dicts([PIL_img], [boxes])[0]
 
 
 if __name__ == '__main__':
-  
-  # Standard library imports
-  from configparser import ConfigParser
 
-  # Local library imports
-  from heif_interpreter import *
+    # Standard library imports
+    from configparser import ConfigParser
+
+    # Local library imports, run from the repository root with
+    # python -m code.FAN_implementation.facial_detection
+    from code.input_interpreter import convert_to_PIL
+    from code.HOG_implementation.facial_detection import set_up, facial_detection_PIL
 
-  # setup configuration and initialize variables
-  config = ConfigParser()
-  config.read('../../config.ini')
+    # setup configuration and initialize variables
+    config = ConfigParser()
+    config.read('config.ini')
 
-  heif_file = config['Paths']['original_dir'] + 'IMG_7807.heic'
-  byte_input = convert_heif_to_bytes(heif_file)
+    heif_file = os.path.join(config['Paths']['original_dir'], 'IMG_7807.heic')
+    PIL_img = convert_to_PIL(heif_file).convert('RGB')
 
+    # refine the landmarks of the HOG detection with FAN
+    predictor, detector = set_up(config['Paths']['HOG_predictor_path'])
+    face_dict = facial_detection_PIL(PIL_img, predictor, detector, detect_scale=4)
+    print(FAN_implementation(PIL_img, [face_dict[0]['facial_coords']]))
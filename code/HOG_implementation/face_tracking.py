@@ -0,0 +1,138 @@
+
+# Standard library imports
+
+# Third party library imports
+import numpy as np
+import dlib
+
+# Local library imports
+from .facial_detection import facial_detection_PIL
+
+
+class FaceTracker:
+    """ Tracks a face across consecutive images by reusing the previous image's face
+    box as a prior. Detection first runs inside an expanded region of interest around
+    the previous box, which is far smaller than the full frame, and only falls back
+    to a full frame detection when the landmarks fitted there look implausible.
+    """
+
+    def __init__(self, predictor, detector, margin=0.5, min_spread=0.6, max_spread=1.4,
+            max_shift=0.25):
+        """ Initializes the tracker without a prior
+
+        :param predictor: A dlib object used for predicting facial landmarks.
+        :param detector: A dlib object used for detecting facial bounding box.
+        :param margin: A float for the fraction of the previous box size added on each
+        side to form the region of interest.
+        :param min_spread: A float for the smallest accepted ratio of the landmark extent
+        to the detected box size.
+        :param max_spread: A float for the largest accepted ratio of the landmark extent
+        to the detected box size.
+        :param max_shift: A float for the largest accepted distance between the landmark
+        centre and the box centre as a fraction of the box size.
+        """
+
+        self.predictor = predictor
+        self.detector = detector
+        self.margin = margin
+        self.min_spread = min_spread
+        self.max_spread = max_spread
+        self.max_shift = max_shift
+
+        self.prev_box = None
+        self.last_hit = False
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_rate(self):
+        """ The fraction of images where the fast path was used """
+
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def reset(self):
+        """ Forgets the previous face box so the next image runs a full detection """
+
+        self.prev_box = None
+
+    def detect(self, PIL_img, **detect_kwargs):
+        """ Detects the facial landmarks of the next image in the sequence
+
+        :param PIL_img: A PIL object of the input image.
+        :param detect_kwargs: Keyword arguments passed to facial_detection_PIL when
+        falling back to a full frame detection.
+        :return: A dictionary of facial detection coordinates.
+        """
+
+        face_dict = None
+        if self.prev_box is not None:
+            face_dict = self._track(np.array(PIL_img))
+
+        self.last_hit = face_dict is not None
+        if self.last_hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+            face_dict = facial_detection_PIL(
+                PIL_img, self.predictor, self.detector, **detect_kwargs
+            )
+
+        self.prev_box = face_dict[min(face_dict)]['facial_coords']
+        return face_dict
+
+    def _track(self, rgb_img):
+        """ Detects the face inside the region of interest around the previous box
+
+        :param rgb_img: A numpy array object containing RGB values of an image.
+        :return: A dictionary of facial detection coordinates or None if the fit failed.
+        """
+
+        # expand the previous box into a region of interest clipped to the image
+        left, top, right, bottom = self.prev_box
+        width, height = right - left, bottom - top
+        x0 = max(0, int(left - self.margin * width))
+        y0 = max(0, int(top - self.margin * height))
+        x1 = min(rgb_img.shape[1], int(right + self.margin * width))
+        y1 = min(rgb_img.shape[0], int(bottom + self.margin * height))
+
+        # the face fills most of the region so no upsampling is needed
+        dets = [
+            d for d in self.detector(rgb_img[y0:y1, x0:x1], 0)
+            if d.right() - d.left() > 200
+        ]
+        if len(dets) != 1:
+            return None
+        d = dets[0]
+        rect = dlib.rectangle(d.left() + x0, d.top() + y0, d.right() + x0, d.bottom() + y0)
+
+        # fit the landmarks at full resolution and check they are plausible
+        shape = self.predictor(rgb_img, rect)
+        facial_points = [(p.x, p.y) for p in shape.parts()]
+        if not self._fits(np.array(facial_points), rect):
+            return None
+
+        return {
+            0: {
+                'facial_coords': [rect.left(), rect.top(), rect.right(), rect.bottom()],
+                'facial_points': facial_points
+            }
+        }
+
+    def _fits(self, points, rect):
+        """ Checks the spread and centre of landmarks against their face box
+
+        :param points: A (68, 2) numpy array of landmark coordinates.
+        :param rect: A dlib rectangle of the face box.
+        :return: A boolean which is True if the landmarks fit the box.
+        """
+
+        box_size = np.array([rect.width(), rect.height()], dtype=float)
+        box_centre = np.array([rect.left(), rect.top()]) + box_size / 2
+        spread = (points.max(axis=0) - points.min(axis=0)) / box_size
+        shift = np.abs(points.mean(axis=0) - box_centre) / box_size
+
+        return bool(
+            np.all(spread >= self.min_spread) and np.all(spread <= self.max_spread)
+            and np.all(shift <= self.max_shift)
+        )
@@ -13,7 +13,9 @@ from PIL import ImageDraw
 from tqdm import tqdm
 
 # Local library imports
-from ..input_interpreter import convert_heif_to_PIL
+from ..input_interpreter import convert_heif_to_numpy
+from ..instrumentation import StageTimer
+from ..rendering import draw_points_PIL
 
 
 def batch_facial_detection(predictor_path, faces_path, draw_bool=False, 
@@ -88,10 +90,11 @@ def image_handler(file_path):
   # wrap to catch file errors
   try:
     if os.path.splitext(file_path)[1] == '.heic':
-      PIL_img = convert_heif_to_bytes(file_path)
+      img_rgb = convert_heif_to_numpy(file_path)
+      PIL_img = PIL.Image.fromarray(img_rgb)
     else:
       PIL_img = PIL.Image.open(file_path)
-    img_rgb = np.array(PIL_img)
+      img_rgb = np.array(PIL_img)
 
     return PIL_img, img_rgb
   except IOError as err:
@@ -130,31 +133,63 @@ def single_facial_detection(img_rgb, predictor, detector):
   return face_dict
 
 
-def facial_detection_PIL(PIL_img, predictor, detector):
+def facial_detection_PIL(PIL_img, predictor, detector, detect_scale=1, thumbnail=None,
+        upsample=None, timer=None):
     """ Applies facial detection to a PIL object and returns the coordinates
+
+    The face bounding box can be detected on a downscaled copy of the image, which
+    is far cheaper, and is then mapped back to full resolution where the landmarks
+    are predicted.
     
     :param PIL_img: A numpy array object containing RGB values of an image
     :param predictor: A dlib object used for predicting facial landmarks
     :param detector: A dlib object used for detecting facial bounding box
+    :param detect_scale: An integer with default 1 for the factor the image is reduced
+    by before detecting the face bounding box
+    :param thumbnail: An optional downscaled PIL object of the image to detect faces
+    on, such as a JPEG draft decode, instead of reducing PIL_img
+    :param upsample: An optional integer for the number of times dlib upsamples the
+    image while detecting, defaults to 1 at full resolution and 0 on a downscaled image
+    :param timer: An optional StageTimer which records the detect and predict stages
     :returnL: A dictionary of facial detection coordiantes
     """
 
     # initialize variables for facial detection
     face_dict = {}
     rgb_img = np.array(PIL_img)
+    timer = timer if timer is not None else StageTimer()
 
     # calculated the faces from the input image
-    dets = detector(rgb_img, 1)
+    if detect_scale == 1 and thumbnail is None:
+        with timer.stage('detect'):
+            dets = detector(rgb_img, 1 if upsample is None else upsample)
+    else:
+        with timer.stage('detect'):
+            if thumbnail is None:
+                thumbnail = PIL_img.reduce(detect_scale)
+            dets = detector(np.array(thumbnail), 0 if upsample is None else upsample)
+
+        # map the bounding boxes back onto the full resolution image
+        scale_x = PIL_img.width / thumbnail.width
+        scale_y = PIL_img.height / thumbnail.height
+        dets = [
+            dlib.rectangle(
+                int(round(d.left() * scale_x)), int(round(d.top() * scale_y)),
+                int(round(d.right() * scale_x)), int(round(d.bottom() * scale_y))
+            )
+            for d in dets
+        ]
 
     # Iterates through the detected faces
-    for i, d in enumerate(dets):
-        if d.right() - d.left() > 200:
-            shape = predictor(rgb_img, d)
-            p = shape.part
-            face_dict[i] = {
-                    'facial_coords': [d.left(), d.top(), d.right(), d.bottom()],
-                    'facial_points': [(p(i).x, p(i).y) for i in range(shape.num_parts)]
-            }
+    with timer.stage('predict'):
+        for i, d in enumerate(dets):
+            if d.right() - d.left() > 200:
+                shape = predictor(rgb_img, d)
+                p = shape.part
+                face_dict[i] = {
+                        'facial_coords': [d.left(), d.top(), d.right(), d.bottom()],
+                        'facial_points': [(p(i).x, p(i).y) for i in range(shape.num_parts)]
+                }
 
     if len(dets) != 1 and len(face_dict) > 1:
         raise ValueError("the latest image file has detected multiple faces")
@@ -204,14 +239,8 @@ def draw_facial_points(PIL_img, point_coords, width=3, radius=5):
   :param radius: An integer depicting the radius of circles drawn
   """
   
-  # iterate through all 68 tuples and draw them on the image
-  draw_obj = ImageDraw.Draw(PIL_img)
-  for x, y in point_coords:
-    draw_obj.ellipse(
-        xy=[x-radius, y-radius, x+radius, y+radius], 
-        fill='#00FF00', width=width
-    )
-  return PIL_img
+  # stamp a precomputed marker on all 68 points in a single draw call
+  return draw_points_PIL(PIL_img, point_coords, radius, fill='#00FF00')
 
 
 def draw_facial_coords_2(PIL_img, point_coords, width=3, box_size=2000):
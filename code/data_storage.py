@@ -1,36 +1,305 @@
 
 # Standard library imports
 import os
+import struct
 
-# Third party library imports 
+# Third party library imports
 import h5py
+import numpy as np
 
 # Local library imports
 
 
-def store_single_hdf5(dataset_path, np_img, attr_dict=None):
-    """ A helper function which facilitates saving image data and detected 
-    facial landmarks to HDF5 files.
-    
+class FrameStore:
+    """ An appendable HDF5 store of processed frames.
+
+    A single file handle is kept open for the lifetime of the store. Frames live in
+    one resizable, chunked uint8 dataset of shape (N, H, W, 3) and the landmarks, face
+    boxes, crop boxes and file names of every frame are kept in parallel datasets so
+    that they can be read back in bulk. Every file name is stored once, appending a
+    name which is already stored overwrites its frame in place.
+    """
+
+    def __init__(self, file_path, compression=None, mode='a'):
+        """ Opens (or creates) the HDF5 file backing the store
+
+        :param file_path: A string to the path of the HDF5 file.
+        :param compression: An optional string for the frame compression, either
+        'lzf' or 'gzip'.
+        :param mode: A string with default 'a' for the h5py file mode.
+        """
+
+        self.file_path = file_path
+        self.compression = compression
+        self._file = h5py.File(file_path, mode)
+        self._rows = {name: row for row, name in enumerate(self.names)}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return len(self._file['frames']) if 'frames' in self._file else 0
+
+    def __getitem__(self, index):
+        """ Reads frames with random access
+
+        :param index: An integer, slice or increasing list of frame indices.
+        :return: A numpy array of the selected frames.
+        """
+
+        return self._file['frames'][index]
+
+    def close(self):
+        """ Flushes and closes the underlying HDF5 file """
+
+        self._file.close()
+
+    @property
+    def names(self):
+        """ A list of the file names of the stored frames in order """
+
+        if 'names' not in self._file:
+            return []
+        return [name.decode() if isinstance(name, bytes) else name
+            for name in self._file['names'][:]]
+
+    @property
+    def landmarks(self):
+        """ The h5py dataset of (N, 68, 2) landmarks in original image coordinates """
+
+        return self._file['landmarks']
+
+    @property
+    def boxes(self):
+        """ The h5py dataset of (N, 4) face boxes in original image coordinates """
+
+        return self._file['boxes']
+
+    @property
+    def crop_boxes(self):
+        """ The h5py dataset of (N, 4) crop boxes used to cut out every frame """
+
+        return self._file['crop_boxes']
+
+    def append(self, frames, landmarks, boxes, crop_boxes, names):
+        """ Appends a batch of frames and their metadata to the store, overwriting the
+        frames of file names which are already stored so reruns do not duplicate them
+
+        :param frames: A (B, H, W, 3) numpy array of uint8 frames.
+        :param landmarks: A (B, 68, 2) numpy array of landmarks.
+        :param boxes: A (B, 4) numpy array of face boxes.
+        :param crop_boxes: A (B, 4) numpy array of crop boxes.
+        :param names: A list of B file names.
+        """
+
+        frames = np.asarray(frames, dtype=np.uint8)
+        columns = {
+            'frames': frames,
+            'landmarks': np.asarray(landmarks, dtype=np.int32),
+            'boxes': np.asarray(boxes, dtype=np.int32),
+            'crop_boxes': np.asarray(crop_boxes, dtype=np.float32),
+            'names': np.asarray(names, dtype=object),
+        }
+
+        # the datasets are only created once the frame size is known
+        if 'frames' not in self._file:
+            self._create_datasets(columns)
+        elif self._file['frames'].shape[1:] != frames.shape[1:]:
+            raise ValueError("frames of shape {} do not match the stored shape {}"
+                .format(frames.shape[1:], self._file['frames'].shape[1:]))
+
+        # rewrite the rows of stored names and append the others in order
+        new_rows = []
+        for i, name in enumerate(names):
+            if name in self._rows:
+                for key, values in columns.items():
+                    self._file[key][self._rows[name]] = values[i]
+            else:
+                new_rows.append(i)
+        if not new_rows:
+            return
+
+        start = len(self)
+        for key, values in columns.items():
+            dset = self._file[key]
+            dset.resize(start + len(new_rows), axis=0)
+            dset[start:] = values[new_rows]
+        for row, i in enumerate(new_rows, start):
+            self._rows[names[i]] = row
+
+    def append_frame(self, name, frame, face_dict, crop_box):
+        """ Appends a single frame and its facial detections to the store
+
+        :param name: A string for the file name of the frame.
+        :param frame: A HxWx3 numpy array of uint8 values.
+        :param face_dict: A dictionary of facial detections.
+        :param crop_box: A tuple of the left, top, right, bottom crop coordinates.
+        """
+
+        face = face_dict[min(face_dict)]
+        self.append(
+            frame[np.newaxis], [face['facial_points']], [face['facial_coords']],
+            [crop_box], [name]
+        )
+
+    def iter_frames(self, batch_size=16):
+        """ Yields the stored frames in order, reading a batch of chunks at a time
+
+        :param batch_size: An integer with default 16 for the frames read per batch.
+        :return: A generator of HxWx3 numpy arrays.
+        """
+
+        for start in range(0, len(self), batch_size):
+            for frame in self[start:start + batch_size]:
+                yield frame
+
+    def _create_datasets(self, columns):
+        """ Creates the resizable datasets based on the first batch of values
+
+        :param columns: A dictionary of dataset names to numpy arrays.
+        """
+
+        for key, values in columns.items():
+            is_frame = key == 'frames'
+            dtype = h5py.string_dtype() if key == 'names' else values.dtype
+            self._file.create_dataset(
+                key, shape=(0,) + values.shape[1:], maxshape=(None,) + values.shape[1:],
+                dtype=dtype, chunks=(1 if is_frame else 256,) + values.shape[1:],
+                compression=self.compression if is_frame else None
+            )
+
+
+class RawFrameCache:
+    """ A single file of raw uint8 frames which can be memory mapped back without
+    copying, so the same frames can be re-encoded at different frame rates without
+    decoding any image again.
+
+    The file starts with a small header holding a magic string and the frame count,
+    height and width, followed by the (N, H, W, 3) frames in C order. In append mode
+    new frames follow the frames of an existing file, so incremental runs extend the
+    cache instead of replacing it.
+    """
+
+    HEADER = struct.Struct('<8sQQQ')
+    MAGIC = b'EEFRAMES'
+
+    def __init__(self, file_path, mode='w'):
+        """ Creates (or opens) the cache file
+
+        :param file_path: A string to the path of the raw frame file.
+        :param mode: A string with default 'w' to truncate the file, or 'a' to append
+        to the frames of an existing file.
+        """
+
+        self.file_path = file_path
+        self.count, self.height, self.width = 0, None, None
+        if mode == 'a' and os.path.exists(file_path):
+            with open(file_path, 'rb') as f:
+                magic, count, height, width = self.HEADER.unpack(f.read(self.HEADER.size))
+            if magic != self.MAGIC:
+                raise ValueError("{!r} is not a raw frame cache".format(file_path))
+            if count:
+                self.count, self.height, self.width = count, height, width
+
+            # drop anything past the recorded frames, such as a frame cut short by a
+            # run which never closed the cache
+            end = self.HEADER.size + self.count * height * width * 3
+            self._file = open(file_path, 'r+b')
+            self._file.truncate(end)
+            self._file.seek(end)
+        elif mode in ('w', 'a'):
+            self._file = open(file_path, 'wb')
+            self._write_header()
+        else:
+            raise ValueError("unknown mode {!r}, expected 'w' or 'a'".format(mode))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def append(self, frame):
+        """ Appends a single frame to the end of the file
+
+        :param frame: A HxWx3 numpy array of uint8 values.
+        """
+
+        if self.height is None:
+            self.height, self.width = frame.shape[:2]
+        elif frame.shape != (self.height, self.width, 3):
+            raise ValueError("frame of shape {} does not match the cached shape {}"
+                .format(frame.shape, (self.height, self.width, 3)))
+
+        self._file.write(np.ascontiguousarray(frame, dtype=np.uint8).data)
+        self.count += 1
+
+    def close(self):
+        """ Records the final frame count in the header and closes the file """
+
+        self._write_header()
+        self._file.close()
+
+    def _write_header(self):
+        """ Writes the header to the start of the file keeping the write position """
+
+        position = self._file.tell()
+        self._file.seek(0)
+        self._file.write(self.HEADER.pack(
+            self.MAGIC, self.count, self.height or 0, self.width or 0
+        ))
+        self._file.seek(max(position, self.HEADER.size))
+
+
+def load_raw_frames(file_path):
+    """ Memory maps the frames of a RawFrameCache file without reading them
+
+    :param file_path: A string to the path of the raw frame file.
+    :return: A read only (N, H, W, 3) numpy memmap of uint8 values, or an empty array
+    when no frame was cached.
+    """
+
+    with open(file_path, 'rb') as f:
+        magic, count, height, width = RawFrameCache.HEADER.unpack(
+            f.read(RawFrameCache.HEADER.size)
+        )
+    if magic != RawFrameCache.MAGIC:
+        raise ValueError("{!r} is not a raw frame cache".format(file_path))
+
+    # an empty file region cannot be memory mapped
+    if count == 0:
+        return np.empty((0, height, width, 3), dtype=np.uint8)
+
+    return np.memmap(file_path, dtype=np.uint8, mode='r', offset=RawFrameCache.HEADER.size,
+        shape=(count, height, width, 3))
+
+
+def store_single_hdf5(dataset_path, np_img, attr_dict=None, file_path="face_data.h5"):
+    """ A helper function which facilitates saving image data and detected
+    facial landmarks to HDF5 files. For a sequence of frames use FrameStore which
+    keeps the file open and appends to a single dataset.
+
     :param dataset_path: A string to the path in the HDF5 file.
     :param np_img: A numpy array of integers representing an image file.
-    :attr_dict: An optional dictionary of attributes associated with the numpy 
+    :attr_dict: An optional dictionary of attributes associated with the numpy
     image. This can contain crop dimensions or facial landmarks.
+    :file_path: A string with default "face_data.h5" for the path of the HDF5 file.
     """
 
     # Interact with HDF5 file with context manager
-    with h5py.File("face_data.h5", 'a') as f:
+    with h5py.File(file_path, 'a') as f:
 
-        # Create a dataset in the file if it does not exist in the file
-        if dataset_path not in f:
-            dset = f.create_dataset(
-                dataset_path, np.shape(np_img), h5py.h5t.STD_U8BE, data=np_img
-            )
+        # Replace the dataset in the file if it already exists
+        if dataset_path in f:
+            del f[dataset_path]
+        dset = f.create_dataset(dataset_path, data=np.asarray(np_img, dtype=np.uint8))
 
         # Iterate through attribute dictionary and assign any new info
-        for key, value in attr_dict.items():
-            if key not in dset.attrs:
-                dset.attrs[key] = value
+        for key, value in (attr_dict or {}).items():
+            dset.attrs[key] = value
 
 
 if __name__ == "__main__":
@@ -39,7 +308,6 @@ if __name__ == "__main__":
 
     # Third party library imports
     import PIL
-    import numpy as np
 
     # Local library imports
     from input_interpreter import convert_to_PIL
@@ -54,4 +322,3 @@ if __name__ == "__main__":
     PIL_img = convert_to_PIL(original_fp)
 
     breakpoint()
-
@@ -0,0 +1,368 @@
+
+# Standard library imports
+import ast
+
+from abc import ABC, abstractmethod
+
+# Third party library imports
+import numpy as np
+import dlib
+
+from PIL import Image
+
+# the CNN backends are optional and only needed when they are selected
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+# Local library imports
+from .HOG_implementation.facial_detection import set_up
+
+try:
+    from .FAN_implementation.facial_detection import FANRunner
+except ImportError:
+    FANRunner = None
+
+
+# registered detector backends keyed by name
+DETECTORS = {}
+
+
+def register_detector(name):
+    """ A class decorator which adds a FaceDetector backend to the registry
+
+    :param name: A string for the name the backend is selected by.
+    :return: The decorator which registers the class.
+    """
+
+    def decorator(cls):
+        cls.name = name
+        DETECTORS[name] = cls
+        return cls
+
+    return decorator
+
+
+def get_detector(name, predictor_path, **options):
+    """ Creates a registered detector backend
+
+    :param name: A string for the name of the backend.
+    :param predictor_path: A string for a valid path to dlib predictor object.
+    :param options: Keyword arguments passed to the backend.
+    :return: A FaceDetector object.
+    """
+
+    if name not in DETECTORS:
+        raise ValueError("unknown detector backend {!r}, expected one of {}"
+            .format(name, sorted(DETECTORS)))
+
+    return DETECTORS[name](predictor_path, **options)
+
+
+def detector_options(config, name):
+    """ Reads the options of a detector backend from its [detector.<name>] section of
+    the configuration. Values are parsed as Python literals where possible.
+
+    :param config: A ConfigParser object of the configuration file.
+    :param name: A string for the name of the backend.
+    :return: A dictionary of keyword arguments for the backend.
+    """
+
+    section = 'detector.' + name
+    if not config.has_section(section):
+        return {}
+
+    options = {}
+    for key, value in config.items(section):
+        try:
+            options[key] = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            options[key] = value
+
+    return options
+
+
+class FaceDetector(ABC):
+    """ The interface every detector backend implements. A backend detects the faces
+    of a batch of images at once and returns their boxes and 68 point landmarks in full
+    resolution image coordinates, so backends can be swapped and compared on the same
+    inputs. The workers hand every backend the images of a whole chunk at once.
+    """
+
+    name = None
+
+    def __init__(self, predictor_path, min_face_size=200):
+        """ Stores the options shared by every backend
+
+        :param predictor_path: A string for a valid path to dlib predictor object.
+        :param min_face_size: An integer with default 200 for the smallest face width
+        in pixels which is kept.
+        """
+
+        self.predictor_path = predictor_path
+        self.min_face_size = min_face_size
+
+    @abstractmethod
+    def detect_batch(self, images):
+        """ Detects the faces of a batch of images
+
+        :param images: A list of PIL objects of RGB images.
+        :return: A list of (F, 4) int arrays of the left, top, right, bottom face boxes
+        and a list of (F, 68, 2) int arrays of landmarks, one of each per image.
+        """
+
+    def detect(self, PIL_img):
+        """ Detects the single face of an image in the format of facial_detection_PIL
+
+        :param PIL_img: A PIL object of an RGB image.
+        :return: A dictionary of facial detection coordinates.
+        """
+
+        boxes, landmarks = self.detect_batch([PIL_img])
+        return face_dict_from_arrays(boxes[0], landmarks[0])
+
+    def _keep(self, boxes):
+        """ Selects the boxes which are wide enough to be the subject's face
+
+        :param boxes: A (F, 4) numpy array of face boxes.
+        :return: A (F,) boolean numpy array.
+        """
+
+        return (boxes[:, 2] - boxes[:, 0]) > self.min_face_size
+
+
+def face_dict_from_arrays(boxes, landmarks):
+    """ Converts the boxes and landmarks of one image into the dictionary format of
+    facial_detection_PIL, raising the same errors when there is not exactly one face
+
+    :param boxes: A (F, 4) numpy array of face boxes.
+    :param landmarks: A (F, 68, 2) numpy array of landmarks.
+    :return: A dictionary of facial detection coordinates.
+    """
+
+    if len(boxes) > 1:
+        raise ValueError("the latest image file has detected multiple faces")
+    elif len(boxes) == 0:
+        raise IOError("the latest image has detected no faces :(")
+
+    return {
+        i: {
+            'facial_coords': [int(v) for v in box],
+            'facial_points': [
+                tuple(point) for point in np.asarray(points, dtype=int).tolist()
+            ]
+        }
+        for i, (box, points) in enumerate(zip(boxes, landmarks))
+    }
+
+
+def predict_landmarks(predictor, rgb_img, boxes):
+    """ Predicts the landmarks of every face box with a dlib shape predictor
+
+    :param predictor: A dlib object used for predicting facial landmarks.
+    :param rgb_img: A numpy array object containing RGB values of an image.
+    :param boxes: A (F, 4) numpy array of face boxes.
+    :return: A (F, 68, 2) int array of landmarks.
+    """
+
+    landmarks = np.empty((len(boxes), predictor.num_parts(), 2), dtype=np.int32)
+    for i, (left, top, right, bottom) in enumerate(np.asarray(boxes, dtype=int).tolist()):
+        shape = predictor(rgb_img, dlib.rectangle(left, top, right, bottom))
+        landmarks[i] = [(p.x, p.y) for p in shape.parts()]
+
+    return landmarks
+
+
+@register_detector('hog')
+class HOGDetector(FaceDetector):
+    """ The dlib HOG face detector followed by the dlib 68 point shape predictor """
+
+    def __init__(self, predictor_path, min_face_size=200, detect_scale=1, upsample=None):
+        """ Loads the dlib predictor and detector
+
+        :param predictor_path: A string for a valid path to dlib predictor object.
+        :param min_face_size: An integer with default 200 for the smallest face width
+        in pixels which is kept.
+        :param detect_scale: An integer with default 1 for the factor images are reduced
+        by before detecting the face boxes.
+        :param upsample: An optional integer for the number of times dlib upsamples the
+        image, defaults to 1 at full resolution and 0 on a reduced image.
+        """
+
+        super().__init__(predictor_path, min_face_size)
+        self.predictor, self.detector = set_up(predictor_path)
+        self.detect_scale = detect_scale
+        self.upsample = upsample
+
+    def detect_batch(self, images):
+        boxes = self.detect_boxes(images)
+        landmarks = [
+            predict_landmarks(self.predictor, np.asarray(PIL_img), img_boxes)
+            for PIL_img, img_boxes in zip(images, boxes)
+        ]
+
+        return boxes, landmarks
+
+    def detect_boxes(self, images):
+        """ Detects the face boxes of a batch of images without predicting landmarks
+
+        :param images: A list of PIL objects of RGB images.
+        :return: A list of (F, 4) int arrays of face boxes, one per image.
+        """
+
+        boxes = []
+        for PIL_img in images:
+            if self.detect_scale > 1:
+                dets = self.detector(np.array(PIL_img.reduce(self.detect_scale)),
+                    0 if self.upsample is None else self.upsample)
+            else:
+                dets = self.detector(np.array(PIL_img),
+                    1 if self.upsample is None else self.upsample)
+
+            # map the boxes back onto the full resolution image
+            img_boxes = np.array(
+                [[d.left(), d.top(), d.right(), d.bottom()] for d in dets], dtype=float
+            ).reshape(-1, 4) * self.detect_scale
+            boxes.append(np.rint(img_boxes[self._keep(img_boxes)]).astype(np.int32))
+
+        return boxes
+
+
+@register_detector('fan')
+class FANDetector(FaceDetector):
+    """ A cheap dlib HOG detection on a reduced image followed by the FAN landmark
+    network on the CPU as a higher accuracy refinement of the landmarks. The model is
+    loaded once and the faces of a whole batch run through the network together, so
+    the dlib predictor is not used.
+    """
+
+    def __init__(self, predictor_path, min_face_size=200, detect_scale=4, batch_size=8,
+            num_threads=None):
+        """ Loads the dlib detector and the FAN model
+
+        :param predictor_path: A string for a valid path to dlib predictor object.
+        :param min_face_size: An integer with default 200 for the smallest face width
+        in pixels which is kept.
+        :param detect_scale: An integer with default 4 for the factor images are reduced
+        by before detecting the face boxes.
+        :param batch_size: An integer with default 8 for the faces per forward pass.
+        :param num_threads: An optional integer for the number of torch CPU threads.
+        """
+
+        if FANRunner is None:
+            raise ImportError("the fan detector requires face_alignment and torch")
+
+        super().__init__(predictor_path, min_face_size)
+        self.box_detector = HOGDetector(predictor_path, min_face_size, detect_scale)
+        self.runner = FANRunner(num_threads=num_threads, batch_size=batch_size)
+
+    def detect_batch(self, images):
+        boxes = self.box_detector.detect_boxes(images)
+        landmarks = [
+            np.rint(points).astype(np.int32)
+            for points in self.runner.predict_batch(images, boxes)
+        ]
+
+        return boxes, landmarks
+
+
+@register_detector('onnx')
+class ONNXDetector(FaceDetector):
+    """ A lightweight CNN face detector run with ONNX Runtime on the CPU, such as the
+    Ultra-Light-Fast-Generic-Face-Detector (version-RFB-320), followed by the dlib 68
+    point shape predictor at full resolution.
+
+    The model is expected to take normalised (B, 3, H, W) images and return the
+    (B, N, 2) face scores and the (B, N, 4) corner boxes relative to the image size.
+    """
+
+    def __init__(self, predictor_path, model_path, min_face_size=200, input_size=(320, 240),
+            score_threshold=0.7, iou_threshold=0.3, num_threads=None):
+        """ Loads the ONNX model and the dlib predictor
+
+        :param predictor_path: A string for a valid path to dlib predictor object.
+        :param model_path: A string for the path of the ONNX face detection model.
+        :param min_face_size: An integer with default 200 for the smallest face width
+        in pixels which is kept.
+        :param input_size: A (width, height) tuple with default (320, 240) for the model
+        input size.
+        :param score_threshold: A float with default 0.7 for the lowest face score kept.
+        :param iou_threshold: A float with default 0.3 for the overlap above which boxes
+        are suppressed.
+        :param num_threads: An optional integer for the number of intra-op threads.
+        """
+
+        if onnxruntime is None:
+            raise ImportError("the onnx detector requires onnxruntime")
+
+        super().__init__(predictor_path, min_face_size)
+        self.predictor, _ = set_up(predictor_path)
+        self.input_size = tuple(input_size)
+        self.score_threshold = score_threshold
+        self.iou_threshold = iou_threshold
+
+        session_options = onnxruntime.SessionOptions()
+        if num_threads:
+            session_options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(
+            model_path, session_options, providers=['CPUExecutionProvider']
+        )
+        self.input_name = self.session.get_inputs()[0].name
+
+        # models exported with a fixed batch dimension are run one image at a time
+        batch_dim = self.session.get_inputs()[0].shape[0]
+        self.batch_size = batch_dim if isinstance(batch_dim, int) else None
+
+    def detect_batch(self, images):
+        # resize and normalise every image into one (B, 3, H, W) tensor
+        tensor = np.stack([
+            np.asarray(PIL_img.resize(self.input_size, Image.BILINEAR), dtype=np.float32)
+            for PIL_img in images
+        ])
+        tensor = ((tensor - 127.0) / 128.0).transpose(0, 3, 1, 2)
+
+        step = self.batch_size or len(images)
+        scores, rel_boxes = [], []
+        for start in range(0, len(images), step):
+            batch_scores, batch_boxes = self.session.run(
+                None, {self.input_name: tensor[start:start + step]}
+            )
+            scores.extend(batch_scores[..., 1])
+            rel_boxes.extend(batch_boxes)
+
+        boxes, landmarks = [], []
+        for PIL_img, img_scores, img_boxes in zip(images, scores, rel_boxes):
+            keep = img_scores > self.score_threshold
+            img_boxes = img_boxes[keep] * np.array(PIL_img.size * 2, dtype=np.float32)
+            img_boxes = img_boxes[_nms(img_boxes, img_scores[keep], self.iou_threshold)]
+            img_boxes = np.rint(img_boxes[self._keep(img_boxes)]).astype(np.int32)
+
+            boxes.append(img_boxes)
+            landmarks.append(predict_landmarks(self.predictor, np.asarray(PIL_img), img_boxes))
+
+        return boxes, landmarks
+
+
+def _nms(boxes, scores, iou_threshold):
+    """ Greedy non-maximum suppression of overlapping boxes
+
+    :param boxes: A (N, 4) numpy array of the left, top, right, bottom boxes.
+    :param scores: A (N,) numpy array of box scores.
+    :param iou_threshold: A float for the overlap above which a box is suppressed.
+    :return: A list of the indices of the kept boxes in descending score order.
+    """
+
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    order = np.argsort(scores)[::-1]
+    keep = []
+    while order.size:
+        i = order[0]
+        keep.append(i)
+        lt = np.maximum(boxes[i, :2], boxes[order[1:], :2])
+        rb = np.minimum(boxes[i, 2:], boxes[order[1:], 2:])
+        overlap = np.prod(np.clip(rb - lt, 0, None), axis=1)
+        iou = overlap / (areas[i] + areas[order[1:]] - overlap)
+        order = order[1:][iou <= iou_threshold]
+
+    return keep
@@ -1,36 +1,111 @@
 
 # Standard library imports
 import glob
+import itertools
 import os
+import shutil
+import tempfile
+
+from concurrent.futures import ThreadPoolExecutor
 
 # Third party library imports
 import ffmpeg
-import numpy
+import numpy as np
 import glob
-import PIL
+import PIL.Image
+import PIL.ImageColor
 
 from tqdm import tqdm
 
 
-def write_jpegs_to_video(jpeg_photo_dir, video_name='video', frame_rate=5):
+# resampling filters which can be picked for the crop and align stages by name
+RESAMPLE_FILTERS = {
+    'nearest': PIL.Image.NEAREST,
+    'box': PIL.Image.BOX,
+    'bilinear': PIL.Image.BILINEAR,
+    'hamming': PIL.Image.HAMMING,
+    'bicubic': PIL.Image.BICUBIC,
+    'lanczos': PIL.Image.LANCZOS,
+}
+
+# frames are padded with this colour wherever the crop box or aligned frame extends
+# past the edge of the image
+PAD_COLOUR = 'black'
+
+# large reductions are first reduced by an integer factor down to this multiple of
+# the output size, which is close to indistinguishable from a full resample
+REDUCING_GAP = 3.0
+
+# software x264 settings which behave the same on any machine. speed trades the
+# encode time against the file size at a similar quality, crf sets the quality (lower
+# is better) and tune adapts the encoder to the content.
+ENCODER_PRESETS = {
+    'draft': {'vcodec': 'libx264', 'preset': 'ultrafast', 'crf': 28},
+    'fast': {'vcodec': 'libx264', 'preset': 'veryfast', 'crf': 23},
+    'balanced': {'vcodec': 'libx264', 'preset': 'medium', 'crf': 20},
+    'quality': {'vcodec': 'libx264', 'preset': 'slow', 'crf': 18, 'tune': 'film'},
+    'archive': {'vcodec': 'libx264', 'preset': 'veryslow', 'crf': 16, 'tune': 'film'},
+}
+
+
+def encoder_options(encoder=None, vcodec='libx264', threads=None):
+    """ Builds the ffmpeg output options of the video encoder
+
+    :param encoder: An optional preset name of ENCODER_PRESETS or a dictionary of
+    ffmpeg output options, the encoder defaults of vcodec are used without it.
+    :param vcodec: A string representing the codec used without an encoder.
+    :param threads: An optional integer for the number of encoder threads.
+    :return: A dictionary of ffmpeg output options.
+    """
+
+    if encoder is None:
+        options = {'vcodec': vcodec}
+    elif isinstance(encoder, dict):
+        options = dict(encoder)
+    elif encoder in ENCODER_PRESETS:
+        options = dict(ENCODER_PRESETS[encoder])
+    else:
+        raise ValueError("unknown encoder preset {!r}, expected one of {}"
+            .format(encoder, sorted(ENCODER_PRESETS)))
+
+    options.setdefault('pix_fmt', 'yuv420p')
+    if threads is not None:
+        options['threads'] = threads
+
+    return options
+
+
+def write_jpegs_to_video(jpeg_photo_dir, video_name='video', frame_rate=5, encoder=None,
+        segments=1):
     """ Compiles videos from a directory of .jpeg files
   
     :param jpeg_photo_dir: A string referencing a valid directory containing 
     .jpeg images.
     :param video_name: A string that'll become the name of the .mp4 file.
     :param frame_rate: An integer to depict the number of image frames per second.
+    :param encoder: An optional preset name of ENCODER_PRESETS or a dictionary of
+    ffmpeg output options, ffmpeg picks its defaults without it.
+    :param segments: An integer with default 1 for the number of segments encoded in
+    parallel, see write_jpeg_list_to_video_parallel.
     :return: A string to the output video
     """
   
     # wrap to catch file errors
     try:
         video_path = '{}.mp4'.format(video_name) if '.mp4' not in video_name else video_name
-    
+
+        # the glob pattern of ffmpeg orders the files by name as well
+        if segments > 1:
+            jpeg_paths = sorted(glob.glob(os.path.join(jpeg_photo_dir, '*.jpeg')))
+            return write_jpeg_list_to_video_parallel(
+                jpeg_paths, video_path, frame_rate, encoder=encoder, segments=segments
+            )
+
         # grab all existing .jpeg files in provided directory and compile to video
         (
             ffmpeg
             .input(os.path.join(jpeg_photo_dir, '*.jpeg'), pattern_type='glob', framerate=frame_rate)
-            .output(video_path)
+            .output(video_path, **(encoder_options(encoder) if encoder else {}))
             .run()
         )
         return video_path 
@@ -38,41 +113,262 @@ def write_jpegs_to_video(jpeg_photo_dir, video_name='video', frame_rate=5):
         print(err)
 
 
-def write_numpy_to_video(video_path, img_array, frame_rate=60, vcodec='libx264'):
-    """ Compiles video from a numpy array of images
+def write_numpy_to_video(video_path, img_array, frame_rate=60, vcodec='libx264', size=None,
+        encoder=None):
+    """ Compiles video from a sequence of numpy images. Frames are written to the
+    ffmpeg pipe one at a time as they arrive, so any iterable or generator can be
+    passed in without holding the whole video in memory.
 
     :param video_path: A string for the saved video path.
-    :param img_array: A n-d numpy array of integers.
+    :param img_array: An iterable of HxWx3 numpy arrays of integers, such as a n-d
+    numpy array or a generator of frames.
     :param frame_rate: An integer to represent the number of image frames per second.
     :param vcodec: A string representing the codec for the video output.
+    :param size: An optional (width, height) tuple to resize the video to in ffmpeg.
+    :param encoder: An optional preset name of ENCODER_PRESETS or a dictionary of
+    ffmpeg output options which replaces vcodec.
     :return: A string to the output video
     """
 
+    # the video size is only known once the first frame has arrived
+    frames = iter(img_array)
+    first_frame = next(frames, None)
+    if first_frame is None:
+        raise ValueError("{!r} has no frames to encode".format(video_path))
+    frame_shape = first_frame.shape
+    process = _open_rawvideo_pipe(
+        video_path, frame_shape[1], frame_shape[0], frame_rate, vcodec, size, encoder
+    )
+
     try:
-        if not isinstance(img_array, np.ndarray):
-            img_array = np.asarray(img_array)
-        n, height, width, channels = img_array.shape
-        process = (
-            ffmpeg
-                #.input('pipe:', format='rawvideo', pix_fmt='rgb24', s='{}x{}'.format(width, height))
-                .input('pipe:', format='rawvideo', pix_fmt='rgb24', s='{}x{}'.format(width, height))
-                #.output(video_name, pix_fmt='yuv420p', vcodec=vcodec, r=framerate)
-                .output(video_path, pix_fmt='yuv420p', r=frame_rate)
-                .overwrite_output()
-                .run_async(pipe_stdin=True)
-        )
-        for frame in img_array:
-            process.stdin.write(
-                frame
-                    .astype(np.uint8)
-                    .tobytes()
-            )
+        for frame in itertools.chain([first_frame], frames):
+            if frame.shape != frame_shape:
+                raise ValueError("frame of shape {} does not match the video shape {}"
+                    .format(frame.shape, frame_shape))
+
+            # only copy the frame when it is not already contiguous uint8 data
+            if frame.dtype != np.uint8:
+                frame = frame.astype(np.uint8)
+            process.stdin.write(np.ascontiguousarray(frame).data)
+    except BrokenPipeError:
+        # ffmpeg stopped reading early, its return code below reports the failure
+        pass
+    except Exception:
+        process.kill()
+        raise
+    finally:
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+        process.wait()
+
+    if process.returncode != 0:
+        raise ffmpeg.Error('ffmpeg', None, None)
+
+    return video_path
+
+
+def write_frame_queue_to_video(video_path, frame_queue, frame_rate=60, vcodec='libx264',
+        size=None, encoder=None):
+    """ Compiles video from frames arriving on a queue, piping each one to ffmpeg as
+    soon as it is available. This is meant to run on its own thread while the frames
+    are still being produced. A None item on the queue marks the end of the video.
+
+    :param video_path: A string for the saved video path.
+    :param frame_queue: A queue.Queue of HxWx3 numpy arrays of integers.
+    :param frame_rate: An integer to represent the number of image frames per second.
+    :param vcodec: A string representing the codec for the video output.
+    :param size: An optional (width, height) tuple to resize the video to in ffmpeg.
+    :param encoder: An optional preset name of ENCODER_PRESETS or a dictionary of
+    ffmpeg output options which replaces vcodec.
+    :return: A string to the output video
+    """
+
+    frames = _queued_frames(frame_queue)
+    try:
+        return write_numpy_to_video(video_path, frames, frame_rate, vcodec, size, encoder)
+    finally:
+        # if encoding stopped early keep draining so the producer never blocks
+        for _ in frames:
+            pass
+
+
+def _queued_frames(frame_queue):
+    """ Yields the frames of a queue until the None which ends the video. The end is
+    checked by identity, comparing a numpy frame with None is elementwise.
+
+    :param frame_queue: A queue.Queue of HxWx3 numpy arrays ending with None.
+    :return: A generator of the frames.
+    """
+
+    while True:
+        frame = frame_queue.get()
+        if frame is None:
+            return
+        yield frame
+
+
+def _open_rawvideo_pipe(video_path, width, height, frame_rate, vcodec='libx264', size=None,
+        encoder=None):
+    """ Starts an ffmpeg process which encodes raw RGB frames written to its stdin
+
+    :param video_path: A string for the saved video path.
+    :param width: An integer for the width of the frames.
+    :param height: An integer for the height of the frames.
+    :param frame_rate: An integer to represent the number of image frames per second.
+    :param vcodec: A string representing the codec for the video output.
+    :param size: An optional (width, height) tuple to resize the video to in ffmpeg.
+    :param encoder: An optional preset name of ENCODER_PRESETS or a dictionary of
+    ffmpeg output options which replaces vcodec.
+    :return: A subprocess.Popen object of the running ffmpeg process.
+    """
+
+    stream = ffmpeg.input(
+        'pipe:', format='rawvideo', pix_fmt='rgb24', s='{}x{}'.format(width, height),
+        framerate=frame_rate
+    )
+    if size is not None:
+        stream = stream.filter('scale', size[0], size[1], flags='lanczos')
+
+    return (
+        stream
+            .output(video_path, r=frame_rate, **encoder_options(encoder, vcodec))
+            .overwrite_output()
+            .run_async(pipe_stdin=True)
+    )
+
+
+def write_jpeg_list_to_video(jpeg_paths, video_path, frame_rate=5, vcodec='libx264',
+        encoder=None, threads=None):
+    """ Compiles video from an ordered list of .jpeg files. The encoded bytes are
+    piped straight to ffmpeg so only the given files end up in the video.
+
+    :param jpeg_paths: A list of strings to valid .jpeg images.
+    :param video_path: A string for the saved video path.
+    :param frame_rate: An integer to represent the number of image frames per second.
+    :param vcodec: A string representing the codec for the video output.
+    :param encoder: An optional preset name of ENCODER_PRESETS or a dictionary of
+    ffmpeg output options which replaces vcodec.
+    :param threads: An optional integer for the number of encoder threads.
+    :return: A string to the output video
+    :raises ffmpeg.Error: If ffmpeg fails, so a broken video is never mistaken for a
+    complete one.
+    """
+
+    process = (
+        ffmpeg
+            .input('pipe:', format='image2pipe', vcodec='mjpeg', framerate=frame_rate)
+            .output(video_path, r=frame_rate, **encoder_options(encoder, vcodec, threads))
+            .overwrite_output()
+            .run_async(pipe_stdin=True)
+    )
+    try:
+        for jpeg_path in jpeg_paths:
+            with open(jpeg_path, 'rb') as f:
+                process.stdin.write(f.read())
         process.stdin.close()
+    except BrokenPipeError:
+        # ffmpeg stopped reading early, its return code below reports the failure
+        pass
+    except Exception:
+        process.kill()
+        raise
+    finally:
         process.wait()
 
+    if process.returncode != 0:
+        raise ffmpeg.Error('ffmpeg', None, None)
+
+    return video_path
+
+
+def write_jpeg_list_to_video_parallel(jpeg_paths, video_path, frame_rate=5,
+        vcodec='libx264', encoder=None, segments=4, threads=None):
+    """ Compiles video from an ordered list of .jpeg files by splitting the frames into
+    contiguous segments, encoding the segments in parallel ffmpeg processes and then
+    losslessly joining them with concat_videos. Every segment starts on a key frame,
+    which costs a little file size for each extra segment.
+
+    :param jpeg_paths: A list of strings to valid .jpeg images.
+    :param video_path: A string for the saved video path.
+    :param frame_rate: An integer to represent the number of image frames per second.
+    :param vcodec: A string representing the codec for the video output.
+    :param encoder: An optional preset name of ENCODER_PRESETS or a dictionary of
+    ffmpeg output options which replaces vcodec.
+    :param segments: An integer with default 4 for the number of parallel encoders.
+    :param threads: An optional integer for the threads of every encoder, the CPUs are
+    shared out between the encoders without it.
+    :return: A string to the output video
+    """
+
+    if not jpeg_paths:
+        raise ValueError("{!r} has no frames to encode".format(video_path))
+    segments = max(1, min(segments, len(jpeg_paths)))
+    if threads is None:
+        threads = max(1, (os.cpu_count() or 1) // segments)
+
+    # split the frames into contiguous runs of near equal length
+    bounds = [round(i * len(jpeg_paths) / segments) for i in range(segments + 1)]
+    chunks = [jpeg_paths[start:end] for start, end in zip(bounds, bounds[1:])]
+
+    # the segments are written next to the output so they share its file system
+    segment_dir = tempfile.mkdtemp(
+        prefix='.segments_', dir=os.path.dirname(os.path.abspath(video_path))
+    )
+    try:
+        extension = os.path.splitext(video_path)[1]
+        segment_paths = [
+            os.path.join(segment_dir, 'segment_{:05d}{}'.format(i, extension))
+            for i in range(len(chunks))
+        ]
+
+        # the threads only wait on the ffmpeg processes which do the encoding
+        with ThreadPoolExecutor(max_workers=len(chunks)) as pool:
+            list(pool.map(
+                lambda args: write_jpeg_list_to_video(
+                    args[0], args[1], frame_rate, vcodec, encoder, threads
+                ), zip(chunks, segment_paths)
+            ))
+
+        return concat_videos(segment_paths, video_path)
+    finally:
+        shutil.rmtree(segment_dir, ignore_errors=True)
+
+
+def concat_videos(segment_paths, video_path):
+    """ Losslessly joins videos which share the same encoding settings using the
+    ffmpeg concat demuxer, so none of the segments are re-encoded.
+
+    :param segment_paths: A list of strings to valid video segments in play order.
+    :param video_path: A string for the saved video path.
+    :return: A string to the output video
+    :raises ffmpeg.Error: If ffmpeg fails, in which case video_path is left untouched.
+    """
+
+    # the concat demuxer reads its inputs from a list file next to the output
+    list_path = '{}.segments.txt'.format(video_path)
+    tmp_path = '{}.tmp{}'.format(*os.path.splitext(video_path))
+    try:
+        with open(list_path, 'w') as f:
+            for segment_path in segment_paths:
+                escaped = os.path.abspath(segment_path).replace("'", "'\\''")
+                f.write("file '{}'\n".format(escaped))
+
+        (
+            ffmpeg
+            .input(list_path, format='concat', safe=0)
+            .output(tmp_path, c='copy')
+            .overwrite_output()
+            .run()
+        )
+        os.replace(tmp_path, video_path)
+
         return video_path
-    except IOError as err:
-        print(err)
+    finally:
+        for path in (list_path, tmp_path):
+            if os.path.exists(path):
+                os.remove(path)
 
 
 def jpeg_crop_images(jpeg_faces_path, faces_dict):
@@ -103,13 +399,17 @@ def jpeg_crop_images(jpeg_faces_path, faces_dict):
       print(err)
 
 
-def crop_image(image, face_dict, box_size=2000):
+def crop_image(image, face_dict, box_size=2000, output_size=None,
+    resample=PIL.Image.BICUBIC):
   """ Crops a PIL object based on facial landmarks detected from the image
 
   :param image: A PIL object of an image.
   :param face_dict: A dictionary of facial landmarks detected from an image.
   :param box_size: An integer depicting the size of the bounding box around
   the facial landmarks.
+  :param output_size: An optional (width, height) tuple the crop is resized to
+  in the same resample.
+  :param resample: A PIL resampling filter with default bicubic.
   """
 
   # calculate a bounding box based on the facial landmark detected on the top
@@ -120,8 +420,10 @@ def crop_image(image, face_dict, box_size=2000):
     point[0] + 0.50 * box_size, point[1] + 0.65 * box_size
   )
 
-  # with the given coordinates crop the image
-  image = image.crop(coords)
+  # with the given coordinates crop (and resize) the image
+  if output_size is not None:
+    return crop_resize_PIL(image, coords, output_size, resample)
+  image = crop_pad_PIL(image, coords)
   return image
 
 
@@ -158,31 +460,291 @@ def crop_image_from_file(file_path, face_dict, box_size=2000):
         print(err)
 
 
-def crop_image_from_PIL(PIL_img, face_dict, box_size=2000):
+def crop_image_from_PIL(PIL_img, face_dict, box_size=2000, output_size=None,
+        resample=PIL.Image.BICUBIC):
     """ Crops an image from the given PIL object based on facial landmarks. This
     function also saves the cropped image to the input file path.
 
     :param PIL_img: A PIL object of a valid image
     :param face_dict: A dict containing the detected facial coordinates
     :box_size: An integer depicting the size of the cropped image
+    :param output_size: An optional (width, height) tuple the crop is resized to in
+    the same resample, instead of keeping the size of the crop box
+    :param resample: A PIL resampling filter with default bicubic
 
     :return: A PIL object of the input file
     """
 
     # wrap to catch file errors
     try:
-        x_coord, y_coord = face_dict[0]['facial_points'][27]
-        coords = (
-            x_coord - 0.50 * box_size, y_coord - 0.65 * box_size,
-            x_coord + 0.50 * box_size, y_coord + 0.65 * box_size
-        )
-        PIL_img = PIL_img.crop(coords)
+        box = crop_box_from_face(face_dict, box_size)
+        if output_size is not None:
+            return crop_resize_PIL(PIL_img, box, output_size, resample)
+        PIL_img = crop_pad_PIL(PIL_img, box)
 
         return PIL_img
     except IOError as err:
         print(err)
 
 
+def crop_resize_PIL(PIL_img, box, output_size, resample=PIL.Image.BICUBIC,
+        reducing_gap=REDUCING_GAP):
+    """ Crops a box out of an image and resizes it to the output size in a single
+    resample. The parts of the box outside of the image are filled with PAD_COLOUR, as
+    crop_pad_PIL and align_image_from_PIL do.
+
+    :param PIL_img: A PIL object of a valid image
+    :param box: A tuple of the left, top, right, bottom crop coordinates
+    :param output_size: A (width, height) tuple of the output frame
+    :param resample: A PIL resampling filter with default bicubic
+    :param reducing_gap: An optional float with default REDUCING_GAP. Large reductions
+    first reduce the box by an integer factor with Image.reduce so that the resampling
+    filter runs on at most reducing_gap times the output size, None disables this.
+
+    :return: A PIL object of the output frame
+    """
+
+    left, top, right, bottom = box
+    width, height = output_size
+    if left >= 0 and top >= 0 and right <= PIL_img.width and bottom <= PIL_img.height:
+        return PIL_img.resize(
+            (width, height), resample, box=(left, top, right, bottom),
+            reducing_gap=reducing_gap
+        )
+
+    # only the part of the box inside the image is resampled onto a padded frame
+    frame = PIL.Image.new(PIL_img.mode, (width, height), _pad_colour(PIL_img.mode))
+    inside = (
+        max(left, 0), max(top, 0), min(right, PIL_img.width), min(bottom, PIL_img.height)
+    )
+    scale_x, scale_y = width / (right - left), height / (bottom - top)
+    dest = (
+        int(round((inside[0] - left) * scale_x)), int(round((inside[1] - top) * scale_y)),
+        int(round((inside[2] - left) * scale_x)), int(round((inside[3] - top) * scale_y))
+    )
+    if dest[2] > dest[0] and dest[3] > dest[1]:
+        frame.paste(PIL_img.resize(
+            (dest[2] - dest[0], dest[3] - dest[1]), resample, box=inside,
+            reducing_gap=reducing_gap
+        ), dest[:2])
+
+    return frame
+
+
+def crop_pad_PIL(PIL_img, box):
+    """ Crops a box out of an image keeping the size of the box. The parts of the box
+    outside of the image are filled with PAD_COLOUR instead of the black of
+    PIL_img.crop.
+
+    :param PIL_img: A PIL object of a valid image
+    :param box: A tuple of the left, top, right, bottom crop coordinates
+
+    :return: A PIL object of the cropped image
+    """
+
+    # the box is rounded the same way PIL_img.crop rounds it
+    left, top, right, bottom = (int(round(v)) for v in box)
+    if left >= 0 and top >= 0 and right <= PIL_img.width and bottom <= PIL_img.height:
+        return PIL_img.crop((left, top, right, bottom))
+
+    frame = PIL.Image.new(
+        PIL_img.mode, (right - left, bottom - top), _pad_colour(PIL_img.mode)
+    )
+    frame.paste(PIL_img, (-left, -top))
+    return frame
+
+
+def _pad_colour(mode):
+    """ Expresses PAD_COLOUR in the bands of an image mode
+
+    :param mode: A string of a PIL image mode.
+    :return: A colour value accepted by PIL for the mode.
+    """
+
+    return PIL.ImageColor.getcolor(PAD_COLOUR, mode)
+
+
+def crop_box_from_face(face_dict, box_size=2000):
+    """ Calculates the box crop_image_from_PIL cuts out around the top of the bridge
+    of the nose
+
+    :param face_dict: A dict containing the detected facial coordinates
+    :box_size: An integer depicting the size of the cropped image
+
+    :return: A tuple of the left, top, right, bottom crop coordinates
+    """
+
+    x_coord, y_coord = face_dict[0]['facial_points'][27]
+    return (
+        x_coord - 0.50 * box_size, y_coord - 0.65 * box_size,
+        x_coord + 0.50 * box_size, y_coord + 0.65 * box_size
+    )
+
+
+def crop_size(box_size=2000):
+    """ Calculates the size of the frames cut out by crop_image_from_PIL
+
+    :box_size: An integer depicting the size of the cropped image
+
+    :return: A (width, height) tuple of the cropped frame
+    """
+
+    return box_size, int(round(1.3 * box_size))
+
+
+# canonical positions of the centre of the left eye, the centre of the right eye and
+# the tip of the nose as fractions of the output width and height. These match the
+# framing crop_image_from_PIL gives a typical selfie around the bridge of the nose.
+ALIGNMENT_TEMPLATE = np.array([[0.42, 0.505], [0.58, 0.505], [0.50, 0.59]])
+
+
+def alignment_anchors(points):
+    """ Extracts the eye centres and nose tip used for alignment from landmarks
+
+    :param points: A (N, 68, 2) numpy array of facial landmarks.
+    :return: A (N, 3, 2) numpy array of the left eye, right eye and nose tip.
+    """
+
+    points = np.asarray(points, dtype=np.float64)
+    return np.stack(
+        [points[:, 36:42].mean(axis=1), points[:, 42:48].mean(axis=1), points[:, 30]],
+        axis=1
+    )
+
+
+def similarity_transforms(points, output_size, template=ALIGNMENT_TEMPLATE):
+    """ Fits a similarity transform (scale, rotation and translation) from a canonical
+    template to the eyes and nose of every frame at once. The least squares fit is
+    solved in closed form using complex numbers so the whole sequence is handled in a
+    single vectorized pass.
+
+    :param points: A (N, 68, 2) numpy array of facial landmarks.
+    :param output_size: A (width, height) tuple of the aligned output frames.
+    :param template: A (3, 2) numpy array of the anchor positions as fractions of
+    the output size.
+    :return: A (N, 2, 3) numpy array of affine matrices which map output pixel
+    coordinates to input pixel coordinates, as expected by Image.transform.
+    """
+
+    anchors = alignment_anchors(points)
+    source = np.asarray(template, dtype=np.float64) * np.asarray(output_size)
+
+    return fit_similarity(source, anchors)
+
+
+def fit_similarity(source, targets, weights=None):
+    """ Fits the weighted least squares similarity transform from a set of source
+    points onto the corresponding points of every frame at once. The fit is solved in
+    closed form using complex numbers.
+
+    :param source: A (K, 2) numpy array of points in output pixel coordinates.
+    :param targets: A (N, K, 2) numpy array of the corresponding input points.
+    :param weights: An optional (N, K) numpy array of point weights, all points weigh
+    the same without it.
+    :return: A (N, 2, 3) numpy array of affine matrices which map output pixel
+    coordinates to input pixel coordinates.
+    """
+
+    source = np.asarray(source, dtype=np.float64)
+    targets = np.asarray(targets, dtype=np.float64)
+    if weights is None:
+        weights = np.ones(targets.shape[:2])
+    weights = weights / weights.sum(axis=1, keepdims=True)
+
+    # centre both point sets and express them as complex numbers x + iy
+    source_mean = weights @ source
+    targets_mean = (weights[..., np.newaxis] * targets).sum(axis=1)
+    w = (source[np.newaxis] - source_mean[:, np.newaxis]) @ np.array([1, 1j])
+    z = (targets - targets_mean[:, np.newaxis]) @ np.array([1, 1j])
+
+    # z = a * w + b where a encodes the scale and rotation and b the translation
+    a = (weights * z * np.conj(w)).sum(axis=1) / (weights * np.abs(w) ** 2).sum(axis=1)
+    b = targets_mean @ np.array([1, 1j]) - a * (source_mean @ np.array([1, 1j]))
+
+    return np.stack([
+        np.stack([a.real, -a.imag, b.real], axis=1),
+        np.stack([a.imag, a.real, b.imag], axis=1),
+    ], axis=1)
+
+
+def transform_bounds(transform, output_size):
+    """ Calculates the box of the input image covered by an aligned output frame
+
+    :param transform: A (2, 3) numpy array mapping output to input coordinates.
+    :param output_size: A (width, height) tuple of the aligned output frame.
+    :return: A tuple of the left, top, right, bottom input coordinates.
+    """
+
+    width, height = output_size
+    corners = np.array([[0, 0, 1], [width, 0, 1], [0, height, 1], [width, height, 1]])
+    mapped = corners @ np.asarray(transform).T
+    return tuple(mapped.min(axis=0)) + tuple(mapped.max(axis=0))
+
+
+def resize_transform(transform, output_size, new_size):
+    """ Adapts an alignment transform fitted for one output size to another, so the
+    same face framing can be rendered at a different resolution
+
+    :param transform: A (2, 3) numpy array mapping output to input coordinates.
+    :param output_size: A (width, height) tuple the transform was fitted for.
+    :param new_size: A (width, height) tuple of the new output frame.
+    :return: A (2, 3) numpy array mapping new output to input coordinates.
+    """
+
+    transform = np.array(transform, dtype=np.float64)
+    transform[:, 0] *= output_size[0] / new_size[0]
+    transform[:, 1] *= output_size[1] / new_size[1]
+    return transform
+
+
+def region_transform(transform, offset, factor):
+    """ Expresses an alignment transform in the pixels of a decoded region of the
+    input image, such as returned by decode_region
+
+    :param transform: A (2, 3) numpy array mapping output to input coordinates.
+    :param offset: An (x, y) full resolution offset of the top left of the region.
+    :param factor: An (x, y) number of full resolution pixels per region pixel.
+    :return: A (2, 3) numpy array mapping output to region coordinates.
+    """
+
+    transform = np.array(transform, dtype=np.float64)
+    transform[:, 2] -= offset
+    return transform / np.asarray(factor, dtype=np.float64)[:, np.newaxis]
+
+
+def region_box(box, offset, factor):
+    """ Expresses a crop box in the pixels of a decoded region of the input image,
+    such as returned by decode_region
+
+    :param box: A tuple of the left, top, right, bottom full resolution crop box.
+    :param offset: An (x, y) full resolution offset of the top left of the region.
+    :param factor: An (x, y) number of full resolution pixels per region pixel.
+    :return: A tuple of the left, top, right, bottom crop box in region pixels.
+    """
+
+    local = (np.asarray(box, dtype=np.float64).reshape(2, 2) - offset) / factor
+    return tuple(local.ravel())
+
+
+def align_image_from_PIL(PIL_img, transform, output_size, resample=PIL.Image.BICUBIC):
+    """ Warps an image onto the canonical template with a single affine resample,
+    replacing a crop followed by a separate resize.
+
+    :param PIL_img: A PIL object of a valid image
+    :param transform: A (2, 3) numpy array mapping output to input coordinates, as
+    returned by similarity_transforms.
+    :param output_size: A (width, height) tuple of the aligned output frame.
+    :param resample: A PIL resampling filter with default bicubic.
+
+    :return: A PIL object of the aligned image
+    """
+
+    return PIL_img.transform(
+        tuple(output_size), PIL.Image.AFFINE, data=tuple(np.ravel(transform)),
+        resample=resample, fillcolor=_pad_colour(PIL_img.mode)
+    )
+
+
 if __name__ == '__main__':
   
   # Standard library imports
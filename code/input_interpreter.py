@@ -1,33 +1,97 @@
 
 # Standard library imports
-import glob
+import io
+import math
 import os
+import tempfile
+import time
+
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 
 # Third party library imports
+import numpy as np
 import pyheif
 
 from PIL import Image
 from tqdm import tqdm
 
+# pillow_heif is optional and only used to read the thumbnails embedded in HEIF files
+try:
+    import pillow_heif
+except ImportError:
+    pillow_heif = None
+
+# PyTurboJPEG is optional and only used by the turbojpeg region decoder
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB
+except ImportError:
+    TurboJPEG = None
+
+
+HEIF_EXTENSIONS = (".heic", ".heif")
+JPEG_EXTENSIONS = (".jpeg", ".jpg")
+IMAGE_EXTENSIONS = HEIF_EXTENSIONS + JPEG_EXTENSIONS
+
+# seconds spent decoding images, keyed by the decode path which was taken
+DECODE_TIMINGS = defaultdict(list)
 
-def convert_to_PIL(file_path):
-    """ Converts a generic image file into a PIL object
+# the umask can only be read by setting it, which is done once at import time as it
+# is not thread safe. converted files get the permissions open() would give them.
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+def image_name(file_path):
+    """ Strips the directory and extension from an image path, the name which keys the
+    image in the landmark cache, stores and manifests.
+
+    :param file_path: A string to an image file.
+    :return: A string of the bare file name.
+    """
+
+    return os.path.splitext(os.path.split(file_path)[1])[0]
+
+
+def convert_to_PIL(file_path, min_size=None, data=None):
+    """ Converts a generic image file into a PIL object, taking the cheapest decode
+    path which still meets the requested resolution
     
     :param file_path: A string to any type of image file.
+    :param min_size: An optional (width, height) tuple for the smallest acceptable
+    size. JPEG files are then decoded at a reduced scale and HEIF files use their
+    embedded thumbnail when it is large enough.
+    :param data: An optional bytes object of the file content which was already read
+    into memory, in which case file_path is only used for its extension.
     :return: A PIL object read in from the given image path.
     """
 
-    file_ext = os.path.splitext(file_path)[1]
-    if file_ext == ".heic" or file_ext == ".heif":
-        PIL_img = convert_heif_to_PIL(file_path)
-    elif file_ext == ".jpeg":
-        PIL_img = convert_jpeg_to_PIL(file_path)
+    file_ext = os.path.splitext(file_path)[1].lower()
+    if file_ext in HEIF_EXTENSIONS:
+        PIL_img = None
+        if min_size is not None:
+            PIL_img = read_heif_thumbnail(_source(file_path, data), min_size)
+        if PIL_img is None:
+            PIL_img = convert_heif_to_PIL(_source(file_path, data))
+    elif file_ext in JPEG_EXTENSIONS:
+        PIL_img = convert_jpeg_to_PIL(_source(file_path, data), min_size)
     else:
-        raise ValueError("{!r} is an supported file type at thie time")
+        raise ValueError("{!r} is an supported file type at thie time".format(file_path))
 
     return PIL_img
 
 
+def _source(file_path, data=None):
+    """ Picks what a decoder reads an image from
+
+    :param file_path: A string to any type of image file.
+    :param data: An optional bytes object of the file content.
+    :return: The file path or a new file object over the bytes.
+    """
+
+    return file_path if data is None else io.BytesIO(data)
+
+
 def convert_heif_to_PIL(heif_file_path):
     """ Converts a .heif/.heic image file into a PIL object
     
@@ -38,79 +102,427 @@ def convert_heif_to_PIL(heif_file_path):
     # wrap to catch file errors
     try:
       # process .heif file if it exists
-      heif_file = pyheif.read_heif(heif_file_path)
-      PIL_image = Image.frombytes(mode=heif_file.mode, size=heif_file.size, data=heif_file.data)
-    
-      return PIL_image
+      return _read_heif(heif_file_path)
     except IOError as err:
       print(err)
 
 
-def convert_jpeg_to_PIL(jpeg_file_path):
+def _read_heif(heif_file_path):
+    """ Decodes a .heif/.heic image file into a PIL object, raising any file errors
+
+    :param heif_file_path: A string which leads to a valid .heif/.heic file.
+    :return: A PIL object read in from the given image path.
+    """
+
+    # the raw decoder honours the row stride of the decoded buffer
+    start = time.perf_counter()
+    heif_file = pyheif.read_heif(heif_file_path)
+    PIL_image = Image.frombuffer(
+        heif_file.mode, heif_file.size, heif_file.data, 'raw', heif_file.mode,
+        heif_file.stride, 1
+    )
+    DECODE_TIMINGS['heif'].append(time.perf_counter() - start)
+
+    return PIL_image
+
+
+def convert_heif_to_numpy(heif_file_path):
+    """ Decodes a .heif/.heic image file straight into a numpy array. The array is a
+    view of the decoded buffer so no copy is made.
+
+    :param heif_file_path: A string which leads to a valid .heif/.heic file.
+    :return: A read only HxWxC numpy array of uint8 values.
+    """
+
+    start = time.perf_counter()
+    heif_file = pyheif.read_heif(heif_file_path)
+    width, height = heif_file.size
+    channels = len(heif_file.mode)
+
+    # drop the padding at the end of every row without copying the buffer
+    rows = np.frombuffer(heif_file.data, dtype=np.uint8).reshape(height, heif_file.stride)
+    np_img = rows[:, :width * channels].reshape(height, width, channels)
+    DECODE_TIMINGS['heif-numpy'].append(time.perf_counter() - start)
+
+    return np_img
+
+
+def read_heif_thumbnail(heif_file_path, min_size=(0, 0)):
+    """ Reads the smallest thumbnail embedded in a .heif/.heic file which is at least
+    the requested size, skipping the decode of the full resolution image.
+
+    :param heif_file_path: A string which leads to a valid .heif/.heic file.
+    :param min_size: A (width, height) tuple for the smallest acceptable size.
+    :return: A PIL object of the thumbnail or None if no thumbnail is large enough.
+    """
+
+    if pillow_heif is None:
+        return None
+
+    start = time.perf_counter()
+    try:
+        heif_file = pillow_heif.open_heif(heif_file_path)
+        thumbnails = sorted(
+            (thumbnail for thumbnail in getattr(heif_file, 'thumbnails', [])
+                if thumbnail.size[0] >= min_size[0] and thumbnail.size[1] >= min_size[1]),
+            key=lambda thumbnail: thumbnail.size[0] * thumbnail.size[1]
+        )
+        if not thumbnails:
+            return None
+        thumbnail = thumbnails[0]
+        PIL_img = Image.frombuffer(
+            thumbnail.mode, thumbnail.size, thumbnail.data, 'raw', thumbnail.mode,
+            thumbnail.stride, 1
+        )
+    except (AttributeError, ValueError) as err:
+        # older and newer pillow_heif releases expose thumbnails differently
+        print(err)
+        return None
+    DECODE_TIMINGS['heif-thumbnail'].append(time.perf_counter() - start)
+
+    return PIL_img
+
+
+def convert_jpeg_to_PIL(jpeg_file_path, min_size=None):
     """ Converts a .jpeg image file into a PIL object
 
     :param jpeg_file_path: A string which leads to a valid .jpeg file.
+    :param min_size: An optional (width, height) tuple for the smallest acceptable
+    size, which lets libjpeg decode at a reduced scale.
     :return: A PIL object read in from the given image path.
     """
 
     # wrap to catch file errors
     try:
-        # process .jpeg file if it exists
+        # process .jpeg file if it exists, the pixels are decoded on the first access
+        start = time.perf_counter()
         PIL_img = Image.open(jpeg_file_path)
+        if min_size is not None:
+            PIL_img.draft('RGB', min_size)
+        PIL_img.load()
+        DECODE_TIMINGS['jpeg' if min_size is None else 'jpeg-draft'].append(
+            time.perf_counter() - start
+        )
 
         return PIL_img
     except IOError as err:
         print(err)
 
 
-def convert_heif_to_jpeg_batch(heif_dir, manipulated_photos_dir):
-    """ Converts a directory of .heif/.heic images into .jpeg files 
+def convert_to_PIL_thumbnail(file_path, scale, data=None):
+    """ Loads a downscaled copy of a generic image file into a PIL object. JPEG files
+    are decoded directly at a reduced size, HEIF files use an embedded thumbnail when
+    it is large enough and other files are decoded and reduced.
+
+    :param file_path: A string to any type of image file.
+    :param scale: An integer for the factor to reduce the image size by.
+    :param data: An optional bytes object of the file content which was already read
+    into memory, in which case file_path is only used for its extension.
+    :return: A PIL object which is roughly 1/scale the size of the image.
+    """
+
+    file_ext = os.path.splitext(file_path)[1].lower()
+    if file_ext in JPEG_EXTENSIONS:
+        # draft lets libjpeg scale the image by 1/2, 1/4 or 1/8 while decoding
+        with Image.open(_source(file_path, data)) as header:
+            width, height = header.size
+        return convert_jpeg_to_PIL(
+            _source(file_path, data), (width // scale, height // scale)
+        )
+
+    if file_ext in HEIF_EXTENSIONS:
+        # only the header is parsed to find the full resolution size
+        width, height = pyheif.open(_source(file_path, data)).size
+        PIL_img = read_heif_thumbnail(
+            _source(file_path, data), (width // scale, height // scale)
+        )
+        if PIL_img is not None:
+            return PIL_img
+
+    return convert_to_PIL(file_path, data=data).reduce(scale)
+
+
+def take_decode_timings():
+    """ Hands over the decode timings recorded so far and clears them, so the timings
+    recorded in a worker process can be sent back with the result of every image
+
+    :return: A dictionary of decode path to lists of seconds.
+    """
+
+    timings = {kind: list(times) for kind, times in DECODE_TIMINGS.items() if times}
+    DECODE_TIMINGS.clear()
+
+    return timings
+
+
+def read_image_size(file_path, data=None):
+    """ Reads the size of an image from its header without decoding any pixels
+
+    :param file_path: A string to any type of image file.
+    :param data: An optional bytes object of the file content.
+    :return: A (width, height) tuple of the full resolution image.
+    """
+
+    if os.path.splitext(file_path)[1].lower() in HEIF_EXTENSIONS:
+        return pyheif.open(_source(file_path, data)).size
+
+    with Image.open(_source(file_path, data)) as header:
+        return header.size
+
+
+def decode_region(file_path, box, output_size=None, decoder='pil', data=None):
+    """ Decodes only as much of an image as is needed to render a crop box at an output
+    size. The 'pil' decoder lets libjpeg decode at the largest reduced scale which still
+    meets the output size and the 'turbojpeg' decoder also losslessly cuts the region
+    out of the JPEG file before decoding it. Files which are not JPEG files always use
+    the 'pil' decoder, which may pick an embedded HEIF thumbnail.
+
+    :param file_path: A string to any type of image file.
+    :param box: A tuple of the left, top, right, bottom full resolution crop box.
+    :param output_size: An optional (width, height) tuple of the rendered region, the
+    region is decoded at full resolution without it.
+    :param decoder: A string with default 'pil' for one of REGION_DECODERS.
+    :param data: An optional bytes object of the file content.
+    :return: A PIL object which covers the box, the (x, y) full resolution offset of
+    its top left corner and the (x, y) number of full resolution pixels per pixel.
+    """
+
+    if decoder not in REGION_DECODERS:
+        raise ValueError("unknown region decoder {!r}, expected one of {}"
+            .format(decoder, sorted(REGION_DECODERS)))
+    if os.path.splitext(file_path)[1].lower() not in JPEG_EXTENSIONS:
+        decoder = 'pil'
+
+    start = time.perf_counter()
+    region = REGION_DECODERS[decoder](file_path, box, output_size, data)
+    DECODE_TIMINGS['region-' + decoder].append(time.perf_counter() - start)
+
+    return region
+
+
+def _region_scale(box, output_size):
+    """ Calculates how much a crop box is reduced to reach the output size
+
+    :param box: A tuple of the left, top, right, bottom crop box.
+    :param output_size: An optional (width, height) tuple of the output size.
+    :return: A float of at least 1 for the reduction of the box.
+    """
+
+    if output_size is None:
+        return 1.0
+
+    return max(1.0, min(
+        (box[2] - box[0]) / output_size[0], (box[3] - box[1]) / output_size[1]
+    ))
+
+
+def _decode_region_pil(file_path, box, output_size, data):
+    """ Decodes the whole image at the smallest scale which still meets the output size
+    of the box, see decode_region
+    """
+
+    width, height = read_image_size(file_path, data)
+    scale = _region_scale(box, output_size)
+    min_size = None
+    if scale > 1:
+        min_size = (int(math.ceil(width / scale)), int(math.ceil(height / scale)))
+
+    PIL_img = convert_to_PIL(file_path, min_size, data)
+    return PIL_img, (0, 0), (width / PIL_img.width, height / PIL_img.height)
+
+
+# the TurboJPEG instance is created on first use since loading libturbojpeg is slow
+_TURBOJPEG = None
+
+
+def _decode_region_turbojpeg(file_path, box, output_size, data):
+    """ Losslessly cuts the MCU aligned region of the box out of a JPEG file and
+    decodes only that region at the smallest scale which still meets the output size,
+    see decode_region
+    """
+
+    global _TURBOJPEG
+    if TurboJPEG is None:
+        raise ImportError("the turbojpeg region decoder requires PyTurboJPEG")
+    if _TURBOJPEG is None:
+        _TURBOJPEG = TurboJPEG()
+
+    if data is None:
+        with open(file_path, 'rb') as f:
+            data = f.read()
+    width, height = _TURBOJPEG.decode_header(data)[:2]
+
+    # a box entirely outside of the image leaves nothing to cut out
+    if box[2] <= 0 or box[3] <= 0 or box[0] >= width or box[1] >= height:
+        return _decode_region_pil(file_path, box, output_size, data)
+
+    # the region has to start on an MCU boundary which is at most 16 pixels
+    left = int(max(box[0], 0) // 16 * 16)
+    top = int(max(box[1], 0) // 16 * 16)
+    right = int(min(math.ceil(box[2]), width))
+    bottom = int(min(math.ceil(box[3]), height))
+    region = _TURBOJPEG.crop(data, left, top, right - left, bottom - top)
+
+    # the largest reduction libjpeg supports which still meets the output size
+    scale = _region_scale(box, output_size)
+    factor = min(
+        (f for f in _TURBOJPEG.scaling_factors if 1 / scale <= f[0] / f[1] <= 1),
+        key=lambda f: f[0] / f[1]
+    )
+    PIL_img = Image.fromarray(
+        _TURBOJPEG.decode(region, pixel_format=TJPF_RGB, scaling_factor=factor)
+    )
+
+    return PIL_img, (left, top), (
+        (right - left) / PIL_img.width, (bottom - top) / PIL_img.height
+    )
+
+
+REGION_DECODERS = {
+    'pil': _decode_region_pil,
+    'turbojpeg': _decode_region_turbojpeg,
+}
+
+
+def convert_heif_to_jpeg_batch(heif_dir, manipulated_photos_dir, workers=1, quality=95,
+        progressive=False):
+    """ Converts a directory of .heif/.heic images into .jpeg files. Files whose .jpeg
+    copy is already up to date are skipped, so an interrupted run can be resumed.
   
     :param heif_dir: A string of a valid directory with .heif/.heic images
     :param manipulated_photos_dir: A string of a valid directory to save
     the .jpeg files into.
-    :return: None
+    :param workers: An integer with default 1 for the number of processes to use.
+    :param quality: An integer with default 95 for the JPEG quality.
+    :param progressive: A boolean with default False to write progressive JPEGs.
+    :return: A dictionary with lists of the converted, skipped and failed files and
+    the total number of seconds the batch took.
     """
-  
-    # grabs all .heic files from the provided directory and wraps with tqdm
-    pbar = tqdm(glob.glob(os.path.join(heif_dir, '*.heic')))
-    for file_path in pbar:
-        # writing custom progress bar description for visulization purposes
-        file_name = os.path.split(file_path)[1]
-        pbar.set_description('Converting {}'.format(file_name))
-    
-        # utilizes helper function to parse a given image
-        convert_heif_to_jpeg(file_path, manipulated_photos_dir)
 
+    # grabs all .heif/.heic files from the provided directory
+    start = time.perf_counter()
+    heif_paths = sorted(
+        os.path.join(heif_dir, file_name) for file_name in os.listdir(heif_dir)
+        if os.path.splitext(file_name)[1].lower() in HEIF_EXTENSIONS
+    )
+    report = {'converted': [], 'skipped': [], 'failed': [], 'seconds': None}
+
+    # only convert the files whose .jpeg copy is missing or out of date
+    tasks = []
+    for heif_path in heif_paths:
+        if _jpeg_is_up_to_date(heif_path, _jpeg_path(heif_path, manipulated_photos_dir)):
+            report['skipped'].append({'file': heif_path})
+        else:
+            tasks.append((heif_path, manipulated_photos_dir, quality, progressive))
+
+    # convert the remaining files serially or over a pool of processes
+    executor = None
+    if workers > 1:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        results = executor.map(_convert_heif_to_jpeg_task, tasks)
+    else:
+        results = map(_convert_heif_to_jpeg_task, tasks)
+
+    try:
+        # wraps the results with tqdm as they are completed
+        pbar = tqdm(results, total=len(tasks))
+        for result in pbar:
+            # writing custom progress bar description for visulization purposes
+            pbar.set_description('Converted {}'.format(os.path.split(result['file'])[1]))
+            report['failed' if 'error' in result else 'converted'].append(result)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    report['seconds'] = time.perf_counter() - start
+    return report
 
-def convert_heif_to_jpeg(heif_file_path, manipulated_photos_dir):
-   """ Converts a .heif/.heic image file into a PIL object and saves a .jpeg file
+
+def convert_heif_to_jpeg(heif_file_path, manipulated_photos_dir, quality=95,
+        progressive=False):
+   """ Converts a .heif/.heic image file into a PIL object and saves a .jpeg file.
+   The .jpeg file is written to a temporary file first and atomically renamed, so an
+   interrupted conversion never leaves a truncated .jpeg behind.
  
    :param heif_file_path: A string which leads to a valid .heif/.heic file.
    :param manipulated_photos_dir: A string of a valid directory to save
    the .jpeg files into.
+   :param quality: An integer with default 95 for the JPEG quality.
+   :param progressive: A boolean with default False to write a progressive JPEG.
    :return: A PIL object read in from the given image path and the file path to
    the saved .jpeg file.
    """
  
-   # wrap to catch file errors
+   # calculates appropriate file name and extension
+   jpeg_file_path = _jpeg_path(heif_file_path, manipulated_photos_dir)
+
+   # process .heif file then save a .jpeg copy next to its final location
+   PIL_image = _read_heif(heif_file_path)
+   fd, tmp_file_path = tempfile.mkstemp(
+       prefix='.', suffix='.tmp', dir=manipulated_photos_dir
+   )
    try:
-       # calculates appropriate file name and extension
-       file_name = os.path.splitext(os.path.split(heif_file_path)[1])[0]
-       jpeg_file_path = os.path.join(manipulated_photos_dir, file_name + '.jpeg')
-       
-       # process .heif file if it exists then save a .jpeg copy
-       heif_file = pyheif.read_heif(heif_file_path)
-       PIL_image = Image.frombytes(mode=heif_file.mode, size=heif_file.size, data=heif_file.data)
-       PIL_image.save(jpeg_file_path, "JPEG")
+       with os.fdopen(fd, 'wb') as f:
+           PIL_image.convert('RGB').save(f, "JPEG", quality=quality, progressive=progressive)
+       # mkstemp creates the file private to the owner
+       os.chmod(tmp_file_path, 0o666 & ~_UMASK)
+       os.replace(tmp_file_path, jpeg_file_path)
+   except BaseException:
+       os.remove(tmp_file_path)
+       raise
    
-       return PIL_image, jpeg_file_path
-   except IOError as err:
-       print(err)
+   return PIL_image, jpeg_file_path
+
+
+def _convert_heif_to_jpeg_task(task):
+    """ Converts a single file for convert_heif_to_jpeg_batch, capturing any failure
+
+    :param task: A tuple of the convert_heif_to_jpeg arguments.
+    :return: A dictionary with the file path, the seconds taken and the error message
+    if the conversion failed.
+    """
+
+    start = time.perf_counter()
+    result = {'file': task[0]}
+    try:
+        convert_heif_to_jpeg(*task)
+    except Exception as err:
+        result['error'] = "{}: {}".format(type(err).__name__, err)
+    result['seconds'] = time.perf_counter() - start
+
+    return result
+
+
+def _jpeg_path(heif_file_path, manipulated_photos_dir):
+    """ Calculates the .jpeg path a .heif/.heic file is converted to
+
+    :param heif_file_path: A string which leads to a .heif/.heic file.
+    :param manipulated_photos_dir: A string of the directory of .jpeg files.
+    :return: A string to the .jpeg file.
+    """
+
+    file_name = os.path.splitext(os.path.split(heif_file_path)[1])[0]
+    return os.path.join(manipulated_photos_dir, file_name + '.jpeg')
+
+
+def _jpeg_is_up_to_date(heif_file_path, jpeg_file_path):
+    """ Checks if a .jpeg copy exists, is not empty and is newer than its source
+
+    :param heif_file_path: A string which leads to a .heif/.heic file.
+    :param jpeg_file_path: A string to the converted .jpeg file.
+    :return: A boolean which is True if the conversion can be skipped.
+    """
+
+    try:
+        jpeg_stat = os.stat(jpeg_file_path)
+    except OSError:
+        return False
+
+    return jpeg_stat.st_size > 0 and jpeg_stat.st_mtime >= os.path.getmtime(heif_file_path)
 
 
 def get_exif(jpeg_file_path):
-    """ Extracts meta-data from a .jpeg image
+    """ Extracts meta-data from a .jpeg image without decoding its pixels
   
     :param jpeg_file_path: A string which leads to a valid .jpeg file.
     :return: A dictionary containing the .jpeg image metadata.
@@ -118,11 +530,9 @@ def get_exif(jpeg_file_path):
   
     # wrap to catch file errors
     try:
-        # extract data from .jpeg file if it exists
-        image = Image.open(jpeg_file_path)
-        image.verify()
-    
-        return image.getexif()
+        # extract data from the .jpeg header if the file exists
+        with Image.open(jpeg_file_path) as image:
+            return image.getexif()
     except IOError as err:
         print(err)
 
@@ -139,6 +549,12 @@ if __name__ == '__main__':
   heif_photo_dir = config['Paths']['original_dir']
   manip_photo_dir = config['Paths']['manipulated_dir']
 
-  convert_heif_to_jpeg_batch(heif_photo_dir, manip_photo_dir)
+  report = convert_heif_to_jpeg_batch(heif_photo_dir, manip_photo_dir, workers=os.cpu_count())
+  print("converted {}, skipped {}, failed {} in {:.1f}s".format(
+      len(report['converted']), len(report['skipped']), len(report['failed']),
+      report['seconds']
+  ))
+  for failure in report['failed']:
+      print("{!r} failed: {}".format(failure['file'], failure['error']))
 
 
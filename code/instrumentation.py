@@ -0,0 +1,147 @@
+
+# Standard library imports
+import cProfile
+import csv
+import json
+import resource
+import sys
+import time
+
+from collections import defaultdict
+from contextlib import contextmanager
+
+# Third party library imports
+import numpy as np
+
+# Local library imports
+
+
+class StageTimer:
+    """ Collects the wall time of every named stage of the pipeline. Timers of worker
+    processes are sent back as plain dictionaries and merged into the timer of the main
+    process, so the summary covers every image regardless of where it was processed.
+    Stage names of the form 'stage:detail' break the time of a stage down further and
+    are already part of the time of the stage itself.
+    """
+
+    def __init__(self):
+        """ Creates a timer without any recorded durations """
+
+        self.durations = defaultdict(list)
+
+    @contextmanager
+    def stage(self, name):
+        """ Times the body of a with statement as one run of a stage
+
+        :param name: A string for the name of the stage.
+        """
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.durations[name].append(time.perf_counter() - start)
+
+    def merge(self, durations):
+        """ Adds the durations recorded by another timer
+
+        :param durations: A dictionary of stage names to lists of seconds.
+        """
+
+        for name, seconds in durations.items():
+            self.durations[name].extend(seconds)
+
+    def summary(self):
+        """ Aggregates the durations of every stage
+
+        :return: A dictionary of stage names to the count, total, p50, p95 and max
+        seconds of the stage.
+        """
+
+        return {
+            name: {
+                'count': len(seconds),
+                'total': float(np.sum(seconds)),
+                'p50': float(np.percentile(seconds, 50)),
+                'p95': float(np.percentile(seconds, 95)),
+                'max': float(np.max(seconds)),
+            }
+            for name, seconds in self.durations.items() if seconds
+        }
+
+
+def peak_rss_mb():
+    """ Looks up the peak resident memory of this process and of its largest finished
+    child process. The children are the pool workers once it has shut down but also
+    the ffmpeg encoders, so the child peak is that of whichever was largest.
+
+    :return: A tuple of the peak resident memory of this process and of the largest
+    child process in megabytes.
+    """
+
+    # linux reports kilobytes while macOS reports bytes
+    unit = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / unit,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / unit,
+    )
+
+
+def write_run_report(report_path, timer, num_images, seconds, failures=None):
+    """ Writes the stage timings, throughput and memory of a run to a JSON file, or to
+    a CSV file with one row per stage when the path ends in .csv
+
+    :param report_path: A string for the path of the report.
+    :param timer: A StageTimer holding the durations of the run.
+    :param num_images: An integer for the number of images processed.
+    :param seconds: A float for the wall time of the run in seconds.
+    :param failures: An optional collection of the file names which failed, kept in
+    JSON reports so the next run can be planned with them.
+    :return: A dictionary of the report.
+    """
+
+    peak_rss, peak_child_rss = peak_rss_mb()
+    report = {
+        'images': num_images,
+        'seconds': seconds,
+        'images_per_second': num_images / seconds if seconds else None,
+        'peak_rss_mb': peak_rss,
+        'peak_children_rss_mb': peak_child_rss,
+        'stages': timer.summary(),
+        'failures': sorted(failures or []),
+    }
+
+    if report_path.lower().endswith('.csv'):
+        with open(report_path, 'w', newline='') as fp:
+            writer = csv.writer(fp)
+            writer.writerow(['stage', 'count', 'total', 'p50', 'p95', 'max'])
+            for name, stats in report['stages'].items():
+                writer.writerow([name] + [
+                    stats[key] for key in ('count', 'total', 'p50', 'p95', 'max')
+                ])
+            writer.writerow(['images_per_second', report['images_per_second']])
+            writer.writerow(['peak_rss_mb', peak_rss])
+            writer.writerow(['peak_children_rss_mb', peak_child_rss])
+    else:
+        with open(report_path, 'w') as fp:
+            json.dump(report, fp, indent=2)
+
+    return report
+
+
+@contextmanager
+def profiled(profile_path):
+    """ Profiles the body of a with statement with cProfile and dumps the statistics,
+    which can be read with pstats or snakeviz. Only the calling process is profiled, so
+    worker processes need a single worker or an external sampler such as py-spy.
+
+    :param profile_path: A string for the path of the profile statistics.
+    """
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        profiler.dump_stats(profile_path)
@@ -0,0 +1,191 @@
+
+# Standard library imports
+import hashlib
+import json
+import os
+import sqlite3
+
+
+class LandmarkCache:
+    """ A persistent SQLite cache of facial detections so that reruns can skip
+    detection for images which have already been processed.
+
+    Entries are keyed by the content hash, size and modification time of the source
+    image together with a hash of the predictor model and the detection options used
+    to detect the landmarks.
+    """
+
+    def __init__(self, cache_path, predictor_path, model_id=None):
+        """ Opens (or creates) the cache database
+
+        :param cache_path: A string for the path of the SQLite database.
+        :param predictor_path: A string for a valid path to dlib predictor object.
+        :param model_id: An optional string identifying the detector backend and the
+        detection options, see detection_model_id, mixed into the model hash so
+        differently detected landmarks do not share entries.
+        """
+
+        self.cache_path = cache_path
+        self.model_hash = hash_file(predictor_path)
+        if model_id:
+            self.model_hash = hashlib.sha1(
+                (self.model_hash + model_id).encode()
+            ).hexdigest()
+
+        self._conn = sqlite3.connect(cache_path)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS landmarks ("
+            "content_hash TEXT, size INTEGER, mtime_ns INTEGER, model_hash TEXT, "
+            "file_path TEXT, face_dict TEXT, "
+            "PRIMARY KEY (content_hash, size, mtime_ns, model_hash))"
+        )
+        self._conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """ Closes the underlying database connection """
+
+        self._conn.close()
+
+    def key(self, file_path, stat=None):
+        """ Calculates the cache key of an image file
+
+        :param file_path: A string to a valid image file.
+        :param stat: An optional os.stat result of the file which was already taken.
+        :return: A tuple of content hash, size, mtime and model hash.
+        """
+
+        stat = stat if stat is not None else os.stat(file_path)
+        return hash_file(file_path), stat.st_size, stat.st_mtime_ns, self.model_hash
+
+    def get(self, key):
+        """ Looks up the facial detections stored for a cache key
+
+        :param key: A tuple returned from LandmarkCache.key.
+        :return: A dictionary of facial detections or None if it is not cached.
+        """
+
+        row = self._conn.execute(
+            "SELECT face_dict FROM landmarks WHERE content_hash = ? AND size = ? "
+            "AND mtime_ns = ? AND model_hash = ?", key
+        ).fetchone()
+        if row is None:
+            return None
+
+        # JSON turns the face indices into strings and the points into lists
+        return {
+            int(i): {
+                'facial_coords': face['facial_coords'],
+                'facial_points': [tuple(point) for point in face['facial_points']]
+            }
+            for i, face in json.loads(row[0]).items()
+        }
+
+    def put(self, key, file_path, face_dict):
+        """ Stores the facial detections of an image
+
+        :param key: A tuple returned from LandmarkCache.key.
+        :param file_path: A string to the image file the detections belong to.
+        :param face_dict: A dictionary of facial detections.
+        """
+
+        self._conn.execute(
+            "INSERT OR REPLACE INTO landmarks VALUES (?, ?, ?, ?, ?, ?)",
+            key + (os.path.abspath(file_path), json.dumps(face_dict))
+        )
+        self._conn.commit()
+
+    def stat_keys(self):
+        """ Lists the file path, size and modification time of every entry of the
+        current model, so cached files can be recognised from a stat call alone
+        without hashing their content
+
+        :return: A set of (absolute file path, size, mtime_ns) tuples.
+        """
+
+        rows = self._conn.execute(
+            "SELECT file_path, size, mtime_ns FROM landmarks WHERE model_hash = ?",
+            (self.model_hash,)
+        )
+        return set(rows.fetchall())
+
+    def vacuum(self):
+        """ Evicts entries whose source file is gone or has changed since it was
+        cached and then compacts the database file.
+
+        :return: An integer for the number of evicted entries.
+        """
+
+        stale = []
+        rows = self._conn.execute("SELECT rowid, file_path, size, mtime_ns FROM landmarks")
+        for rowid, file_path, size, mtime_ns in rows.fetchall():
+            try:
+                stat = os.stat(file_path)
+                if stat.st_size != size or stat.st_mtime_ns != mtime_ns:
+                    stale.append((rowid,))
+            except OSError:
+                stale.append((rowid,))
+
+        self._conn.executemany("DELETE FROM landmarks WHERE rowid = ?", stale)
+        self._conn.commit()
+        self._conn.execute("VACUUM")
+
+        return len(stale)
+
+
+def detection_model_id(backend='hog', backend_options=None, detect_scale=1, track=False):
+    """ Identifies the detector backend and the detection options for LandmarkCache, so
+    landmarks found on a reduced image or by tracking are never reused by a run which
+    detects differently
+
+    :param backend: A string with default 'hog' for the registered detector backend.
+    :param backend_options: An optional dictionary of keyword arguments of the backend.
+    :param detect_scale: An integer with default 1 for the detection reduction factor.
+    :param track: A boolean with default False for whether detection is tracked.
+    :return: A string of the model id, or None for full resolution untracked hog
+    detection which keeps the model hash of earlier caches.
+    """
+
+    if backend == 'hog' and detect_scale == 1 and not track:
+        return None
+
+    return json.dumps(
+        [backend, backend_options or {}, {'detect_scale': detect_scale, 'track': track}],
+        sort_keys=True
+    )
+
+
+def hash_file(file_path, chunk_size=1 << 20):
+    """ Calculates the SHA-256 hash of a file's content
+
+    :param file_path: A string to a valid file.
+    :param chunk_size: An integer for the number of bytes read at a time.
+    :return: A hexadecimal string of the file hash.
+    """
+
+    sha = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+
+    return sha.hexdigest()
+
+
+if __name__ == '__main__':
+
+    # Standard library imports
+    from configparser import ConfigParser
+
+    # set up configuration and initialize variables
+    config = ConfigParser()
+    config.read('../config.ini')
+
+    predictor_path = config['Paths']['HOG_predictor_path']
+
+    with LandmarkCache('../landmark_cache.db', predictor_path) as cache:
+        print("Evicted {} stale entries".format(cache.vacuum()))
@@ -0,0 +1,301 @@
+
+# Standard library imports
+
+# Third party library imports
+import numpy as np
+
+# Local library imports
+from .image_alignment import alignment_anchors, crop_size, fit_similarity, \
+    similarity_transforms
+
+
+SMOOTHING_METHODS = ('savgol', 'one_euro', 'kalman')
+
+# size of the frame the landmarks are smoothed in, the face fills it about as much as
+# it fills a selfie so the filter defaults keep working in pixels
+NORMALIZED_SIZE = crop_size(1000)
+
+
+def smooth_sequence(points, method='savgol', outlier_threshold=0.35, **kwargs):
+    """ Smooths the landmarks of a whole sequence of frames offline. Every frame is a
+    separate photo with the face anywhere in it, so the landmarks of every frame are
+    first mapped through the inverse of its own robust fit over all of its landmarks,
+    see stable_transforms. Only the shape of the face is smoothed, which includes the
+    eyes and nose the alignment is fitted to, and every frame is mapped back through
+    its own transform, so a face which moved between photos stays where it was
+    detected. Frames whose normalized landmarks deviate implausibly from their
+    neighbours are marked as outliers and their shape is interpolated from the
+    neighbouring shapes before the sequence is filtered.
+
+    :param points: A (N, 68, 2) numpy array of the landmarks of every frame in order.
+    :param method: A string with default 'savgol' for the filter, one of
+    SMOOTHING_METHODS.
+    :param outlier_threshold: A float with default 0.35 for the largest accepted mean
+    landmark or alignment anchor deviation from the neighbouring frames, in
+    inter-ocular distances. None disables outlier rejection.
+    :param kwargs: Keyword arguments passed to the chosen filter.
+    :return: The smoothed (N, 68, 2) float landmarks and a (N,) boolean array which is
+    True for the outlier frames.
+    """
+
+    filters = {'savgol': savgol_filter, 'one_euro': one_euro_filter, 'kalman': kalman_filter}
+    if method not in filters:
+        raise ValueError("unknown smoothing method {!r}, expected one of {}"
+            .format(method, SMOOTHING_METHODS))
+
+    points = np.asarray(points, dtype=float)
+    transforms = stable_transforms(points)
+    normalized = normalize_landmarks(points, transforms)
+
+    outliers = np.zeros(len(points), dtype=bool)
+    if outlier_threshold is not None:
+        outliers = detect_outliers(normalized, outlier_threshold)
+        normalized = interpolate_frames(normalized, outliers)
+
+    return denormalize_landmarks(filters[method](normalized, **kwargs), transforms), outliers
+
+
+def stable_transforms(points, iterations=10):
+    """ Fits the similarity transform of every frame from the median face shape of the
+    sequence onto all of its landmarks. Points far off the median shape, such as an
+    open mouth or a misplaced eye, are down weighted by iteratively reweighted least
+    squares, so noise on the eyes and nose is left in the normalized shape where it
+    is smoothed instead of being absorbed by the transform.
+
+    :param points: A (N, 68, 2) numpy array of landmarks in image coordinates.
+    :param iterations: An integer with default 10 for the reweighted fits.
+    :return: A (N, 2, 3) numpy array of transforms from the NORMALIZED_SIZE frame to
+    the image of every frame.
+    """
+
+    points = np.asarray(points, dtype=float)
+    transforms = similarity_transforms(points, NORMALIZED_SIZE)
+    weights = None
+    for _ in range(iterations):
+        reference = np.median(normalize_landmarks(points, transforms), axis=0)
+        transforms = fit_similarity(reference, points, weights)
+
+        # Cauchy weights relative to the typical residual of every frame
+        residuals = np.linalg.norm(normalize_landmarks(points, transforms) - reference, axis=-1)
+        scale = 1.5 * np.median(residuals, axis=1, keepdims=True) + 1e-6
+        weights = 1.0 / (1.0 + (residuals / scale) ** 2)
+
+    return transforms
+
+
+def normalize_landmarks(points, transforms):
+    """ Maps the landmarks of every frame through the inverse of its own transform
+
+    :param points: A (N, 68, 2) numpy array of landmarks in image coordinates.
+    :param transforms: A (N, 2, 3) numpy array of transforms from the normalized frame
+    to the image of every frame, as returned by similarity_transforms.
+    :return: A (N, 68, 2) float numpy array of landmarks in the normalized frame.
+    """
+
+    inverse = np.linalg.inv(transforms[:, :, :2])
+    shifted = np.asarray(points, dtype=float) - transforms[:, np.newaxis, :, 2]
+    return np.einsum('nij,nkj->nki', inverse, shifted)
+
+
+def denormalize_landmarks(points, transforms):
+    """ Maps the normalized landmarks of every frame back through its own transform
+
+    :param points: A (N, 68, 2) numpy array of landmarks in the normalized frame.
+    :param transforms: A (N, 2, 3) numpy array of transforms from the normalized frame
+    to the image of every frame, as returned by similarity_transforms.
+    :return: A (N, 68, 2) float numpy array of landmarks in image coordinates.
+    """
+
+    linear = np.einsum('nij,nkj->nki', transforms[:, :, :2], np.asarray(points, dtype=float))
+    return linear + transforms[:, np.newaxis, :, 2]
+
+
+def detect_outliers(points, threshold=0.35, window=5):
+    """ Marks frames whose landmarks deviate from the running median of their
+    neighbours by more than a fraction of the inter-ocular distance, on average or at
+    any of the eye centres and nose tip the alignment is fitted to. The landmarks must
+    be normalized, as a face moving between photos is no outlier.
+
+    :param points: A (N, 68, 2) numpy array of normalized landmarks.
+    :param threshold: A float with default 0.35 for the largest accepted mean landmark
+    or alignment anchor deviation in inter-ocular distances.
+    :param window: An odd integer with default 5 for the frames in the running median.
+    :return: A (N,) boolean array which is True for the outlier frames.
+    """
+
+    points = np.asarray(points, dtype=float)
+    reference = _running_median(points, window)
+
+    inter_ocular = np.linalg.norm(
+        reference[:, 36:42].mean(axis=1) - reference[:, 42:48].mean(axis=1), axis=-1
+    )
+    deviation = np.maximum(
+        np.linalg.norm(points - reference, axis=-1).mean(axis=1),
+        np.linalg.norm(alignment_anchors(points) - alignment_anchors(reference), axis=-1)
+        .max(axis=1)
+    )
+
+    return deviation > threshold * np.maximum(inter_ocular, 1.0)
+
+
+def interpolate_frames(values, mask):
+    """ Replaces the masked frames by linearly interpolating between the nearest
+    unmasked frames on either side, holding the edge values at the ends
+
+    :param values: A (N, ...) numpy array of per frame values.
+    :param mask: A (N,) boolean array which is True for the frames to replace.
+    :return: A (N, ...) float numpy array with the masked frames interpolated.
+    """
+
+    values = np.array(values, dtype=float)
+    mask = np.asarray(mask, dtype=bool)
+    if not mask.any() or mask.all():
+        return values
+
+    # index of the nearest valid frame before and after every frame
+    frames = np.arange(len(values))
+    valid = np.where(mask, -1, frames)
+    before = np.maximum.accumulate(valid)
+    valid = np.where(mask, len(values), frames)
+    after = np.minimum.accumulate(valid[::-1])[::-1]
+
+    before = np.where(before < 0, after, before)
+    after = np.where(after >= len(values), before, after)
+    span = np.maximum(after - before, 1)
+    weight = ((frames - before) / span).reshape((-1,) + (1,) * (values.ndim - 1))
+
+    values[mask] = ((1 - weight) * values[before] + weight * values[after])[mask]
+    return values
+
+
+def savgol_filter(values, window=9, order=2):
+    """ Applies a Savitzky-Golay filter along the frames, fitting a polynomial to a
+    sliding window of every coordinate at once. The edges are padded by repeating the
+    first and last frames.
+
+    :param values: A (N, ...) numpy array of per frame values.
+    :param window: An odd integer with default 9 for the frames in the window.
+    :param order: An integer with default 2 for the order of the fitted polynomial.
+    :return: A (N, ...) float numpy array of smoothed values.
+    """
+
+    if window % 2 == 0 or window <= order:
+        raise ValueError("the window must be odd and larger than the polynomial order")
+
+    values = np.asarray(values, dtype=float)
+    half = window // 2
+
+    # the centre row of the least squares projection gives the convolution weights
+    offsets = np.arange(-half, half + 1)
+    coeffs = np.linalg.pinv(np.vander(offsets, order + 1, increasing=True))[0]
+
+    padded = np.concatenate([
+        np.repeat(values[:1], half, axis=0), values, np.repeat(values[-1:], half, axis=0)
+    ])
+    return sum(c * padded[k:k + len(values)] for k, c in enumerate(coeffs))
+
+
+def one_euro_filter(values, min_cutoff=0.1, beta=0.01, d_cutoff=1.0):
+    """ Applies a One Euro filter along the frames. The cutoff frequency rises with
+    the speed of every coordinate, so slow jitter is smoothed heavily while large
+    movements are followed with little lag. Frequencies are in cycles per frame and
+    speeds in units per frame.
+
+    :param values: A (N, ...) numpy array of per frame values.
+    :param min_cutoff: A float with default 0.1 for the cutoff of a still coordinate.
+    :param beta: A float with default 0.01 for how fast the cutoff rises with speed.
+    :param d_cutoff: A float with default 1.0 for the cutoff of the speed estimate.
+    :return: A (N, ...) float numpy array of smoothed values.
+    """
+
+    values = np.asarray(values, dtype=float)
+    smoothed = np.empty_like(values)
+    if not len(values):
+        return smoothed
+
+    # the recursion runs over frames while every coordinate is filtered at once
+    smoothed[0] = values[0]
+    speed = np.zeros_like(values[0])
+    d_alpha = _smoothing_factor(d_cutoff)
+    for i in range(1, len(values)):
+        speed = d_alpha * (values[i] - smoothed[i - 1]) + (1 - d_alpha) * speed
+        alpha = _smoothing_factor(min_cutoff + beta * np.abs(speed))
+        smoothed[i] = alpha * values[i] + (1 - alpha) * smoothed[i - 1]
+
+    return smoothed
+
+
+def kalman_filter(values, process_noise=1.0, measurement_noise=16.0):
+    """ Applies a constant velocity Kalman filter followed by a Rauch-Tung-Striebel
+    smoother along the frames. Every coordinate shares the same noise model, so the
+    covariances and gains are computed once per frame and applied to all coordinates.
+
+    :param values: A (N, ...) numpy array of per frame values.
+    :param process_noise: A float with default 1.0 for the acceleration variance.
+    :param measurement_noise: A float with default 16.0 for the measurement variance.
+    :return: A (N, ...) float numpy array of smoothed values.
+    """
+
+    values = np.asarray(values, dtype=float)
+    num_frames = len(values)
+    if num_frames < 2:
+        return values.copy()
+
+    F = np.array([[1.0, 1.0], [0.0, 1.0]])
+    Q = process_noise * np.array([[0.25, 0.5], [0.5, 1.0]])
+    H = np.array([1.0, 0.0])
+
+    # position and velocity of every coordinate with a shared 2x2 covariance
+    states = np.empty((num_frames, 2) + values.shape[1:])
+    predicted = np.empty_like(states)
+    covs = np.empty((num_frames, 2, 2))
+    predicted_covs = np.empty_like(covs)
+
+    state = np.stack([values[0], np.zeros_like(values[0])])
+    cov = np.diag([measurement_noise, measurement_noise])
+    for i in range(num_frames):
+        if i:
+            state = np.tensordot(F, state, axes=1)
+            cov = F @ cov @ F.T + Q
+        predicted[i], predicted_covs[i] = state, cov
+
+        gain = cov @ H / (H @ cov @ H + measurement_noise)
+        state = state + np.multiply.outer(gain, values[i] - state[0])
+        cov = cov - np.outer(gain, H @ cov)
+        states[i], covs[i] = state, cov
+
+    # smooth backwards so every frame also uses the frames after it
+    for i in range(num_frames - 2, -1, -1):
+        gain = covs[i] @ F.T @ np.linalg.inv(predicted_covs[i + 1])
+        states[i] = states[i] + np.tensordot(gain, states[i + 1] - predicted[i + 1], axes=1)
+
+    return states[:, 0]
+
+
+def _smoothing_factor(cutoff):
+    """ Calculates the exponential smoothing factor of a cutoff frequency
+
+    :param cutoff: A float or numpy array of cutoff frequencies in cycles per frame.
+    :return: A float or numpy array of smoothing factors between 0 and 1.
+    """
+
+    tau = 1.0 / (2 * np.pi * cutoff)
+    return 1.0 / (1.0 + tau)
+
+
+def _running_median(values, window):
+    """ Calculates the median of every frame and its neighbours, repeating the first
+    and last frames at the edges
+
+    :param values: A (N, ...) numpy array of per frame values.
+    :param window: An odd integer for the frames in the running median.
+    :return: A (N, ...) float numpy array of running medians.
+    """
+
+    half = window // 2
+    padded = np.concatenate([
+        np.repeat(values[:1], half, axis=0), values, np.repeat(values[-1:], half, axis=0)
+    ])
+    return np.median(
+        np.stack([padded[k:k + len(values)] for k in range(window)]), axis=0
+    )
@@ -0,0 +1,176 @@
+
+# Standard library imports
+import json
+import os
+
+# Third party library imports
+import numpy as np
+
+
+class LandmarkStore:
+    """ A compact columnar store of facial detections for a sequence of images.
+
+    The landmarks of every image are kept in a single (N, 68, 2) int32 array and the
+    face boxes in a (N, 4) int32 array, indexed by file name. This lets downstream
+    stages operate on all frames at once with NumPy instead of nested dictionaries.
+    """
+
+    def __init__(self, points=None, boxes=None, names=None, num_parts=68):
+        """ Creates a store, optionally wrapping existing arrays
+
+        :param points: An optional (N, num_parts, 2) numpy array of landmarks.
+        :param boxes: An optional (N, 4) numpy array of face boxes.
+        :param names: An optional list of N file names.
+        :param num_parts: An integer with default 68 for the number of landmarks.
+        """
+
+        names = list(names or [])
+        if points is None:
+            points = np.empty((0, num_parts, 2), dtype=np.int32)
+        if boxes is None:
+            boxes = np.empty((0, 4), dtype=np.int32)
+
+        self._points = points
+        self._boxes = boxes
+        self._names = names
+        self._index = {name: i for i, name in enumerate(names)}
+        self._size = len(names)
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, name):
+        return name in self._index
+
+    @property
+    def names(self):
+        """ The file names of the stored images in order """
+
+        return self._names
+
+    @property
+    def points(self):
+        """ A (N, 68, 2) int32 array of the landmarks of every image """
+
+        return self._points[:self._size]
+
+    @property
+    def boxes(self):
+        """ A (N, 4) int32 array of the left, top, right, bottom face boxes """
+
+        return self._boxes[:self._size]
+
+    def index(self, name):
+        """ Looks up the row of an image
+
+        :param name: A string for the file name of the image.
+        :return: An integer for the row of the image in the arrays.
+        """
+
+        return self._index[name]
+
+    def append(self, name, face_dict):
+        """ Appends the first detected face of an image, growing the arrays by doubling
+        their capacity so that building the store incrementally stays cheap.
+
+        :param name: A string for the file name of the image.
+        :param face_dict: A dictionary of facial detections for the image.
+        """
+
+        if name in self._index:
+            raise ValueError("{!r} is already in the landmark store".format(name))
+
+        if self._size == len(self._points) or not self._points.flags.writeable:
+            capacity = max(16, 2 * self._size)
+            self._points = _resize(self._points, capacity)
+            self._boxes = _resize(self._boxes, capacity)
+
+        face = face_dict[min(face_dict)]
+        self._points[self._size] = face['facial_points']
+        self._boxes[self._size] = face['facial_coords']
+        self._index[name] = self._size
+        self._names.append(name)
+        self._size += 1
+
+    def update(self, face_detections):
+        """ Appends the detections of every image not yet in the store, keeping the
+        order of the dictionary so that incremental runs extend the sequence.
+
+        :param face_detections: A dictionary of file names to facial detections.
+        """
+
+        for name, face_dict in face_detections.items():
+            if name not in self._index:
+                self.append(name, face_dict)
+
+    def face_dict(self, name):
+        """ Converts the landmarks of an image back into the dictionary format
+        returned by facial_detection_PIL.
+
+        :param name: A string for the file name of the image.
+        :return: A dictionary of facial detections.
+        """
+
+        i = self._index[name]
+        return {
+            0: {
+                'facial_coords': self._boxes[i].tolist(),
+                'facial_points': [tuple(point) for point in self._points[i].tolist()]
+            }
+        }
+
+    def save(self, store_dir):
+        """ Saves the store as .npy arrays and a JSON file name index
+
+        :param store_dir: A string for the directory to save the store to.
+        """
+
+        os.makedirs(store_dir, exist_ok=True)
+        np.save(os.path.join(store_dir, 'points.npy'), self.points)
+        np.save(os.path.join(store_dir, 'boxes.npy'), self.boxes)
+        with open(os.path.join(store_dir, 'names.json'), 'w') as fp:
+            json.dump(self._names, fp)
+
+    @classmethod
+    def load(cls, store_dir, mmap=True):
+        """ Loads a saved store, memory mapping the arrays so that nothing is read
+        until it is accessed.
+
+        :param store_dir: A string for the directory the store was saved to.
+        :param mmap: A boolean with default True to memory map the arrays.
+        :return: A LandmarkStore object.
+        """
+
+        mmap_mode = 'r' if mmap else None
+        points = np.load(os.path.join(store_dir, 'points.npy'), mmap_mode=mmap_mode)
+        boxes = np.load(os.path.join(store_dir, 'boxes.npy'), mmap_mode=mmap_mode)
+        with open(os.path.join(store_dir, 'names.json')) as fp:
+            names = json.load(fp)
+
+        return cls(points, boxes, names, num_parts=points.shape[1])
+
+    @classmethod
+    def from_face_detections(cls, face_detections):
+        """ Builds a store from the dictionary returned by process_all_images
+
+        :param face_detections: A dictionary of file names to facial detections.
+        :return: A LandmarkStore object.
+        """
+
+        store = cls()
+        store.update(face_detections)
+
+        return store
+
+
+def _resize(array, capacity):
+    """ Copies an array into a new writeable array with a larger first dimension
+
+    :param array: A numpy array.
+    :param capacity: An integer for the new length of the first dimension.
+    :return: A numpy array with the original rows followed by uninitialized rows.
+    """
+
+    resized = np.empty((capacity,) + array.shape[1:], dtype=np.int32)
+    resized[:len(array)] = array
+    return resized
@@ -0,0 +1,142 @@
+
+# Standard library imports
+import json
+import os
+
+from datetime import datetime
+
+# Third party library imports
+import pyheif
+
+from PIL import Image
+
+# Local library imports
+from .input_interpreter import HEIF_EXTENSIONS
+
+
+# EXIF tags, see https://exiftool.org/TagNames/EXIF.html
+EXIF_IFD = 0x8769
+DATE_TIME = 0x0132
+DATE_TIME_ORIGINAL = 0x9003
+ORIENTATION = 0x0112
+
+
+class MetadataIndex:
+    """ A small on-disk JSON index of image metadata used to order frames by their
+    true capture time. Only the header bytes of an image are read, and only for files
+    whose size or modification time changed since the index was last refreshed.
+    """
+
+    def __init__(self, index_path):
+        """ Loads the index if it already exists
+
+        :param index_path: A string for the path of the JSON index file.
+        """
+
+        self.index_path = index_path
+        self.entries = {}
+        if os.path.exists(index_path):
+            with open(index_path) as fp:
+                self.entries = json.load(fp)
+
+    def refresh(self, file_paths, stats=None):
+        """ Reads the metadata of new or changed files and drops files which are gone
+
+        :param file_paths: A list of strings to the image files to index.
+        :param stats: An optional dictionary of file paths to os.stat results which
+        were already taken, so the files are not stat'ed again.
+        :return: An integer for the number of files whose metadata was read.
+        """
+
+        entries, updated = {}, 0
+        for file_path in file_paths:
+            key = os.path.abspath(file_path)
+            stat = stats[file_path] if stats is not None else os.stat(file_path)
+            entry = self.entries.get(key)
+            if entry is None or entry['size'] != stat.st_size \
+                    or entry['mtime_ns'] != stat.st_mtime_ns:
+                # an unreadable header falls back to the modification time, the image
+                # then fails on its own when it is processed
+                try:
+                    entry = read_image_metadata(file_path)
+                except Exception:
+                    entry = {'capture_time': None, 'orientation': None, 'width': None,
+                        'height': None}
+                entry.update(size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+                updated += 1
+            entries[key] = entry
+
+        self.entries = entries
+        return updated
+
+    def save(self):
+        """ Writes the index back to disk """
+
+        with open(self.index_path, 'w') as fp:
+            json.dump(self.entries, fp)
+
+    def sort_key(self, file_path):
+        """ Calculates the ordering key of an indexed file. Files without a capture
+        time fall back to their modification time.
+
+        :param file_path: A string to an indexed image file.
+        :return: A string of the ISO 8601 capture (or modification) time.
+        """
+
+        entry = self.entries[os.path.abspath(file_path)]
+        if entry.get('capture_time'):
+            return entry['capture_time']
+
+        return datetime.fromtimestamp(entry['mtime_ns'] / 1e9).isoformat()
+
+    def sorted_paths(self, file_paths, stats=None):
+        """ Refreshes the index and orders files by capture time
+
+        :param file_paths: A list of strings to image files.
+        :param stats: An optional dictionary of file paths to os.stat results.
+        :return: A list of strings to the image files in capture order.
+        """
+
+        self.refresh(file_paths, stats)
+        return sorted(file_paths, key=self.sort_key)
+
+
+def read_image_metadata(file_path):
+    """ Reads the capture time, orientation and dimensions of an image from its header
+    without decoding any pixels
+
+    :param file_path: A string to any type of image file.
+    :return: A dictionary with the ISO 8601 capture time (or None), the EXIF
+    orientation (or None), the width and the height of the image.
+    """
+
+    if os.path.splitext(file_path)[1].lower() in HEIF_EXTENSIONS:
+        # pyheif.open only parses the container, the image itself is not decoded
+        heif_file = pyheif.open(file_path)
+        size = heif_file.size
+        exif = Image.Exif()
+        for metadata in heif_file.metadata or []:
+            if metadata['type'] == 'Exif':
+                data = metadata['data']
+                exif.load(data[max(data.find(b'Exif\x00\x00'), 0):])
+    else:
+        # PIL only reads up to the start of the image data when opening a file
+        with Image.open(file_path) as image:
+            size = image.size
+            exif = image.getexif()
+
+    capture_time = exif.get_ifd(EXIF_IFD).get(DATE_TIME_ORIGINAL) or exif.get(DATE_TIME)
+    if capture_time:
+        try:
+            capture_time = datetime.strptime(
+                capture_time.strip('\x00 '), '%Y:%m:%d %H:%M:%S'
+            ).isoformat()
+        except ValueError:
+            capture_time = None
+
+    return {
+        'capture_time': capture_time or None,
+        'orientation': exif.get(ORIENTATION),
+        'width': size[0],
+        'height': size[1],
+    }
@@ -1,24 +1,60 @@
 
 # Standard library imports
+import io
+import itertools
+import json
 import os
+import queue
+import threading
 
+from concurrent.futures import ProcessPoolExecutor
 from glob import iglob
 
 # Third party library imports
+import numpy as np
+
 from tqdm import tqdm
 
 # Local library imports
-from .input_interpreter import convert_to_PIL
+from .input_interpreter import convert_to_PIL, convert_to_PIL_thumbnail, read_heif_thumbnail, \
+    decode_region, take_decode_timings, image_name, HEIF_EXTENSIONS, IMAGE_EXTENSIONS, \
+    JPEG_EXTENSIONS
 from .HOG_implementation.facial_detection import set_up, facial_detection_PIL, draw_facial_points
-from .image_alignment import crop_image_from_PIL, write_jpegs_to_video, write_numpy_to_video
-from .data_storage import store_single_hdf5
+from .HOG_implementation.face_tracking import FaceTracker
+from .image_alignment import crop_image_from_PIL, crop_resize_PIL, crop_box_from_face, \
+    crop_size, similarity_transforms, transform_bounds, resize_transform, \
+    region_transform, region_box, align_image_from_PIL, encoder_options, \
+    RESAMPLE_FILTERS, write_numpy_to_video, write_jpeg_list_to_video, \
+    write_jpeg_list_to_video_parallel, write_frame_queue_to_video, concat_videos
+from .data_storage import FrameStore, RawFrameCache, load_raw_frames
+from .detectors import get_detector, face_dict_from_arrays
+from .instrumentation import StageTimer
+from .pipeline import prefetch, bounded_map, chunked, read_file, WriterPool
+from .rendering import draw_points_PIL
+from .landmark_cache import LandmarkCache, detection_model_id
+from .landmark_smoothing import smooth_sequence
+from .landmark_store import LandmarkStore
+from .metadata_index import MetadataIndex
+
+
+# per-process state populated once by _init_worker so that the dlib predictor and
+# detector are only loaded a single time per worker
+_WORKER_STATE = {}
 
+# number of images whose faces a detector backend detects in a single batch
+DETECT_BATCH_SIZE = 8
 
-def process_all_images(orig_dir, manip_dir, predictor_path, video_path, frame_rate, 
-        draw, crop, box_size=2500, prev_images=None):
-    """ A orchestrator function which coordinates the processing of all images in a 
+
+def process_all_images(orig_dir, manip_dir, predictor_path, video_path, frame_rate,
+        draw, crop, box_size=2500, prev_images=None, workers=1, cache_path=None,
+        stream=False, queue_size=8, index_path=None, encoder=None, encode_segments=1,
+        plan=None, **kwargs):
+    """ A orchestrator function which coordinates the processing of all images in a
     given directory and compiles them into a single video.
 
+    In streaming mode the processed frames are piped straight into ffmpeg from an
+    encoder thread instead of being saved to manip_dir and read back as .jpeg files.
+
     :orig_dir: A string for valid directory path to input images.
     :manip_dir: A string for a valid directory path to saved processed images.
     :predictor_path: A string for a valid path to dlib predictor object.
@@ -27,61 +63,576 @@ def process_all_images(orig_dir, manip_dir, predictor_path, video_path, frame_ra
     :draw: A boolean to indicate if the images should have the detected landmarks drawn.
     :crop: A boolean to indicate if the images should be cropped.
     :box_size: An integer with default 2500 to indicate the size of the cropping box.
-    :return: A dictionary of dictionary of facial detections 
+    :prev_images: An optional collection of file names which have already been processed.
+    :workers: An integer with default 1 for the number of processes to fan images out to.
+    :cache_path: An optional string for the path of the landmark cache database.
+    :stream: A boolean with default False to encode frames without saving them to disk.
+    :queue_size: An integer with default 8 for the number of frames buffered for the
+    encoder thread when streaming.
+    :index_path: An optional string for a metadata index used to order the images by
+    capture time instead of modification time.
+    :encoder: An optional preset name of ENCODER_PRESETS or a dictionary of ffmpeg
+    output options for the video encoder.
+    :encode_segments: An integer with default 1 for the number of segments of the
+    saved images encoded in parallel, which does not apply when streaming.
+    :plan: An optional RunPlan of orig_dir whose ordered images and stat results are
+    used instead of listing the directory again.
+    :kwargs: Additional detection options passed to process_images.
+    :return: A dictionary of dictionary of facial detections and a dictionary of
+    file names to the error raised while processing them.
     """
 
-    # initialize the facial detection dictionary and the predictor/detector
-    face_detections = {}
-    predictor, detector = set_up(predictor_path)
+    # order the input images by capture time and drop previously processed ones
+    image_paths = _list_images(orig_dir, prev_images, index_path, plan)
+    if plan is not None:
+        kwargs.setdefault('file_stats', plan.stats)
 
-    # set a progress bar to iterate through of the input images
-    valid_images = iglob(os.path.join(orig_dir, "*.*"))
-    images_pbar = tqdm(sorted(valid_images, key=os.path.getmtime))
-    for orig_fp in images_pbar:
-        # parse the file name for custom progress bar description
-        file_name = os.path.splitext(os.path.split(orig_fp)[1])[0]
-        pbar.set_description("Processing {!r}".format(file_name))
-        manip_fp = os.path.join(manip_dir, file_name + ".jpeg")
-
-        # if current input image has already been processed then skip to next iter
-        if prev_images is not None and file_name in prev_images:
-            continue
+    if not stream:
+        # process every image, collecting failures instead of stopping the run
+        face_detections, failures = process_images(
+            image_paths, manip_dir, predictor_path, draw, crop, box_size, workers, cache_path,
+            **kwargs
+        )
+
+        # save the resulting images to video in capture order, a glob of manip_dir
+        # would order the frames by file name
+        jpeg_paths = [
+            os.path.join(manip_dir, image_name(orig_fp) + ".jpeg") for orig_fp in image_paths
+            if image_name(orig_fp) in face_detections
+        ]
+        timer = kwargs.get('timer') or StageTimer()
+        if jpeg_paths:
+            with timer.stage('encode'):
+                _write_video(jpeg_paths, video_path, frame_rate, encoder, encode_segments)
+
+        return face_detections, failures
 
-        # process a single image using helper function and save detected faces
-        face_detect = process_image_PIL(orig_fp, manip_fp, predictor, detector, draw, crop, box_size)
-        face_detections[file_name] = face_detect
+    # every frame of a video must share the same size which only cropping or aligning
+    # guarantees
+    if not (crop or kwargs.get('align')):
+        raise ValueError("streaming to video requires the images to be cropped or aligned")
+
+    # encode frames on a separate thread, the bounded queue applies backpressure
+    frame_queue = queue.Queue(maxsize=queue_size)
+    timer = kwargs.get('timer') or StageTimer()
+    encoder_errors = []
+    encoder_thread = threading.Thread(
+        target=_encode_frame_queue,
+        args=(video_path, frame_queue, frame_rate, encoder, timer, encoder_errors)
+    )
+    encoder_thread.start()
+    try:
+        face_detections, failures = process_images(
+            image_paths, None, predictor_path, draw, crop, box_size, workers, cache_path,
+            frame_sinks=[lambda file_name, frame, face_dict: frame_queue.put(frame)],
+            **kwargs
+        )
+    finally:
+        frame_queue.put(None)
+        encoder_thread.join()
 
-    # save resulting images to video
-    _ = write_to_video(manip_dir, video_path, frame_rate)
+    # a failed encode must not pass for a finished video
+    if encoder_errors:
+        raise encoder_errors[0]
 
     # return facial detections for later usage
-    return face_detections
+    return face_detections, failures
+
+
+def process_images(image_paths, manip_dir, predictor_path, draw, crop, box_size=2500,
+        workers=1, cache_path=None, frame_sinks=None, detect_scale=1, track=False,
+        store_path=None, store_compression=None, frame_cache_path=None, align=False,
+        smooth=None, face_dicts=None, transforms=None, timer=None, backend='hog',
+        backend_options=None, readers=0, writers=0, read_ahead=8, output_size=None,
+        region_decoder=None, resample='bicubic', file_stats=None, frame_cache_mode='w'):
+    """ Processes a list of images either serially or over a pool of processes. The
+    results are returned in the same order as the input paths.
+
+    When aligning or smoothing, the landmarks of every image are detected in a first
+    pass so the whole sequence can be smoothed and its similarity transforms computed
+    at once, and the frames are then cropped or warped and saved in a second pass.
+
+    :image_paths: A list of strings to valid input image paths.
+    :manip_dir: A string for a valid directory path to saved processed images, or None
+    to not save them.
+    :predictor_path: A string for a valid path to dlib predictor object.
+    :draw: A boolean to indicate if the images should have the detected landmarks drawn.
+    :crop: A boolean to indicate if the images should be cropped.
+    :box_size: An integer with default 2500 to indicate the size of the cropping box.
+    :workers: An integer with default 1 for the number of processes to fan images out to.
+    :cache_path: An optional string for the path of the landmark cache database.
+    :frame_sinks: An optional list of callables which are handed the file name, the
+    processed frame as a numpy array and the facial detections of every image, in order.
+    :detect_scale: An integer with default 1 for the factor images are reduced by
+    before detecting the face bounding box.
+    :track: A boolean with default False to reuse the previous image's face box as a
+    prior for detection, falling back to a full detection when the fit is poor.
+    :store_path: An optional string for an HDF5 file the cropped frames and their
+    landmarks are appended to.
+    :store_compression: An optional string for the HDF5 frame compression, either
+    'lzf' or 'gzip'.
+    :frame_cache_path: An optional string for a raw frame file the cropped frames are
+    written to, so they can be re-rendered with render_frame_cache.
+    :frame_cache_mode: A string with default 'w' to replace the frame cache, or 'a' to
+    append to the frames already in it.
+    :align: A boolean with default False to warp every face onto a canonical template
+    with a similarity transform instead of cropping around the nose.
+    :smooth: An optional string for the temporal filter applied to the landmarks of
+    the sequence before cropping or aligning, one of SMOOTHING_METHODS. The landmarks
+    are smoothed relative to a robust fit of their own face, so faces keep their
+    position while the eyes and nose the alignment is fitted to are steadied, and
+    implausible face shapes are interpolated from their neighbours.
+    :face_dicts: An optional dictionary of file names to known facial detections, in
+    which case the landmark cache is not consulted.
+    :transforms: An optional dictionary of file names to the (2, 3) alignment
+    transforms to warp the images with.
+    :timer: An optional StageTimer which collects the time spent in every stage of
+    every image, including those processed by worker processes.
+    :backend: A string with default 'hog' for the registered detector backend.
+    :backend_options: An optional dictionary of keyword arguments for the backend.
+    :readers: An integer with default 0 for the number of threads reading the next
+    images ahead of detection, which hides the latency of slow storage.
+    :writers: An integer with default 0 for the number of threads saving the processed
+    images. Frame sinks then also run on their own thread. With worker processes the
+    processed images are sent back to be saved, which costs a copy per image.
+    :read_ahead: An integer with default 8 for the number of images read ahead and the
+    number of writes in flight before the processing loop waits.
+    :output_size: An optional (width, height) tuple the cropped or aligned frames are
+    resampled to in the same pass, instead of keeping the size of the crop box.
+    :region_decoder: An optional string for one of REGION_DECODERS. When the landmarks
+    of an image are known, only the region of the image covered by its output frame is
+    decoded, at the smallest scale which still meets the output size.
+    :resample: A string with default 'bicubic' for one of RESAMPLE_FILTERS used to
+    crop or align the frames.
+    :file_stats: An optional dictionary of image paths to os.stat results which were
+    already taken, so the landmark cache does not stat the images again.
+    :return: A dictionary of facial detections and a dictionary of failures, both
+    keyed by file name.
+    """
+
+    if track and backend != 'hog':
+        raise ValueError("tracking is only supported by the hog detector backend")
+
+    if (align or smooth) and face_dicts is None:
+        # detect the landmarks of every image without rendering any frame
+        face_detections, failures = process_images(
+            image_paths, None, predictor_path, False, False, box_size, workers, cache_path,
+            detect_scale=detect_scale, track=track, timer=timer, backend=backend,
+            backend_options=backend_options, readers=readers, read_ahead=read_ahead,
+            file_stats=file_stats
+        )
+        landmarks = LandmarkStore.from_face_detections(face_detections)
+        points = landmarks.points
 
+        # smooth the landmarks of the whole sequence at once, the boxes are detected
+        if smooth and len(landmarks):
+            points, outliers = smooth_sequence(landmarks.points, smooth)
+            landmarks = LandmarkStore(
+                np.rint(points).astype(np.int32), landmarks.boxes, landmarks.names
+            )
+            face_detections = {name: landmarks.face_dict(name) for name in landmarks.names}
+            print("{} of {} frames had implausible landmarks and were interpolated".format(
+                int(outliers.sum()), len(outliers)))
 
-def process_recent_images():
-    pass
+        # fit the transforms of the whole sequence in a single vectorized pass
+        if align:
+            transforms = dict(zip(
+                landmarks.names, similarity_transforms(points, crop_size(box_size))
+            ))
 
+        # crop or warp and save the frames of the images which were detected
+        detected_paths = [fp for fp in image_paths if image_name(fp) in face_detections]
+        face_detections, render_failures = process_images(
+            detected_paths, manip_dir, predictor_path, draw, crop, box_size, workers, None,
+            frame_sinks, store_path=store_path, store_compression=store_compression,
+            frame_cache_path=frame_cache_path, frame_cache_mode=frame_cache_mode,
+            face_dicts=face_detections, transforms=transforms, timer=timer, readers=readers,
+            writers=writers, read_ahead=read_ahead, output_size=output_size, region_decoder=region_decoder,
+            resample=resample
+        )
+        failures.update(render_failures)
 
-def process_image_PIL(origin_fp, manip_fp, predictor, detector, draw, crop, box_size=2500):
+        return face_detections, failures
+
+    # frames are stored from this process since HDF5 files cannot be safely written
+    # from several processes at once
+    frame_sinks = list(frame_sinks or [])
+    frame_store, frame_cache = None, None
+    transforms = transforms or {}
+    if (store_path is not None or frame_cache_path is not None) and not (crop or transforms):
+        raise ValueError("storing frames requires the images to be cropped or aligned")
+    if store_path is not None:
+        frame_store = FrameStore(store_path, compression=store_compression)
+        frame_sinks.append(lambda file_name, frame, face_dict: frame_store.append_frame(
+            file_name, frame, face_dict,
+            transform_bounds(transforms[file_name], crop_size(box_size))
+            if file_name in transforms else crop_box_from_face(face_dict, box_size)
+        ))
+    if frame_cache_path is not None:
+        frame_cache = RawFrameCache(frame_cache_path, frame_cache_mode)
+        frame_sinks.append(lambda file_name, frame, face_dict: frame_cache.append(frame))
+
+    options = {'draw': draw, 'crop': crop, 'box_size': box_size,
+        'return_frame': bool(frame_sinks), 'detect_scale': detect_scale, 'track': track,
+        'timed': timer is not None, 'backend': backend,
+        'backend_options': backend_options or {}, 'defer_save': writers > 0,
+        'output_size': output_size, 'region_decoder': region_decoder,
+        'resample': resample}
+    cache = None
+    if cache_path:
+        cache = LandmarkCache(cache_path, predictor_path, detection_model_id(
+            backend, options['backend_options'], detect_scale, track
+        ))
+    timer = timer if timer is not None else StageTimer()
+
+    # look up previously detected landmarks so that detection can be skipped
+    tasks, cache_keys = [], {}
+    for orig_fp in image_paths:
+        file_name = image_name(orig_fp)
+        known_face_dict = None
+        if face_dicts is not None:
+            known_face_dict = face_dicts[file_name]
+        elif cache is not None:
+            with timer.stage('cache'):
+                cache_keys[orig_fp] = cache.key(orig_fp, (file_stats or {}).get(orig_fp))
+                known_face_dict = cache.get(cache_keys[orig_fp])
+        manip_fp = None
+        if manip_dir is not None:
+            manip_fp = os.path.join(manip_dir, file_name + ".jpeg")
+        tasks.append((orig_fp, manip_fp, known_face_dict, transforms.get(file_name), None))
+
+    def read_task(task):
+        # only read the images which the workers will decode
+        orig_fp, manip_fp, known_face_dict, transform, _ = task
+        if known_face_dict is not None and manip_fp is None and not options['return_frame']:
+            return task
+        with timer.stage('read'):
+            return orig_fp, manip_fp, known_face_dict, transform, read_file(orig_fp)
+
+    def save_image(PIL_img, file_path):
+        with timer.stage('save'):
+            PIL_img.save(file_path)
+
+    def write_sinks(file_name, frame, face_dict):
+        with timer.stage('store'):
+            for sink in frame_sinks:
+                sink(file_name, frame, face_dict)
+
+    # read the next images ahead of detection on a pool of threads
+    task_stream = prefetch(read_task, tasks, readers, read_ahead) if readers else tasks
+    writer = WriterPool(writers, read_ahead) if writers else None
+
+    # hand out contiguous runs of images so tracking can follow the face and detector
+    # backends see a batch of images at once, shorter runs when every result carries
+    # a frame so the frames in flight stay bounded
+    chunksize = 1
+    if track:
+        chunksize = max(1, len(tasks) // (workers * 4))
+    elif backend != 'hog':
+        chunksize = DETECT_BATCH_SIZE
+    if options['return_frame']:
+        chunksize = min(chunksize, read_ahead * 4)
+
+    face_detections, failures = {}, {}
+    tracked = 0
+    executor = None
+    if workers > 1:
+        executor = ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_worker, initargs=(predictor_path, options)
+        )
+        # submit lazily, unlike executor.map, so only a bounded number of read images
+        # and returned frames are held in memory however large the archive is
+        results = itertools.chain.from_iterable(bounded_map(
+            executor, _process_chunk, chunked(task_stream, chunksize), workers * 2
+        ))
+    else:
+        _init_worker(predictor_path, options)
+        results = itertools.chain.from_iterable(
+            map(_process_chunk, chunked(task_stream, chunksize))
+        )
+
+    try:
+        # set a progress bar to iterate through the results as they are completed
+        images_pbar = tqdm(results, total=len(tasks))
+        for result in images_pbar:
+            file_name = image_name(result['file_path'])
+            images_pbar.set_description("Processed {!r}".format(file_name))
+
+            timer.merge(result['timings'])
+            if result['error'] is not None:
+                failures[file_name] = result['error']
+            else:
+                face_detections[file_name] = result['face_dict']
+                tracked += result['tracked']
+                if cache is not None and result['detected']:
+                    cache.put(cache_keys[result['file_path']], result['file_path'],
+                        result['face_dict'])
+
+                # hand the outputs to the writer threads when there are any
+                if writer is None:
+                    write_sinks(file_name, result['frame'], result['face_dict'])
+                else:
+                    if result['image'] is not None:
+                        writer.save(file_name, save_image, result['image'],
+                            result['manip_fp'])
+                    if frame_sinks:
+                        writer.sink(file_name, write_sinks, file_name, result['frame'],
+                            result['face_dict'])
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        if writer is not None:
+            writer.close()
+        if cache is not None:
+            cache.close()
+        if frame_store is not None:
+            frame_store.close()
+        if frame_cache is not None:
+            frame_cache.close()
+
+    # images which could not be written are failures as well
+    for file_name, error in (writer.errors if writer is not None else {}).items():
+        face_detections.pop(file_name, None)
+        failures[file_name] = error
+
+    # report how often tracking could skip the full frame detection
+    if track:
+        print("Tracking fast path hit {}/{} images".format(tracked, len(tasks)))
+
+    return face_detections, failures
+
+
+def render_frame_cache(frame_cache_path, video_path, frame_rate, size=None, encoder=None):
+    """ Re-renders the frames of a raw frame cache into a video. The frames are memory
+    mapped and handed to the encoder without being copied or decoded, so rendering
+    the same frames at another frame rate is only bound by the encoder.
+
+    :frame_cache_path: A string for the raw frame file written by process_images.
+    :video_path: A valid path for the output video to be saved to.
+    :frame_rate: An integer for the framerate of the video.
+    :size: An optional (width, height) tuple to resize the video to.
+    :encoder: An optional preset name of ENCODER_PRESETS or a dictionary of ffmpeg
+    output options for the video encoder.
+    :return: A string to the output video.
+    """
+
+    os.makedirs(os.path.dirname(video_path) or ".", exist_ok=True)
+    return write_numpy_to_video(video_path, load_raw_frames(frame_cache_path), frame_rate,
+        size=size, encoder=encoder)
+
+
+def process_recent_images(orig_dir, manip_dir, predictor_path, video_path, frame_rate,
+        draw, crop, box_size=2500, workers=1, cache_path=None, index_path=None, encoder=None,
+        encode_segments=1, plan=None, **kwargs):
+    """ A orchestrator function which only processes images that are not yet part of
+    an existing video and appends them to it without re-encoding the earlier frames.
+
+    Every batch of new images is encoded into its own video segment and the segments
+    are losslessly concatenated into the output video. A manifest kept in the output
+    directory tracks which original images each segment contains, so a run with a new
+    video name, such as the default dated name, still continues the same sequence. The
+    manifest is only updated once the segment is encoded and joined. It also records
+    the size and framing of the frames, and a run with other settings starts a new
+    chain of segments from every image since frames of different sizes cannot be
+    joined.
+
+    :orig_dir: A string for valid directory path to input images.
+    :manip_dir: A string for a valid directory path to saved processed images.
+    :predictor_path: A string for a valid path to dlib predictor object.
+    :video_path: A valid path for the output video to be saved to.
+    :frame_rate: An integer for the framerate of the video.
+    :draw: A boolean to indicate if the images should have the detected landmarks drawn.
+    :crop: A boolean to indicate if the images should be cropped.
+    :box_size: An integer with default 2500 to indicate the size of the cropping box.
+    :workers: An integer with default 1 for the number of processes to fan images out to.
+    :cache_path: An optional string for the path of the landmark cache database.
+    :index_path: An optional string for a metadata index used to order the images by
+    capture time instead of modification time.
+    :encoder: An optional preset name of ENCODER_PRESETS or a dictionary of ffmpeg
+    output options for the video encoder. Segments can only be joined losslessly when
+    every run uses the same encoder settings, which are recorded in the manifest.
+    :encode_segments: An integer with default 1 for the number of parts of the new
+    segment encoded in parallel.
+    :plan: An optional RunPlan of orig_dir whose ordered images and stat results are
+    used instead of listing the directory again.
+    :kwargs: Additional detection options passed to process_images.
+    :return: A dictionary of dictionary of facial detections for the new images and a
+    dictionary of file names to the error raised while processing them.
+    """
+
+    # load the manifest of images which are already part of the video
+    manifest_path = _manifest_path(video_path)
+    geometry = {
+        'crop': bool(crop), 'align': bool(kwargs.get('align')),
+        'frame_size': list(kwargs.get('output_size') or crop_size(box_size)),
+    }
+    manifest = _load_manifest(manifest_path, frame_rate, encoder_options(encoder), geometry)
+    if manifest['geometry'] != geometry:
+        print("The frames of {!r} were {}, starting a new video of {} frames".format(
+            video_path, manifest['geometry'], geometry))
+        manifest = _load_manifest(None, frame_rate, encoder_options(encoder), geometry)
+    if manifest['frame_rate'] != frame_rate:
+        raise ValueError("{!r} was encoded at {} fps, rebuild it with process_all_images"
+            .format(video_path, manifest['frame_rate']))
+    if manifest['encoder'] != encoder_options(encoder):
+        raise ValueError("{!r} was encoded with {}, rebuild it with process_all_images"
+            .format(video_path, manifest['encoder']))
+    done_images = {name for segment in manifest['segments'] for name in segment['images']}
+
+    # process only the new images, previously failed images are retried
+    image_paths = _list_images(orig_dir, done_images, index_path, plan)
+    if not image_paths:
+        return {}, {}
+    if plan is not None:
+        kwargs.setdefault('file_stats', plan.stats)
+    # the frame cache keeps the frames of earlier runs so it matches the whole video
+    kwargs.setdefault('frame_cache_mode', 'a' if manifest['segments'] else 'w')
+    face_detections, failures = process_images(
+        image_paths, manip_dir, predictor_path, draw, crop, box_size, workers, cache_path,
+        **kwargs
+    )
+
+    # encode the new frames into a segment in the same order they were processed
+    new_images = [
+        image_name(orig_fp) for orig_fp in image_paths
+        if image_name(orig_fp) in face_detections
+    ]
+    if not new_images:
+        return face_detections, failures
+
+    segment_dir = os.path.join(os.path.dirname(video_path), "segments")
+    os.makedirs(segment_dir, exist_ok=True)
+    segment_path = os.path.join(
+        segment_dir, "segment_{:05d}.mp4".format(len(manifest['segments']))
+    )
+    jpeg_paths = [os.path.join(manip_dir, name + ".jpeg") for name in new_images]
+
+    # join all segments into the output video and only then record the new segment,
+    # a failed encode raises before the manifest is touched. Segment paths are kept
+    # relative to the manifest so the run can start from any working directory.
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_path))
+    segments = manifest['segments'] + [{
+        'path': os.path.relpath(segment_path, manifest_dir), 'images': new_images
+    }]
+    timer = kwargs.get('timer') or StageTimer()
+    with timer.stage('encode'):
+        _write_video(jpeg_paths, segment_path, frame_rate, encoder, encode_segments)
+        concat_videos([
+            os.path.join(manifest_dir, segment['path']) for segment in segments
+        ], video_path)
+    manifest['segments'] = segments
+    with open(manifest_path + ".tmp", 'w') as fp:
+        json.dump(manifest, fp, indent=2)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+    return face_detections, failures
+
+
+def process_image_PIL(origin_fp, manip_fp, predictor, detector, draw, crop, box_size=2500,
+        face_dict=None, timer=None):
     """ A helper function to facilitate the processing of one image
 
     :origin_fp: A string to a valid input image path to be processed.
-    :manip_fp: A string to saved the resulting image to.
+    :manip_fp: A string to saved the resulting image to, or None to not save it.
     :predictor: A dlib predictor object to assist with facial detection.
     :detector: A dlib detector object to assist with facial detection.
     :draw: A boolean to indicate if the image should have the detected landmarks drawn.
     :crop: A boolean to indicate if the image should be cropped.
     :box_size: An integer with default 2500 to indicate the size of the cropping box.
+    :face_dict: An optional dictionary of previously detected landmarks to skip detection.
+    :timer: An optional StageTimer which records the time spent in every stage.
     :return: A dictionary of facial detections.
     """
 
+    timer = timer if timer is not None else StageTimer()
+    face_dict, PIL_img = render_image_PIL(
+        origin_fp, predictor, detector, draw, crop, box_size, face_dict, timer=timer
+    )
+
+    # save the output image
+    if manip_fp is not None:
+        with timer.stage('save'):
+            PIL_img.save(manip_fp)
+
+    return face_dict
+
+
+def render_image_PIL(origin_fp, predictor, detector, draw, crop, box_size=2500,
+        face_dict=None, detect_scale=1, tracker=None, transform=None, timer=None,
+        face_detector=None, data=None, output_size=None, region_decoder=None,
+        resample='bicubic', PIL_img=None):
+    """ A helper function which detects, draws and crops one image in memory
+
+    :origin_fp: A string to a valid input image path to be processed.
+    :predictor: A dlib predictor object to assist with facial detection.
+    :detector: A dlib detector object to assist with facial detection.
+    :draw: A boolean to indicate if the image should have the detected landmarks drawn.
+    :crop: A boolean to indicate if the image should be cropped.
+    :box_size: An integer with default 2500 to indicate the size of the cropping box.
+    :face_dict: An optional dictionary of previously detected landmarks to skip detection.
+    :detect_scale: An integer with default 1 for the factor the image is reduced by
+    before detecting the face bounding box.
+    :tracker: An optional FaceTracker which uses the previous image's face as a prior.
+    :transform: An optional (2, 3) alignment transform to warp the image with instead
+    of cropping it.
+    :timer: An optional StageTimer which records the time spent in every stage.
+    :face_detector: An optional FaceDetector backend used instead of dlib HOG.
+    :data: An optional bytes object of the image file which was already read.
+    :output_size: An optional (width, height) tuple the cropped or aligned frame is
+    resampled to in the same pass.
+    :region_decoder: An optional string for one of REGION_DECODERS to only decode the
+    region of the frame when the landmarks are known.
+    :resample: A string with default 'bicubic' for one of RESAMPLE_FILTERS.
+    :PIL_img: An optional PIL object of the image which was already decoded.
+    :return: A dictionary of facial detections and the processed PIL object.
+    """
+
+    if resample not in RESAMPLE_FILTERS:
+        raise ValueError("unknown resample filter {!r}, expected one of {}"
+            .format(resample, sorted(RESAMPLE_FILTERS)))
+
+    timer = timer if timer is not None else StageTimer()
+    if face_dict is not None and region_decoder is not None and PIL_img is None \
+            and (crop or transform is not None):
+        return face_dict, _render_region(
+            origin_fp, face_dict, draw, box_size, transform, timer, data, output_size,
+            region_decoder, RESAMPLE_FILTERS[resample]
+        )
+
     # load the image to PIL object
-    PIL_img = convert_to_PIL(origin_fp)
+    if PIL_img is None:
+        with timer.stage('decode'):
+            PIL_img = convert_to_PIL(origin_fp, data=data)
+    file_name = os.path.split(origin_fp)[1]
 
     try:
-        # detect the facial landmarks on the given image
-        face_dict = facial_detection_PIL(PIL_img, predictor, detector)
-        file_name = os.path.split(origin_fp)
+        # detect the facial landmarks on the given image unless they were cached
+        if face_dict is None and face_detector is not None:
+            with timer.stage('detect'):
+                face_dict = face_detector.detect(PIL_img.convert('RGB'))
+        elif face_dict is None:
+            # JPEG files can be decoded straight at the reduced detection size and
+            # HEIF files may embed a large enough thumbnail
+            thumbnail = None
+            file_ext = os.path.splitext(origin_fp)[1].lower()
+            with timer.stage('thumbnail'):
+                if detect_scale > 1 and file_ext in JPEG_EXTENSIONS:
+                    thumbnail = convert_to_PIL_thumbnail(origin_fp, detect_scale, data)
+                elif detect_scale > 1 and file_ext in HEIF_EXTENSIONS:
+                    thumbnail = read_heif_thumbnail(
+                        origin_fp if data is None else io.BytesIO(data),
+                        (PIL_img.width // detect_scale, PIL_img.height // detect_scale)
+                    )
+            if tracker is not None:
+                # the fast path detects and predicts in one go so it is timed as a whole
+                with timer.stage('track'):
+                    face_dict = tracker.detect(
+                        PIL_img, detect_scale=detect_scale, thumbnail=thumbnail
+                    )
+            else:
+                face_dict = facial_detection_PIL(
+                    PIL_img, predictor, detector, detect_scale, thumbnail, timer=timer
+                )
     except ValueError as e:
         raise ValueError("{!r} has detected more than 1 face".format(file_name))
     except IOError as e:
@@ -89,17 +640,357 @@ def process_image_PIL(origin_fp, manip_fp, predictor, detector, draw, crop, box_
 
     # draw the detected landmarks
     if draw:
-        draw_facial_points(PIL_img, face_dict[0]['facial_points'], width=3, radius=5)
+        with timer.stage('draw'):
+            draw_facial_points(PIL_img, face_dict[0]['facial_points'], width=3, radius=5)
 
-    # crop the image based on landmarks
-    if crop:
-        PIL_img = crop_image_from_PIL(PIL_img, face_dict, box_size=box_size)
+    # align or crop the image based on landmarks
+    frame_size = output_size or crop_size(box_size)
+    if transform is not None:
+        with timer.stage('align'):
+            PIL_img = align_image_from_PIL(
+                PIL_img, resize_transform(transform, crop_size(box_size), frame_size),
+                frame_size, RESAMPLE_FILTERS[resample]
+            )
+    elif crop:
+        with timer.stage('crop'):
+            PIL_img = crop_image_from_PIL(
+                PIL_img, face_dict, box_size, output_size, RESAMPLE_FILTERS[resample]
+            )
 
-    # store the numpy array in .hdf5
-    store_single_hdf5('temp', PIL_img)
+    return face_dict, PIL_img
 
-    # save the output image
-    PIL_img.save(manip_fp) 
 
-    return face_dict
+def _render_region(origin_fp, face_dict, draw, box_size, transform, timer, data,
+        output_size, region_decoder, resample):
+    """ Crops or aligns an image with known landmarks by decoding only the region of the
+    image covered by the output frame, see render_image_PIL
+
+    :return: The processed PIL object.
+    """
+
+    frame_size = output_size or crop_size(box_size)
+    points = np.asarray(face_dict[0]['facial_points'], dtype=np.float64)
+
+    if transform is not None:
+        transform = resize_transform(transform, crop_size(box_size), frame_size)
+        box = transform_bounds(transform, frame_size)
+    else:
+        box = crop_box_from_face(face_dict, box_size)
+
+    with timer.stage('decode'):
+        PIL_img, offset, factor = decode_region(
+            origin_fp, box, frame_size, region_decoder, data
+        )
+
+    # express the crop box or transform in the pixels of the decoded region
+    if transform is not None:
+        with timer.stage('align'):
+            local = region_transform(transform, offset, factor)
+            PIL_img = align_image_from_PIL(PIL_img, local, frame_size, resample)
+        # the landmarks are mapped with the inverse of the output to input transform
+        points = (points - transform[:, 2]) @ np.linalg.inv(transform[:, :2]).T
+    else:
+        with timer.stage('crop'):
+            local = region_box(box, offset, factor)
+            PIL_img = crop_resize_PIL(PIL_img, local, frame_size, resample)
+        points = (points - box[:2]) * (np.asarray(frame_size) / np.subtract(box[2:], box[:2]))
+
+    # the landmarks are drawn on the output frame so the markers are scaled with it
+    if draw:
+        with timer.stage('draw'):
+            radius = max(1, int(round(5 * frame_size[0] / crop_size(box_size)[0])))
+            draw_points_PIL(PIL_img, np.rint(points), radius)
+
+    return PIL_img
+
+
+def _init_worker(predictor_path, options):
+    """ Loads the dlib predictor/detector once for the current process
+
+    :predictor_path: A string for a valid path to dlib predictor object.
+    :options: A dictionary of processing options shared by every image.
+    """
+
+    predictor, detector = set_up(predictor_path)
+    tracker = FaceTracker(predictor, detector) if options['track'] else None
+    face_detector = None
+    if options['backend'] != 'hog':
+        face_detector = get_detector(
+            options['backend'], predictor_path, **options['backend_options']
+        )
+    _WORKER_STATE.update(
+        predictor=predictor, detector=detector, tracker=tracker,
+        face_detector=face_detector, options=options
+    )
+
+
+def _process_worker(task, detection=None, timer=None):
+    """ Processes a single image with the worker state, capturing any failure
+
+    :task: A tuple of the input image path, the output image path, the known facial
+    detections (or None), the alignment transform (or None) and the file content if it
+    was read ahead (or None).
+    :detection: An optional tuple of the decoded PIL object, the facial detections and
+    the exception raised (or None) when the face was detected in a batch.
+    :timer: An optional StageTimer which already holds timings of the image.
+    :return: A dictionary with the input path, facial detections, whether detection
+    was run, the processed frame (if requested), the processed image and output path
+    (if saving is deferred), the stage timings (if requested) and error message.
+    """
+
+    orig_fp, manip_fp, face_dict, transform, data = task
+    options = _WORKER_STATE['options']
+    tracker = _WORKER_STATE['tracker']
+    timer = timer if timer is not None else StageTimer()
+    result = {'file_path': orig_fp, 'face_dict': None, 'detected': face_dict is None,
+        'tracked': False, 'frame': None, 'image': None, 'manip_fp': manip_fp, 'timings': {},
+        'error': None}
+    # nothing needs to be decoded when the landmarks are known and no output is wanted
+    if face_dict is not None and manip_fp is None and not options['return_frame']:
+        result['face_dict'] = face_dict
+        return result
+
+    PIL_img, error = None, None
+    if detection is not None:
+        PIL_img, face_dict, error = detection
+
+    try:
+        if error is not None:
+            raise error
+        face_dict, PIL_img = render_image_PIL(
+            orig_fp, _WORKER_STATE['predictor'], _WORKER_STATE['detector'], options['draw'],
+            options['crop'], options['box_size'], face_dict, options['detect_scale'], tracker,
+            transform, timer, _WORKER_STATE['face_detector'], data, options['output_size'],
+            options['region_decoder'], options['resample'], PIL_img
+        )
+        result['tracked'] = result['detected'] and tracker is not None and tracker.last_hit
+
+        # save the output image and hand the frame back if it is needed downstream
+        if manip_fp is not None and options['defer_save']:
+            result['image'] = PIL_img
+        elif manip_fp is not None:
+            with timer.stage('save'):
+                PIL_img.save(manip_fp)
+        if options['return_frame']:
+            with timer.stage('frame'):
+                result['frame'] = np.asarray(PIL_img.convert('RGB'))
+
+        result['face_dict'] = face_dict
+    except Exception as err:
+        result['error'] = "{}: {}".format(type(err).__name__, err)
+
+    # only send the timings back when they are collected, the decode timings of every
+    # format are kept as a breakdown of the decode stage
+    decode_timings = take_decode_timings()
+    if options['timed']:
+        for kind, seconds in decode_timings.items():
+            timer.durations['decode:' + kind].extend(seconds)
+        result['timings'] = dict(timer.durations)
+
+    return result
+
+
+def _process_chunk(tasks):
+    """ Processes a contiguous run of images in order with the worker state. With a
+    detector backend the faces of every image of the run are detected in one batch
+    before the images are rendered one by one.
+
+    :tasks: A list of tasks as accepted by _process_worker.
+    :return: A list of the result dictionaries of _process_worker.
+    """
+
+    if _WORKER_STATE['face_detector'] is None:
+        return [_process_worker(task) for task in tasks]
+
+    timers = [StageTimer() for _ in tasks]
+    detections = _detect_chunk(tasks, timers)
+    return [
+        _process_worker(task, detections.get(i), timers[i]) for i, task in enumerate(tasks)
+    ]
+
+
+def _detect_chunk(tasks, timers):
+    """ Decodes the images of a chunk whose landmarks are unknown and detects their
+    faces with a single detect_batch call of the detector backend. The time of the
+    batch is shared evenly between its images so 'detect' stays a per image stage.
+
+    :tasks: A list of tasks as accepted by _process_worker.
+    :timers: A list of a StageTimer per task.
+    :return: A dictionary of task indices to a tuple of the decoded PIL object (or
+    None), the facial detections (or None) and the exception raised (or None).
+    """
+
+    detections, decoded = {}, []
+    for i, (orig_fp, _, face_dict, _, data) in enumerate(tasks):
+        if face_dict is not None:
+            continue
+        try:
+            with timers[i].stage('decode'):
+                decoded.append((i, convert_to_PIL(orig_fp, data=data)))
+        except Exception as err:
+            detections[i] = (None, None, err)
+    if not decoded:
+        return detections
+
+    batch_timer, error = StageTimer(), None
+    try:
+        with batch_timer.stage('detect'):
+            boxes, landmarks = _WORKER_STATE['face_detector'].detect_batch(
+                [PIL_img.convert('RGB') for _, PIL_img in decoded]
+            )
+    except Exception as err:
+        error = err
+    seconds = batch_timer.durations['detect'][0] / len(decoded)
+
+    for k, (i, PIL_img) in enumerate(decoded):
+        timers[i].durations['detect'].append(seconds)
+        if error is not None:
+            detections[i] = (PIL_img, None, error)
+            continue
+
+        # the same errors render_image_PIL raises for a single image
+        file_name = os.path.split(tasks[i][0])[1]
+        try:
+            detections[i] = (PIL_img, face_dict_from_arrays(boxes[k], landmarks[k]), None)
+        except ValueError:
+            detections[i] = (PIL_img, None,
+                ValueError("{!r} has detected more than 1 face".format(file_name)))
+        except IOError:
+            detections[i] = (PIL_img, None,
+                ValueError("{!r} has detected no faces".format(file_name)))
+
+    return detections
+
+
+def encoded_images(video_path):
+    """ Lists the images which are already part of an incrementally built video
+
+    :video_path: A valid path of the output video.
+    :return: A set of the file names in the segments of the video manifest.
+    """
+
+    manifest = _load_manifest(_manifest_path(video_path), None)
+    return {name for segment in manifest['segments'] for name in segment['images']}
+
+
+def _list_images(orig_dir, prev_images=None, index_path=None, plan=None):
+    """ Lists the input images of a directory ordered by capture time when a metadata
+    index is given and by modification time otherwise
+
+    :orig_dir: A string for valid directory path to input images.
+    :prev_images: An optional collection of file names to leave out.
+    :index_path: An optional string for the path of the metadata index.
+    :plan: An optional RunPlan whose images, already listed and ordered, are used.
+    Only prev_images are left out, not the done images of the plan.
+    :return: A list of strings to the input image paths.
+    """
+
+    if plan is not None:
+        # the plan only refreshed the metadata index in memory
+        if plan.index is not None:
+            plan.index.save()
+        return [
+            orig_fp for orig_fp in plan.listed_paths
+            if prev_images is None or image_name(orig_fp) not in prev_images
+        ]
+
+    # only images which can be decoded, other files such as .AAE sidecars or videos
+    # would otherwise fail every run
+    valid_images = [
+        file_path for file_path in iglob(os.path.join(orig_dir, "*.*"))
+        if os.path.splitext(file_path)[1].lower() in IMAGE_EXTENSIONS
+    ]
+    if index_path is not None:
+        # only the headers of new or changed files are read to refresh the index
+        index = MetadataIndex(index_path)
+        sorted_images = index.sorted_paths(valid_images)
+        index.save()
+    else:
+        sorted_images = sorted(valid_images, key=os.path.getmtime)
+
+    return [
+        orig_fp for orig_fp in sorted_images
+        if prev_images is None or image_name(orig_fp) not in prev_images
+    ]
+
+
+def _encode_frame_queue(video_path, frame_queue, frame_rate, encoder, timer, errors):
+    """ Encodes the frames of a queue into a video on the encoder thread of a stream,
+    timing the whole encode as the 'encode' stage. It runs alongside the other stages
+    so its time overlaps theirs.
+
+    :video_path: A string for the path of the video.
+    :frame_queue: A queue.Queue of frames ending with None.
+    :frame_rate: An integer for the frame rate of the video.
+    :encoder: An optional preset name of ENCODER_PRESETS or a dictionary of ffmpeg
+    output options for the video encoder.
+    :timer: A StageTimer which records the encode.
+    :errors: A list the exception of a failed encode is appended to, since it would
+    otherwise be lost with the thread.
+    """
+
+    try:
+        with timer.stage('encode'):
+            write_frame_queue_to_video(video_path, frame_queue, frame_rate, encoder=encoder)
+    except Exception as err:
+        errors.append(err)
+
+
+def _write_video(jpeg_paths, video_path, frame_rate, encoder=None, encode_segments=1):
+    """ Encodes an ordered list of processed images, in parallel segments if asked to
+
+    :jpeg_paths: A list of strings to the processed .jpeg images in play order.
+    :video_path: A valid path for the output video to be saved to.
+    :frame_rate: An integer for the framerate of the video.
+    :encoder: An optional preset name of ENCODER_PRESETS or a dictionary of ffmpeg
+    output options for the video encoder.
+    :encode_segments: An integer with default 1 for the number of segments encoded in
+    parallel.
+    :return: A string to the output video.
+    """
+
+    os.makedirs(os.path.dirname(video_path) or ".", exist_ok=True)
+    if encode_segments > 1:
+        return write_jpeg_list_to_video_parallel(
+            jpeg_paths, video_path, frame_rate, encoder=encoder, segments=encode_segments
+        )
+
+    return write_jpeg_list_to_video(jpeg_paths, video_path, frame_rate, encoder=encoder)
+
+
+def _manifest_path(video_path):
+    """ Locates the manifest of the incrementally built videos of an output directory.
+    The manifest is shared by every video name in the directory, so daily runs with
+    dated video names keep appending to the same sequence.
+
+    :video_path: A valid path of the output video.
+    :return: A string for the path of the manifest JSON file.
+    """
+
+    return os.path.join(os.path.dirname(video_path), "incremental.manifest.json")
+
+
+def _load_manifest(manifest_path, frame_rate, encoder=None, geometry=None):
+    """ Loads the manifest of an incrementally built video
+
+    :manifest_path: A string for the path of the manifest JSON file, or None for the
+    manifest of a new video.
+    :frame_rate: An integer for the framerate used if the manifest does not exist.
+    :encoder: An optional dictionary of the ffmpeg output options used if the manifest
+    does not exist or predates recording them.
+    :geometry: An optional dictionary of the size and framing of the frames used if
+    the manifest does not exist or predates recording it.
+    :return: A dictionary with the frame rate, the encoder options, the frame geometry
+    and the list of encoded segments, whose paths are relative to the manifest.
+    """
+
+    if manifest_path is None or not os.path.exists(manifest_path):
+        return {'frame_rate': frame_rate, 'encoder': encoder, 'geometry': geometry,
+            'segments': []}
+
+    with open(manifest_path) as fp:
+        manifest = json.load(fp)
+    manifest.setdefault('encoder', encoder)
+    manifest.setdefault('geometry', geometry)
 
+    return manifest
@@ -0,0 +1,158 @@
+
+# Standard library imports
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Third party library imports
+
+# Local library imports
+
+
+def read_file(file_path):
+    """ Reads the whole content of a file, which lets slow storage such as a network
+    mount be read ahead on a separate thread
+
+    :param file_path: A string to a valid file.
+    :return: A bytes object of the file content.
+    """
+
+    with open(file_path, 'rb') as f:
+        return f.read()
+
+
+def prefetch(func, items, threads=4, depth=8):
+    """ Applies a function to items on a pool of threads which runs at most depth items
+    ahead of the consumer, yielding the results in order. The bounded window applies
+    backpressure so a slow consumer never causes everything to be read into memory.
+
+    :param func: A callable applied to every item.
+    :param items: An iterable of items.
+    :param threads: An integer with default 4 for the number of threads.
+    :param depth: An integer with default 8 for the number of results kept ahead.
+    :return: A generator of the results in the order of the items.
+    """
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        yield from bounded_map(pool, func, items, depth)
+
+
+def chunked(items, size):
+    """ Groups items into lists of a fixed size, the last list holding the remainder
+
+    :param items: An iterable of items.
+    :param size: An integer for the number of items per list.
+    :return: A generator of lists of items.
+    """
+
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def bounded_map(executor, func, items, depth=8):
+    """ Submits a function over items to an executor keeping at most depth items in
+    flight, yielding the results in order. Unlike Executor.map the items are consumed
+    lazily, so a generator of prefetched items is only drained as fast as it is used.
+
+    :param executor: A concurrent.futures executor.
+    :param func: A callable applied to every item.
+    :param items: An iterable of items.
+    :param depth: An integer with default 8 for the number of items in flight.
+    :return: A generator of the results in the order of the items.
+    """
+
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(func, item))
+        if len(pending) >= depth:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+class WriterPool:
+    """ Moves the output of processed images off the processing loop. Images are saved
+    on a pool of threads while sinks, such as HDF5 appends which must happen in order
+    from one thread, run on a single dedicated thread. Both keep a bounded number of
+    writes in flight so the processing loop blocks once storage falls behind.
+    """
+
+    def __init__(self, threads=2, depth=8):
+        """ Starts the writer threads
+
+        :param threads: An integer with default 2 for the number of image save threads.
+        :param depth: An integer with default 8 for the writes in flight per pool.
+        """
+
+        self.depth = depth
+        self.errors = {}
+        self._saver = ThreadPoolExecutor(max_workers=threads)
+        self._sinker = ThreadPoolExecutor(max_workers=1)
+        self._saves = deque()
+        self._sinks = deque()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def save(self, name, func, *args):
+        """ Calls a write, such as saving an image, on the save threads in any order
+
+        :param name: A string for the file name failures are recorded under.
+        :param func: A callable which writes the output.
+        :param args: Arguments passed to the callable.
+        """
+
+        self._submit(self._saver, self._saves, name, func, *args)
+
+    def sink(self, name, func, *args):
+        """ Calls a sink on the sink thread, in the order the sinks were submitted
+
+        :param name: A string for the file name failures are recorded under.
+        :param func: A callable which writes the output.
+        :param args: Arguments passed to the callable.
+        """
+
+        self._submit(self._sinker, self._sinks, name, func, *args)
+
+    def close(self):
+        """ Waits for every outstanding write and stops the threads """
+
+        for pending in (self._saves, self._sinks):
+            while pending:
+                self._wait(pending)
+        self._saver.shutdown()
+        self._sinker.shutdown()
+
+    def _submit(self, executor, pending, name, func, *args):
+        """ Submits a write, first waiting for the oldest one when too many are in flight
+
+        :param executor: The executor to run the write on.
+        :param pending: A deque of the (name, future) writes in flight.
+        :param name: A string for the file name failures are recorded under.
+        :param func: A callable which writes the output.
+        :param args: Arguments passed to the callable.
+        """
+
+        if len(pending) >= self.depth:
+            self._wait(pending)
+        pending.append((name, executor.submit(func, *args)))
+
+    def _wait(self, pending):
+        """ Waits for the oldest write in flight, recording its failure
+
+        :param pending: A deque of the (name, future) writes in flight.
+        """
+
+        name, future = pending.popleft()
+        try:
+            future.result()
+        except Exception as err:
+            self.errors[name] = "{}: {}".format(type(err).__name__, err)
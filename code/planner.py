@@ -0,0 +1,240 @@
+
+# Standard library imports
+import json
+import os
+
+# Third party library imports
+
+# Local library imports
+from .input_interpreter import image_name, IMAGE_EXTENSIONS
+from .landmark_cache import LandmarkCache, detection_model_id
+from .metadata_index import MetadataIndex
+
+
+# stages which only run for images whose landmarks are not cached
+DETECT_STAGES = ('thumbnail', 'detect', 'predict', 'track')
+
+# stages which run once for the whole video, their cost scales with the frame count
+VIDEO_STAGES = ('encode',)
+
+
+class RunPlan:
+    """ The work a run is going to do, worked out from a single listing of the input
+    directory and one stat call per image without decoding any image. The plan is
+    printed by --plan and otherwise handed to the run, which then reuses its ordered
+    image paths and stat results instead of listing and stat'ing the files again.
+    """
+
+    def __init__(self, image_paths, stats, cached=(), failed=(), current_outputs=(),
+            done_images=(), history=None, index=None, listed_paths=None):
+        """ Holds the outcome of build_plan
+
+        :param image_paths: A list of strings to the input images to process, in order.
+        :param stats: A dictionary of image paths to their os.stat results.
+        :param cached: A collection of image paths whose landmarks are cached.
+        :param failed: A collection of file names which failed in the previous run.
+        :param current_outputs: A collection of image paths whose processed image in
+        the output directory is newer than the image.
+        :param done_images: A collection of file names which are already part of the
+        video and are left out of an incremental run.
+        :param history: An optional dictionary of the run report of the previous run.
+        :param index: An optional MetadataIndex refreshed in memory, which the run
+        saves once it uses the plan.
+        :param listed_paths: An optional list of strings to every input image in order,
+        including the done images, defaults to image_paths.
+        """
+
+        self.image_paths = image_paths
+        self.stats = stats
+        self.cached = set(cached)
+        self.failed = set(failed)
+        self.current_outputs = set(current_outputs)
+        self.done_images = set(done_images)
+        self.history = history
+        self.index = index
+        self.listed_paths = image_paths if listed_paths is None else listed_paths
+
+    def __len__(self):
+        return len(self.image_paths)
+
+    def status(self, file_path):
+        """ Classifies an image of the plan
+
+        :param file_path: A string to an input image of the plan.
+        :return: A string, 'cached' when its landmarks are cached, 'failed' when it
+        failed in the previous run and 'new' otherwise.
+        """
+
+        if file_path in self.cached:
+            return 'cached'
+        if image_name(file_path) in self.failed:
+            return 'failed'
+        return 'new'
+
+    def counts(self):
+        """ Counts the images of the plan by status and output
+
+        :return: A dictionary of the number of images to process, the number which are
+        new, cached and failed, the number with a current or a missing (or stale)
+        processed image and the number already part of the video.
+        """
+
+        counts = {'images': len(self), 'new': 0, 'cached': 0, 'failed': 0}
+        for file_path in self.image_paths:
+            counts[self.status(file_path)] += 1
+        counts['current_outputs'] = sum(fp in self.current_outputs for fp in self.image_paths)
+        counts['missing_outputs'] = len(self) - counts['current_outputs']
+        counts['already_encoded'] = len(self.done_images)
+
+        return counts
+
+    def estimate(self, workers=1):
+        """ Estimates the seconds every stage of the run will take from the mean stage
+        timings of the previous run. Detection stages are only counted for images
+        whose landmarks are not cached and per image stages are shared between the
+        worker processes.
+
+        :param workers: An integer with default 1 for the number of processes.
+        :return: A dictionary of stage names to estimated seconds together with the
+        'total', or None without the stage timings of a previous run.
+        """
+
+        if not self.history or not self.history.get('stages'):
+            return None
+
+        to_detect = sum(fp not in self.cached for fp in self.image_paths)
+        estimate = {}
+        for name, stats in self.history['stages'].items():
+            # breakdowns such as 'decode:jpeg' are already counted in their stage
+            if ':' in name:
+                continue
+            if name in VIDEO_STAGES:
+                # the video is encoded from every processed image of the run
+                estimate[name] = stats['total'] * len(self) / max(self.history['images'], 1)
+            else:
+                runs = to_detect if name in DETECT_STAGES else len(self)
+                estimate[name] = stats['total'] / stats['count'] * runs / max(workers, 1)
+        estimate['total'] = sum(estimate.values())
+
+        return estimate
+
+    def describe(self, workers=1):
+        """ Formats the plan for printing
+
+        :param workers: An integer with default 1 for the number of processes.
+        :return: A string of the counts and estimated stage timings of the plan.
+        """
+
+        counts = self.counts()
+        lines = [
+            "{images} images to process: {new} new, {cached} cached, {failed} failed "
+            "previously".format(**counts),
+            "{current_outputs} processed images are current, {missing_outputs} are "
+            "missing or stale".format(**counts),
+        ]
+        if counts['already_encoded']:
+            lines.append("{already_encoded} images are already part of the video"
+                .format(**counts))
+
+        estimate = self.estimate(workers)
+        if estimate is None:
+            lines.append("No run report of a previous run to estimate the timings from")
+        else:
+            lines.append("Estimated {:.0f} s with {} worker(s):".format(
+                estimate.pop('total'), workers))
+            for name, seconds in sorted(estimate.items(), key=lambda item: -item[1]):
+                lines.append("  {:<12} {:>10.1f} s".format(name, seconds))
+
+        return "\n".join(lines)
+
+
+def build_plan(orig_dir, manip_dir=None, predictor_path=None, cache_path=None,
+        index_path=None, backend='hog', backend_options=None, report_path=None,
+        done_images=None, detect_scale=1, track=False):
+    """ Plans a run by listing and stat'ing the input images once. The landmark cache
+    is checked by file path, size and modification time, so no image is hashed, read
+    or decoded. Only the headers of images missing from the metadata index are read.
+    Nothing is written, the refreshed index is only saved by the run using the plan.
+
+    :param orig_dir: A string for valid directory path to input images.
+    :param manip_dir: An optional string for the directory of processed images.
+    :param predictor_path: An optional string for a valid path to dlib predictor
+    object, required to check the landmark cache.
+    :param cache_path: An optional string for the path of the landmark cache database.
+    :param index_path: An optional string for a metadata index used to order the images
+    by capture time instead of modification time.
+    :param backend: A string with default 'hog' for the detector backend of the run.
+    :param backend_options: An optional dictionary of keyword arguments of the backend.
+    :param report_path: An optional string for the JSON run report of the previous run,
+    which holds its stage timings and failures.
+    :param done_images: An optional collection of file names to leave out, such as the
+    images already part of an incrementally built video.
+    :param detect_scale: An integer with default 1 for the detection reduction factor
+    of the run, which is part of the cache key.
+    :param track: A boolean with default False for whether the run tracks faces.
+    :return: A RunPlan of the run.
+    """
+
+    # a single listing of the images the run can decode, the stat results are reused
+    # for ordering and cache checks
+    stats = {}
+    with os.scandir(orig_dir) as entries:
+        for entry in entries:
+            file_ext = os.path.splitext(entry.name)[1].lower()
+            if file_ext in IMAGE_EXTENSIONS and not entry.name.startswith('.'):
+                stats[os.path.join(orig_dir, entry.name)] = entry.stat()
+
+    index = None
+    if index_path is not None:
+        index = MetadataIndex(index_path)
+        image_paths = index.sorted_paths(list(stats), stats)
+    else:
+        image_paths = sorted(stats, key=lambda file_path: stats[file_path].st_mtime)
+    listed_paths = image_paths
+    done_images = set(done_images or ())
+    image_paths = [fp for fp in image_paths if image_name(fp) not in done_images]
+
+    # a missing cache is not created just to find out that nothing is cached
+    cached = set()
+    if cache_path and predictor_path and os.path.exists(cache_path):
+        model_id = detection_model_id(backend, backend_options, detect_scale, track)
+        with LandmarkCache(cache_path, predictor_path, model_id) as cache:
+            stat_keys = cache.stat_keys()
+        cached = {
+            fp for fp in image_paths
+            if (os.path.abspath(fp), stats[fp].st_size, stats[fp].st_mtime_ns) in stat_keys
+        }
+
+    # processed images which are newer than their input image
+    current_outputs = set()
+    if manip_dir is not None and os.path.isdir(manip_dir):
+        with os.scandir(manip_dir) as entries:
+            output_mtimes = {
+                image_name(entry.name): entry.stat().st_mtime_ns for entry in entries
+                if entry.name.endswith('.jpeg')
+            }
+        current_outputs = {
+            fp for fp in image_paths
+            if output_mtimes.get(image_name(fp), -1) >= stats[fp].st_mtime_ns
+        }
+
+    history = load_run_report(report_path) if report_path else None
+    failed = history.get('failures', []) if history else []
+
+    return RunPlan(image_paths, stats, cached, failed, current_outputs, done_images,
+        history, index, listed_paths)
+
+
+def load_run_report(report_path):
+    """ Loads the JSON run report written by write_run_report
+
+    :param report_path: A string for the path of the run report.
+    :return: A dictionary of the run report, or None if there is no JSON report.
+    """
+
+    if not report_path.lower().endswith('.json') or not os.path.exists(report_path):
+        return None
+
+    with open(report_path) as fp:
+        return json.load(fp)
+
@@ -0,0 +1,62 @@
+
+# Standard library imports
+from functools import lru_cache
+
+# Third party library imports
+import numpy as np
+
+from PIL import Image, ImageDraw
+
+# Local library imports
+
+
+@lru_cache(maxsize=None)
+def stamp_offsets(radius=5):
+    """ Precomputes the pixel offsets of a filled landmark marker. The marker is drawn
+    once with ImageDraw.ellipse filling the box [x-r, y-r, x+r, y+r], so the stamp
+    covers exactly the pixels of the per point ellipses of the installed Pillow.
+
+    :param radius: An integer with default 5 for the radius of the marker.
+    :return: A read only (K, 2) int array of x, y offsets from the marker centre.
+    """
+
+    mask = Image.new('1', (2 * radius + 1, 2 * radius + 1), 0)
+    ImageDraw.Draw(mask).ellipse([0, 0, 2 * radius, 2 * radius], fill=1)
+    dy, dx = np.nonzero(np.asarray(mask))
+    offsets = np.stack([dx - radius, dy - radius], axis=1)
+    offsets.setflags(write=False)
+
+    return offsets
+
+
+def stamp_coords(points, size, radius=5):
+    """ Places the marker stamp on every landmark, dropping pixels outside the image
+
+    :param points: A (..., 2) array of x, y landmark coordinates.
+    :param size: A (width, height) tuple of the image size.
+    :param radius: An integer with default 5 for the radius of the marker.
+    :return: A (M, 2) int array of the x, y pixels covered by the markers.
+    """
+
+    points = np.asarray(points, dtype=int).reshape(-1, 2)
+    coords = (points[:, np.newaxis, :] + stamp_offsets(radius)).reshape(-1, 2)
+    inside = (coords[:, 0] >= 0) & (coords[:, 0] < size[0]) \
+        & (coords[:, 1] >= 0) & (coords[:, 1] < size[1])
+
+    return coords[inside]
+
+
+def draw_points_PIL(PIL_img, points, radius=5, fill='#00FF00'):
+    """ Draws every landmark marker on a PIL object in a single draw call
+
+    :param PIL_img: A PIL object of the image, which is drawn on in place.
+    :param points: A (..., 2) array of x, y landmark coordinates.
+    :param radius: An integer with default 5 for the radius of the marker.
+    :param fill: A colour string with default '#00FF00' for the markers.
+    :return: The PIL object with the markers drawn.
+    """
+
+    coords = stamp_coords(points, PIL_img.size, radius)
+    ImageDraw.Draw(PIL_img).point(coords.ravel().tolist(), fill=fill)
+
+    return PIL_img
@@ -0,0 +1,2 @@
+# pytest puts the directory of this file on sys.path, so the tests import the local
+# code package rather than the code module of the standard library
@@ -1,54 +1,188 @@
 
 # standard library imports
 import argparse
-import json
+import contextlib
 import os
+import time
 
 from datetime import date
 from configparser import ConfigParser
 
 # local library imports
-from code.orchestrator import process_all_images
-
-
-# set up command line argument parser
-ap = argparse.ArgumentParser()
-ap.add_argument("-s", "--save", required=False, action="store_true",
-    help="A boolean for saving the detected facial landmarks")
-ap.add_argument("-d", "--draw", required=False, action="store_true",
-    help="A boolean for drawing detected faces on images")
-ap.add_argument("-c", "--crop", required=False, action="store_true",
-    help="A boolean for croping images")
-ap.add_argument("-n", "--name", required=False, 
-    default="video_{}".format(date.today()),
-    help="A string for the name of the video")
-ap.add_argument("-r", "--rate", required=False, default=10,
-    help="An integer detailing the number of frames in a video")
-ap.add_argument("-o", "--output", required=False, default="./videos",
-    help="A string for the file directory to output video")
-args = vars(ap.parse_args())
-
-# set up configuration parser and read config file
-config = ConfigParser()
-config.read("config.ini")
-
-# initialize command line arguments and configuration variables
-SAVE = args['save']
-DRAW = args['draw']
-CROP = args['crop']
-VIDEO_PATH = os.path.join(args['output'], str(args['rate']), args['name'] + '.mp4')
-FRAME_RATE = args['rate']
-
-ORIGINAL_DIR = config['Paths']['original_dir']
-MANIPULATED_DIR = config['Paths']['manipulated_dir']
-PREDICTOR_PATH = config['Paths']['HOG_predictor_path']
-
-# process all images in the input directory
-face_detections = process_all_images(ORIGINAL_DIR, MANIPULATED_DIR, PREDICTOR_PATH, 
-        VIDEO_PATH, FRAME_RATE, DRAW, CROP)
-
-# if prompted then save facial detections for later usage
-if SAVE:
-    with open('face_data.json', 'w') as fp:
-        json.dump(face_detections, fp)
+from code.detectors import DETECTORS, detector_options
+from code.image_alignment import ENCODER_PRESETS, RESAMPLE_FILTERS
+from code.instrumentation import StageTimer, profiled, write_run_report
+from code.landmark_cache import LandmarkCache
+from code.landmark_store import LandmarkStore
+from code.orchestrator import process_all_images, process_recent_images, render_frame_cache, \
+    encoded_images
+from code.planner import build_plan
 
+
+if __name__ == "__main__":
+
+    # set up command line argument parser
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-s", "--save", required=False, action="store_true",
+        help="A boolean for saving the detected facial landmarks to face_data/")
+    ap.add_argument("-d", "--draw", required=False, action="store_true",
+        help="A boolean for drawing detected faces on images")
+    ap.add_argument("-c", "--crop", required=False, action="store_true",
+        help="A boolean for croping images")
+    ap.add_argument("-a", "--align", required=False, action="store_true",
+        help="A boolean for aligning faces with a similarity transform instead of cropping")
+    ap.add_argument("--smooth", required=False, default=None,
+        choices=['savgol', 'one_euro', 'kalman'],
+        help="A string for the temporal filter applied to the landmarks before cropping")
+    ap.add_argument("-n", "--name", required=False, 
+        default="video_{}".format(date.today()),
+        help="A string for the name of the video")
+    ap.add_argument("-r", "--rate", required=False, type=int, default=10,
+        help="An integer detailing the number of frames in a video")
+    ap.add_argument("-o", "--output", required=False, default="./videos",
+        help="A string for the file directory to output video")
+    ap.add_argument("-w", "--workers", required=False, type=int, default=1,
+        help="An integer for the number of processes used to process images")
+    ap.add_argument("-l", "--cache", required=False, default="landmark_cache.db",
+        help="A string for the landmark cache database, empty to disable caching")
+    ap.add_argument("-i", "--incremental", required=False, action="store_true",
+        help="A boolean for only processing new images and appending them to the video")
+    ap.add_argument("--stream", required=False, action="store_true",
+        help="A boolean for piping cropped frames straight into the video encoder")
+    ap.add_argument("--detect-scale", required=False, type=int, default=1,
+        help="An integer for the factor images are reduced by before detecting faces")
+    ap.add_argument("-t", "--track", required=False, action="store_true",
+        help="A boolean for reusing the previous image's face box as a detection prior")
+    ap.add_argument("--store", required=False, default=None,
+        help="A string for an HDF5 file to append the cropped frames and landmarks to")
+    ap.add_argument("--store-compression", required=False, default=None,
+        choices=["lzf", "gzip"], help="A string for the HDF5 frame compression")
+    ap.add_argument("--frame-cache", required=False, default=None,
+        help="A string for a raw frame file to write the cropped frames to")
+    ap.add_argument("--render-only", required=False, action="store_true",
+        help="A boolean for only re-rendering the video from --frame-cache at --rate")
+    ap.add_argument("-m", "--metadata-index", required=False, default="metadata_index.json",
+        help="A string for the capture time index used to order images, empty to use mtime")
+    ap.add_argument("--vacuum-cache", required=False, action="store_true",
+        help="A boolean for evicting cache entries whose images are gone and exiting")
+    ap.add_argument("--readers", required=False, type=int, default=0,
+        help="An integer for the number of threads reading images ahead of detection")
+    ap.add_argument("--writers", required=False, type=int, default=0,
+        help="An integer for the number of threads saving and storing processed images")
+    ap.add_argument("-b", "--backend", required=False, default=None,
+        choices=sorted(DETECTORS),
+        help="A string for the face detector backend, defaults to [Detection] in config.ini")
+    ap.add_argument("--output-size", required=False, type=int, nargs=2, default=None,
+        metavar=("WIDTH", "HEIGHT"),
+        help="Two integers the cropped or aligned frames are resized to, e.g. 1080 1404")
+    ap.add_argument("--resample", required=False, default="bicubic",
+        choices=sorted(RESAMPLE_FILTERS),
+        help="A string for the resampling filter used to crop or align the frames")
+    ap.add_argument("-e", "--encoder", required=False, default=None,
+        choices=sorted(ENCODER_PRESETS),
+        help="A string for the x264 encoder preset, defaults to the ffmpeg settings")
+    ap.add_argument("--encode-segments", required=False, type=int, default=1,
+        help="An integer for the number of video segments encoded in parallel")
+    ap.add_argument("--region-decode", required=False, default=None,
+        choices=["pil", "turbojpeg"],
+        help="A string for decoding only the frame region of images with cached landmarks")
+    ap.add_argument("--plan", required=False, action="store_true",
+        help="A boolean for only printing the work and estimated time of the run")
+    ap.add_argument("--report", required=False, default="run_report.json",
+        help="A string for the JSON (or .csv) run report of stage timings, empty to disable")
+    ap.add_argument("--profile", required=False, nargs="?", const="profile.prof",
+        default=None, help="A string for a cProfile output file, use with -w 1 to see workers")
+    args = vars(ap.parse_args())
+
+    # set up configuration parser and read config file
+    config = ConfigParser()
+    config.read("config.ini")
+
+    # initialize command line arguments and configuration variables
+    SAVE = args['save']
+    DRAW = args['draw']
+    CROP = args['crop']
+    VIDEO_PATH = os.path.join(args['output'], str(args['rate']), args['name'] + '.mp4')
+    FRAME_RATE = args['rate']
+    WORKERS = args['workers']
+    CACHE_PATH = args['cache']
+    INDEX_PATH = args['metadata_index'] or None
+    BACKEND = args['backend'] or config.get('Detection', 'backend', fallback='hog')
+
+    ORIGINAL_DIR = config['Paths']['original_dir']
+    MANIPULATED_DIR = config['Paths']['manipulated_dir']
+    PREDICTOR_PATH = config['Paths']['HOG_predictor_path']
+
+    # if prompted then only clean up the landmark cache
+    if args['vacuum_cache']:
+        with LandmarkCache(CACHE_PATH, PREDICTOR_PATH) as cache:
+            print("Evicted {} stale cache entries".format(cache.vacuum()))
+        raise SystemExit(0)
+
+    # if prompted then only re-render the cached frames at the requested frame rate
+    if args['render_only']:
+        if args['frame_cache'] is None:
+            ap.error("--render-only requires --frame-cache")
+        render_frame_cache(args['frame_cache'], VIDEO_PATH, FRAME_RATE,
+            size=tuple(args['output_size']) if args['output_size'] else None,
+            encoder=args['encoder'])
+        raise SystemExit(0)
+
+    # list and stat the input images once, the plan then drives the run
+    PLAN = build_plan(ORIGINAL_DIR, MANIPULATED_DIR, PREDICTOR_PATH, CACHE_PATH, INDEX_PATH,
+        BACKEND, detector_options(config, BACKEND), args['report'] or None,
+        encoded_images(VIDEO_PATH) if args['incremental'] else None, args['detect_scale'],
+        args['track'])
+
+    # if prompted then only print the plan without processing any image
+    if args['plan']:
+        print(PLAN.describe(WORKERS))
+        raise SystemExit(0)
+
+    # options shared by full and incremental runs
+    OPTIONS = {
+        'workers': WORKERS, 'cache_path': CACHE_PATH, 'index_path': INDEX_PATH,
+        'encoder': args['encoder'], 'encode_segments': args['encode_segments'],
+        'detect_scale': args['detect_scale'], 'track': args['track'],
+        'store_path': args['store'], 'store_compression': args['store_compression'],
+        'frame_cache_path': args['frame_cache'], 'align': args['align'],
+        'smooth': args['smooth'], 'backend': BACKEND,
+        'backend_options': detector_options(config, BACKEND),
+        'readers': args['readers'], 'writers': args['writers'],
+        'region_decoder': args['region_decode'], 'resample': args['resample'],
+        'output_size': tuple(args['output_size']) if args['output_size'] else None,
+        'timer': StageTimer() if args['report'] else None, 'plan': PLAN,
+    }
+
+    # process all (or only the new) images in the input directory
+    start = time.perf_counter()
+    with profiled(args['profile']) if args['profile'] else contextlib.nullcontext():
+        if args['incremental']:
+            face_detections, failures = process_recent_images(ORIGINAL_DIR, MANIPULATED_DIR,
+                    PREDICTOR_PATH, VIDEO_PATH, FRAME_RATE, DRAW, CROP, **OPTIONS)
+        else:
+            face_detections, failures = process_all_images(ORIGINAL_DIR, MANIPULATED_DIR,
+                    PREDICTOR_PATH, VIDEO_PATH, FRAME_RATE, DRAW, CROP,
+                    stream=args['stream'], **OPTIONS)
+    seconds = time.perf_counter() - start
+
+    # report where the time of the run went
+    if args['report']:
+        report = write_run_report(args['report'], OPTIONS['timer'],
+            len(face_detections) + len(failures), seconds, failures)
+        print("Processed {} images at {:.2f} images/s, peak RSS {:.0f} MB".format(
+            report['images'], report['images_per_second'] or 0, report['peak_rss_mb']))
+
+    # report any images which could not be processed
+    for file_name, error in failures.items():
+        print("{!r} failed: {}".format(file_name, error))
+
+    # if prompted then save facial detections for later usage, incremental runs add
+    # the new images to the saved ones
+    if SAVE:
+        if args['incremental'] and os.path.isdir('face_data'):
+            landmarks = LandmarkStore.load('face_data', mmap=False)
+            landmarks.update(face_detections)
+        else:
+            landmarks = LandmarkStore.from_face_detections(face_detections)
+        landmarks.save('face_data')
@@ -0,0 +1,233 @@
+
+# Standard library imports
+import os
+import queue
+import shutil
+
+# Third party library imports
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('PIL')
+pytest.importorskip('ffmpeg')
+pytest.importorskip('tqdm')
+
+# Local library imports
+from PIL import Image
+
+import ffmpeg
+
+from code import image_alignment
+from code.image_alignment import ALIGNMENT_TEMPLATE, alignment_anchors, crop_size, \
+    align_image_from_PIL, crop_pad_PIL, region_box, write_frame_queue_to_video, \
+    write_numpy_to_video, region_transform, resize_transform, \
+    similarity_transforms, transform_bounds
+
+
+def landmarks_from_anchors(anchors):
+    """ Builds 68 point landmarks whose eye centres and nose tip are the given anchors
+
+    :param anchors: A (N, 3, 2) array of the left eye, right eye and nose tip.
+    :return: A (N, 68, 2) array of landmarks.
+    """
+
+    points = np.zeros((len(anchors), 68, 2))
+    points[:, 36:42] = anchors[:, np.newaxis, 0]
+    points[:, 42:48] = anchors[:, np.newaxis, 1]
+    points[:, 30] = anchors[:, 2]
+    return points
+
+
+def similarity(scale, angle, shift):
+    """ Builds a (2, 3) similarity transform
+
+    :param scale: A float for the scale.
+    :param angle: A float for the rotation in radians.
+    :param shift: A (2,) translation.
+    :return: A (2, 3) numpy array.
+    """
+
+    cos, sin = scale * np.cos(angle), scale * np.sin(angle)
+    return np.array([[cos, -sin, shift[0]], [sin, cos, shift[1]]])
+
+
+def apply(transform, points):
+    return points @ transform[:, :2].T + transform[:, 2]
+
+
+def test_similarity_transforms_recover_exact_transforms():
+    output_size = crop_size(1000)
+    template = ALIGNMENT_TEMPLATE * np.asarray(output_size)
+    truths = [
+        similarity(1.0, 0.0, (0, 0)),
+        similarity(2.5, 0.3, (120, -40)),
+        similarity(0.7, -1.2, (3000, 2000)),
+    ]
+    anchors = np.stack([apply(truth, template) for truth in truths])
+
+    transforms = similarity_transforms(landmarks_from_anchors(anchors), output_size)
+
+    assert transforms.shape == (3, 2, 3)
+    np.testing.assert_allclose(transforms, np.stack(truths), atol=1e-9)
+
+
+def test_similarity_transforms_are_least_squares_fits():
+    # the nose is moved off the similarity so no transform fits exactly, the fit must
+    # still be the least squares one, its residuals orthogonal to every parameter
+    output_size = (800, 1040)
+    template = ALIGNMENT_TEMPLATE * np.asarray(output_size)
+    anchors = apply(similarity(1.8, 0.4, (500, 600)), template)
+    anchors[2] += (25, -10)
+    transform = similarity_transforms(landmarks_from_anchors(anchors[np.newaxis]),
+        output_size)[0]
+
+    residual = apply(transform, template) - anchors
+    a, b = residual[:, 0], residual[:, 1]
+    u, v = template[:, 0], template[:, 1]
+    np.testing.assert_allclose(
+        [a.sum(), b.sum(), (a * u + b * v).sum(), (b * u - a * v).sum()], 0, atol=1e-6
+    )
+
+
+def test_alignment_anchors_average_the_eyes():
+    points = np.arange(68 * 2, dtype=float).reshape(1, 68, 2)
+    anchors = alignment_anchors(points)
+
+    np.testing.assert_allclose(anchors[0, 0], points[0, 36:42].mean(axis=0))
+    np.testing.assert_allclose(anchors[0, 1], points[0, 42:48].mean(axis=0))
+    np.testing.assert_allclose(anchors[0, 2], points[0, 30])
+
+
+def test_transform_bounds_of_identity_and_rotation():
+    assert transform_bounds(similarity(1, 0, (10, 20)), (100, 50)) == (10, 20, 110, 70)
+
+    # a quarter turn swaps the extent of the width and the height
+    bounds = transform_bounds(similarity(2, np.pi / 2, (0, 0)), (100, 50))
+    np.testing.assert_allclose(bounds, (-100, 0, 0, 200), atol=1e-9)
+
+
+def test_resize_transform_keeps_the_framing():
+    transform = similarity(1.5, 0.2, (300, 400))
+    output_size, new_size = (1000, 1300), (250, 325)
+    resized = resize_transform(transform, output_size, new_size)
+
+    # the corners and centre of both frames map onto the same input pixels
+    new_points = np.array([[0, 0], [250, 0], [0, 325], [250, 325], [125, 162.5]])
+    np.testing.assert_allclose(
+        apply(resized, new_points), apply(transform, new_points * 4), atol=1e-9
+    )
+    np.testing.assert_allclose(
+        transform_bounds(resized, new_size), transform_bounds(transform, output_size)
+    )
+
+
+def test_region_transform_maps_onto_the_same_input_pixels():
+    transform = similarity(1.7, -0.3, (1200, 900))
+    offset, factor = (1000, 750), (4, 4)
+    local = region_transform(transform, offset, factor)
+
+    # a region pixel times the factor plus the offset is the full resolution pixel
+    points = np.array([[0, 0], [400, 0], [0, 520], [400, 520], [133, 250]])
+    np.testing.assert_allclose(
+        apply(local, points) * factor + offset, apply(transform, points), atol=1e-9
+    )
+
+
+def test_region_box_maps_onto_the_same_input_pixels():
+    box = (1500, 800, 3500, 3400)
+    offset, factor = (1472, 768), (2, 4)
+
+    local = region_box(box, offset, factor)
+
+    assert local == (14, 8, 1014, 658)
+
+
+def test_aligning_a_region_matches_aligning_the_whole_image():
+    rng = np.random.default_rng(0)
+    PIL_img = Image.fromarray(rng.integers(0, 256, (150, 200, 3), dtype=np.uint8))
+    transform = similarity(1, 0, (37, 21))
+    offset = (30, 15)
+    region = PIL_img.crop((30, 15, 130, 90))
+
+    whole = align_image_from_PIL(PIL_img, transform, (60, 40), Image.NEAREST)
+    local = align_image_from_PIL(
+        region, region_transform(transform, offset, (1, 1)), (60, 40), Image.NEAREST
+    )
+
+    np.testing.assert_array_equal(np.asarray(local), np.asarray(whole))
+
+
+def test_crop_pad_fills_outside_the_image_with_the_pad_colour(monkeypatch):
+    monkeypatch.setattr(image_alignment, 'PAD_COLOUR', 'white')
+    rng = np.random.default_rng(0)
+    pixels = rng.integers(0, 200, (30, 40, 3), dtype=np.uint8)
+    PIL_img = Image.fromarray(pixels)
+
+    frame = np.asarray(crop_pad_PIL(PIL_img, (-10, 20, 25.4, 45)))
+
+    assert frame.shape == (25, 35, 3)
+    np.testing.assert_array_equal(frame[:10, 10:], pixels[20:, :25])
+    assert (frame[:, :10] == 255).all() and (frame[10:] == 255).all()
+
+
+def test_crop_pad_inside_the_image_is_a_plain_crop():
+    PIL_img = Image.fromarray(np.arange(30 * 40 * 3, dtype=np.uint8).reshape(30, 40, 3))
+    box = (3.6, 2, 30, 27.5)
+
+    np.testing.assert_array_equal(
+        np.asarray(crop_pad_PIL(PIL_img, box)), np.asarray(PIL_img.crop(box))
+    )
+
+
+needs_ffmpeg = pytest.mark.skipif(shutil.which('ffmpeg') is None, reason="needs ffmpeg")
+
+
+@needs_ffmpeg
+def test_write_numpy_to_video_encodes_every_frame(tmp_path):
+    video_path = str(tmp_path / "video.mp4")
+    frames = (np.full((32, 48, 3), i * 20, dtype=np.uint8) for i in range(5))
+
+    assert write_numpy_to_video(video_path, frames, 5) == video_path
+    assert os.path.getsize(video_path) > 0
+
+
+@needs_ffmpeg
+def test_write_numpy_to_video_raises_on_a_wrong_sized_frame(tmp_path):
+    frames = [np.zeros((32, 48, 3), dtype=np.uint8), np.zeros((16, 48, 3), dtype=np.uint8)]
+
+    with pytest.raises(ValueError, match="does not match the video shape"):
+        write_numpy_to_video(str(tmp_path / "video.mp4"), frames, 5)
+
+
+@needs_ffmpeg
+def test_write_numpy_to_video_raises_when_ffmpeg_fails(tmp_path):
+    frames = [np.zeros((32, 48, 3), dtype=np.uint8)] * 3
+
+    with pytest.raises(ffmpeg.Error):
+        write_numpy_to_video(str(tmp_path / "video.mp4"), frames, 5,
+            encoder={'vcodec': 'no_such_codec'})
+
+
+@needs_ffmpeg
+def test_write_frame_queue_to_video_drains_the_queue_after_a_failure(tmp_path):
+    frame_queue = queue.Queue()
+    frame_queue.put(np.zeros((32, 48, 3), dtype=np.uint8))
+    frame_queue.put(np.zeros((16, 48, 3), dtype=np.uint8))
+    frame_queue.put(np.zeros((32, 48, 3), dtype=np.uint8))
+    frame_queue.put(None)
+
+    with pytest.raises(ValueError):
+        write_frame_queue_to_video(str(tmp_path / "video.mp4"), frame_queue, 5)
+    assert frame_queue.empty()
+
+
+@needs_ffmpeg
+def test_write_frame_queue_to_video_encodes_until_none(tmp_path):
+    frame_queue = queue.Queue()
+    for i in range(4):
+        frame_queue.put(np.full((32, 48, 3), i * 40, dtype=np.uint8))
+    frame_queue.put(None)
+    video_path = str(tmp_path / "video.mp4")
+
+    assert write_frame_queue_to_video(video_path, frame_queue, 5) == video_path
+    assert os.path.getsize(video_path) > 0
@@ -0,0 +1,121 @@
+
+# Third party library imports
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('PIL')
+pytest.importorskip('ffmpeg')
+pytest.importorskip('tqdm')
+
+# Local library imports
+from code.image_alignment import crop_box_from_face, crop_size, similarity_transforms
+from code.landmark_smoothing import SMOOTHING_METHODS, smooth_sequence
+
+
+def face_landmarks(seed=0):
+    """ Builds plausible 68 point landmarks of a face about 300 pixels wide
+
+    :param seed: An integer for the random jitter of the points.
+    :return: A (68, 2) numpy array of landmarks.
+    """
+
+    rng = np.random.default_rng(seed)
+    angles = np.linspace(0, 2 * np.pi, 68, endpoint=False)
+    points = np.c_[150 * np.cos(angles), 200 * np.sin(angles)] + rng.normal(0, 3, (68, 2))
+    points[36:42] = (-60, -40) + rng.normal(0, 2, (6, 2))
+    points[42:48] = (60, -40) + rng.normal(0, 2, (6, 2))
+    points[30] = (0, 30)
+    points[27] = (0, -35)
+    return points
+
+
+def translated_sequence(num_frames=12):
+    # daily selfies of the same face, each at a different place in the photo
+    shifts = np.random.default_rng(1).uniform(-800, 800, (num_frames, 2)) + (2000, 1500)
+    return face_landmarks()[np.newaxis] + shifts[:, np.newaxis]
+
+
+def crop_boxes(points, box_size=1000):
+    return [
+        crop_box_from_face({0: {'facial_points': [tuple(p) for p in frame]}}, box_size)
+        for frame in points
+    ]
+
+
+@pytest.mark.parametrize('method', SMOOTHING_METHODS)
+def test_translated_faces_keep_their_crops(method):
+    points = translated_sequence()
+
+    smoothed, outliers = smooth_sequence(points, method)
+
+    assert not outliers.any()
+    np.testing.assert_allclose(crop_boxes(smoothed), crop_boxes(points), atol=1e-6)
+    np.testing.assert_allclose(
+        similarity_transforms(smoothed, crop_size(1000)),
+        similarity_transforms(points, crop_size(1000)), atol=1e-6
+    )
+
+
+def test_rotated_and_scaled_faces_keep_their_landmarks():
+    base = face_landmarks()
+    frames = []
+    for i in range(10):
+        angle, scale = 0.05 * (-1) ** i * i, 1 + 0.1 * (i % 3)
+        rotation = scale * np.array([[np.cos(angle), -np.sin(angle)],
+            [np.sin(angle), np.cos(angle)]])
+        frames.append(base @ rotation.T + (300 * i, -150 * i))
+    points = np.stack(frames)
+
+    smoothed, outliers = smooth_sequence(points)
+
+    assert not outliers.any()
+    np.testing.assert_allclose(smoothed, points, atol=1e-6)
+
+
+def test_outlier_shapes_are_replaced_in_their_own_frame():
+    points = translated_sequence()
+    points[5, :17] += (0, 300)
+    transform = similarity_transforms(points[5:6], crop_size(1000))
+
+    smoothed, outliers = smooth_sequence(points)
+
+    assert outliers.tolist() == [i == 5 for i in range(len(points))]
+    # the jaw is put back on the face where it was photographed, not a neighbour's
+    np.testing.assert_allclose(smoothed, translated_sequence(), atol=1e-6)
+    np.testing.assert_allclose(
+        similarity_transforms(smoothed[5:6], crop_size(1000)), transform, atol=1e-6
+    )
+
+
+@pytest.mark.parametrize('method', SMOOTHING_METHODS)
+def test_noisy_eyes_and_nose_give_steadier_transforms(method):
+    points = translated_sequence(30)
+    truth = similarity_transforms(points, crop_size(1000))
+
+    # every detection misplaces the eyes and the nose tip by a few pixels
+    rng = np.random.default_rng(2)
+    noisy = points.copy()
+    noisy[:, 36:42] += rng.normal(0, 4, (30, 1, 2))
+    noisy[:, 42:48] += rng.normal(0, 4, (30, 1, 2))
+    noisy[:, 30] += rng.normal(0, 4, (30, 2))
+
+    smoothed, outliers = smooth_sequence(noisy, method)
+
+    raw_jitter = np.abs(similarity_transforms(noisy, crop_size(1000)) - truth).mean()
+    jitter = np.abs(similarity_transforms(smoothed, crop_size(1000)) - truth).mean()
+    assert not outliers.any()
+    assert jitter < 0.7 * raw_jitter
+
+
+def test_misplaced_eyes_are_aligned_like_their_neighbours():
+    points = translated_sequence()
+    truth = similarity_transforms(points, crop_size(1000))
+    points[7, 36:48] += (0, -60)
+    points[7, 30] += (25, 0)
+
+    smoothed, outliers = smooth_sequence(points)
+
+    assert outliers.tolist() == [i == 7 for i in range(len(points))]
+    np.testing.assert_allclose(
+        similarity_transforms(smoothed, crop_size(1000)), truth, atol=1e-6
+    )
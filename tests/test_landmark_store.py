@@ -0,0 +1,34 @@
+
+# Third party library imports
+import pytest
+
+np = pytest.importorskip('numpy')
+
+# Local library imports
+from code.landmark_store import LandmarkStore
+
+
+def face(offset):
+    """ Builds a facial detection dictionary with every landmark at an offset
+
+    :param offset: An integer for the coordinates of the face.
+    :return: A dictionary of facial detections.
+    """
+
+    return {0: {
+        'facial_coords': [offset, offset, offset + 10, offset + 10],
+        'facial_points': [(offset, offset)] * 68,
+    }}
+
+
+def test_update_of_a_saved_store_keeps_earlier_runs(tmp_path):
+    LandmarkStore.from_face_detections({'a': face(1), 'b': face(2)}).save(str(tmp_path))
+
+    landmarks = LandmarkStore.load(str(tmp_path), mmap=False)
+    landmarks.update({'b': face(5), 'c': face(3), 'd': face(4)})
+    landmarks.save(str(tmp_path))
+
+    landmarks = LandmarkStore.load(str(tmp_path))
+    assert landmarks.names == ['a', 'b', 'c', 'd']
+    assert landmarks.points[:, 0, 0].tolist() == [1, 2, 3, 4]
+    assert landmarks.boxes[:, 0].tolist() == [1, 2, 3, 4]
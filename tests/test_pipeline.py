@@ -0,0 +1,124 @@
+
+# Standard library imports
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+# Third party library imports
+import pytest
+
+# Local library imports
+from code.pipeline import bounded_map, chunked, prefetch, WriterPool
+
+
+def counted(items, consumed):
+    """ Yields items while recording how many were taken
+
+    :param items: An iterable of items.
+    :param consumed: A list the number of items taken so far is appended to.
+    :return: A generator of the items.
+    """
+
+    for i, item in enumerate(items):
+        consumed.append(i + 1)
+        yield item
+
+
+def test_chunked_keeps_the_remainder():
+    assert list(chunked(range(7), 3)) == [[0, 1, 2], [3, 4, 5], [6]]
+    assert list(chunked([], 3)) == []
+
+
+def test_bounded_map_yields_in_order():
+    # later items finish first, the results must still come back in order
+    def slow_first(i):
+        time.sleep(0.01 * (5 - i))
+        return i * i
+
+    with ThreadPoolExecutor(max_workers=5) as executor:
+        assert list(bounded_map(executor, slow_first, range(6), depth=4)) == \
+            [i * i for i in range(6)]
+
+
+def test_bounded_map_consumes_items_lazily():
+    consumed = []
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        results = bounded_map(executor, lambda i: i, counted(range(100), consumed), depth=3)
+        assert consumed == []
+
+        # the first result is only handed out once depth items are in flight
+        assert next(results) == 0
+        assert len(consumed) == 3
+        assert next(results) == 1
+        assert len(consumed) == 4
+        results.close()
+
+    assert len(consumed) == 4
+
+
+def test_bounded_map_keeps_at_most_depth_items_in_flight():
+    lock = threading.Lock()
+    running, peak = [0], [0]
+
+    def track(i):
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        time.sleep(0.005)
+        with lock:
+            running[0] -= 1
+        return i
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        assert list(bounded_map(executor, track, range(40), depth=3)) == list(range(40))
+    assert 1 <= peak[0] <= 3
+
+
+def test_bounded_map_raises_the_failure_of_an_item():
+    def fail_on_two(i):
+        if i == 2:
+            raise ValueError("bad item")
+        return i
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        results = bounded_map(executor, fail_on_two, range(5), depth=2)
+        assert [next(results), next(results)] == [0, 1]
+        with pytest.raises(ValueError, match="bad item"):
+            next(results)
+
+
+def test_prefetch_yields_in_order():
+    assert list(prefetch(str, range(20), threads=4, depth=5)) == [str(i) for i in range(20)]
+
+
+def test_writer_pool_records_failures_by_name():
+    saved = []
+
+    def save(name):
+        if name == 'b':
+            raise IOError("disk full")
+        saved.append(name)
+
+    with WriterPool(threads=2, depth=2) as writer:
+        for name in 'abcde':
+            writer.save(name, save, name)
+
+    assert sorted(saved) == ['a', 'c', 'd', 'e']
+    assert writer.errors == {'b': 'OSError: disk full'}
+
+
+def test_writer_pool_runs_sinks_in_order():
+    sunk = []
+
+    def sink(i):
+        # earlier sinks are slower, they must still be written first
+        time.sleep(0.001 * (10 - i))
+        sunk.append(i)
+
+    with WriterPool(threads=2, depth=3) as writer:
+        for i in range(10):
+            writer.sink(str(i), sink, i)
+
+    assert sunk == list(range(10))
+    assert writer.errors == {}
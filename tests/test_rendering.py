@@ -0,0 +1,33 @@
+
+# Third party library imports
+import pytest
+
+np = pytest.importorskip('numpy')
+Image = pytest.importorskip('PIL.Image')
+ImageDraw = pytest.importorskip('PIL.ImageDraw')
+
+# Local library imports
+from code.rendering import draw_points_PIL, stamp_offsets
+
+
+@pytest.mark.parametrize('radius', [1, 2, 3, 5, 8, 13])
+def test_markers_match_per_point_ellipses(radius):
+    # points inside the image, on its edges and partly outside of it
+    points = [(20, 20), (0, 0), (63, 10), (5, 47), (-3, 30), (40, 50), (33, 33)]
+
+    expected = Image.new('RGB', (64, 48))
+    draw_obj = ImageDraw.Draw(expected)
+    for x, y in points:
+        draw_obj.ellipse([x - radius, y - radius, x + radius, y + radius], fill='#00FF00')
+
+    drawn = draw_points_PIL(Image.new('RGB', (64, 48)), points, radius)
+
+    np.testing.assert_array_equal(np.asarray(drawn), np.asarray(expected))
+
+
+def test_stamp_is_cached_and_read_only():
+    offsets = stamp_offsets(5)
+
+    assert stamp_offsets(5) is offsets
+    assert not offsets.flags.writeable
+    assert (0, 0) in {tuple(p) for p in offsets.tolist()}